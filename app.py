@@ -1,20 +1,355 @@
-from flask import Flask, request, render_template_string, redirect, url_for, send_file
+from flask import Flask, Response, request, render_template, redirect, url_for, stream_with_context, jsonify, g
+from flask import before_render_template, template_rendered
+from werkzeug.http import generate_etag
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 import io
 import csv
-from groq import Groq
+from groq import Groq, RateLimitError, APIConnectionError, InternalServerError
+from jinja2 import DictLoader
 import re
 import json
+import base64
+import threading
+import zlib
+import gzip
+import time
+import click
+import httpx
+import hashlib
+import os
+from html import escape
+import random
+import uuid
+import unicodedata
+import weakref
+import queue
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
+from collections import deque
+from bisect import bisect_left
+import cProfile
+import pstats
+import tempfile
+import shutil
 
 app = Flask(__name__)
 
-DB = 'crm.db'
+DB = os.environ.get('CRM_DB', 'crm.db')
 
-def init_db():
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    cur.execute('CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT)')
+# Each worker thread keeps one long-lived connection instead of paying for
+# connect/close on every query; sqlite3's per-connection statement cache then
+# holds the prepared statements for the lifetime of the thread.
+DB_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA temp_store=MEMORY',
+)
+DB_STATEMENT_CACHE = 256
+# synchronous for every connection: 'normal' does not fsync on a WAL commit,
+# 'full' flushes the log before each commit returns.
+WRITE_SYNC = os.environ.get('CRM_WRITE_SYNC', 'normal')
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+def get_db():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        ensure_schema()
+        conn = sqlite3.connect(DB, timeout=5, cached_statements=DB_STATEMENT_CACHE, factory=TimedConnection)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        conn.execute(f"PRAGMA synchronous={'FULL' if WRITE_SYNC == 'full' else 'NORMAL'}")
+        _local.conn = conn
+    return conn
+
+def close_db():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+@app.teardown_request
+def rollback_db(exc):
+    # A pooled connection must never carry an open transaction into the next request.
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+# Metrics. Each process keeps counters and histograms in memory. When
+# METRICS_DIR is set (run_server sets it for its workers) a background thread
+# in each process writes a snapshot there every METRICS_FLUSH_INTERVAL seconds,
+# whether or not requests arrive, and /metrics adds up the snapshots of every
+# worker in the Prometheus text format.
+METRICS_DIR = os.environ.get('CRM_METRICS_DIR')
+METRICS_FLUSH_INTERVAL = 5
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICS = {
+    'crm_http_request_duration_seconds': ('histogram', 'Request latency by route, until the body has been sent.'),
+    'crm_sql_query_duration_seconds': ('histogram', 'SQLite statement latency, execute plus first row.'),
+    'crm_sql_slow_queries_total': ('counter', 'Statements slower than SLOW_QUERY_SECONDS.'),
+    'crm_template_render_duration_seconds': ('histogram', 'Jinja template render time.'),
+    'crm_llm_request_duration_seconds': ('histogram', 'Groq completion latency, excluding the wait for a slot.'),
+    'crm_llm_first_token_seconds': ('histogram', 'Time to the first streamed token.'),
+    'crm_llm_retries_total': ('counter', 'Groq calls retried after a rate limit or connection error.'),
+    'crm_llm_tokens_total': ('counter', 'Prompt and completion tokens, from usage or estimated.'),
+    'crm_write_batches_total': ('counter', 'Group commits run by the writer thread.'),
+    'crm_write_batch_rows_total': ('counter', 'Writes included in those group commits.'),
+}
+SLOW_QUERY_SECONDS = float(os.environ.get('CRM_SLOW_QUERY_MS', 100)) / 1000
+SQL_LABEL_LENGTH = 120
+_metrics_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_sql_labels = {}
+_metrics_flusher = None
+_SQL_SPACE = re.compile(r'\s+')
+_SQL_PLACEHOLDERS = re.compile(r'\?(?:\s*,\s*\?)+')
+
+def observe(name, labels, seconds):
+    key = (name, labels)
+    with _metrics_lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(METRICS_BUCKETS) + 2)
+        histogram[bisect_left(METRICS_BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+def inc(name, labels=(), amount=1):
+    key = (name, labels)
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def sql_labels(sql):
+    # Statements are labelled by their normalized text; IN lists of any length
+    # share one label.
+    labels = _sql_labels.get(sql)
+    if labels is None:
+        labels = (('statement', _SQL_PLACEHOLDERS.sub('?, ...', _SQL_SPACE.sub(' ', sql).strip())[:SQL_LABEL_LENGTH]),)
+        if len(_sql_labels) < 10000:
+            _sql_labels[sql] = labels
+    return labels
+
+def record_query(sql, parameters, seconds):
+    labels = sql_labels(sql)
+    observe('crm_sql_query_duration_seconds', labels, seconds)
+    label = labels[0][1]
+    queries = getattr(_local, 'queries', None)
+    if queries is not None:
+        queries.append((label, seconds))
+    if seconds >= SLOW_QUERY_SECONDS:
+        inc('crm_sql_slow_queries_total')
+        app.logger.warning('slow query %.1f ms: %s %.200r', seconds * 1000, label, parameters)
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, parameters, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(sql, (), time.perf_counter() - start)
+
+class TimedConnection(sqlite3.Connection):
+    # conn.execute() would bypass TimedCursor.execute, so it is routed through it.
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        if not self.in_transaction:
+            return super().commit()
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            record_query('COMMIT', (), time.perf_counter() - start)
+
+    # `with conn:` commits or rolls back in C without calling commit().
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.in_transaction:
+            return super().__exit__(exc_type, exc_value, traceback)
+        start = time.perf_counter()
+        try:
+            return super().__exit__(exc_type, exc_value, traceback)
+        finally:
+            record_query('ROLLBACK' if exc_type else 'COMMIT', (), time.perf_counter() - start)
+
+def metrics_snapshot():
+    with _metrics_lock:
+        return {'histograms': [[name, labels, values[:]] for (name, labels), values in _histograms.items()],
+                'counters': [[name, labels, value] for (name, labels), value in _counters.items()]}
+
+def flush_metrics():
+    if not METRICS_DIR:
+        return
+    path = os.path.join(METRICS_DIR, f'{os.getpid()}.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(metrics_snapshot(), f)
+    os.replace(path + '.tmp', path)
+
+def start_metrics_flusher():
+    global _metrics_flusher
+    if not METRICS_DIR:
+        return
+    with _metrics_lock:
+        if _metrics_flusher is None:
+            _metrics_flusher = threading.Thread(target=_flush_metrics_forever, name='metrics-flush', daemon=True)
+            _metrics_flusher.start()
+
+def _flush_metrics_forever():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush_metrics()
+        except OSError:
+            app.logger.exception('could not write metrics snapshot')
+
+def collect_metrics():
+    snapshots = [metrics_snapshot()]
+    if METRICS_DIR:
+        own = f'{os.getpid()}.json'
+        for filename in os.listdir(METRICS_DIR):
+            if filename.endswith('.json') and filename != own:
+                try:
+                    with open(os.path.join(METRICS_DIR, filename)) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+    histograms, counters = {}, {}
+    for snapshot in snapshots:
+        for name, labels, values in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            total = histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+    return histograms, counters
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _label_text(labels, extra=()):
+    pairs = [f'{k}="{_label_value(v)}"' for k, v in tuple(labels) + tuple(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def render_metrics():
+    histograms, counters = collect_metrics()
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        if kind == 'counter':
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f'{name}{_label_text(labels)} {value}')
+            continue
+        for (metric, labels), values in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(METRICS_BUCKETS + ('+Inf',), values[:-1]):
+                cumulative += count
+                lines.append(f'{name}_bucket{_label_text(labels, (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{_label_text(labels)} {values[-1]:.6f}')
+            lines.append(f'{name}_count{_label_text(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+# Per-request profiling: with PROFILE_ENABLED (CRM_PROFILE=1, or debug mode) a
+# request carrying the X-Profile header runs under cProfile, and the response
+# is replaced by the top PROFILE_STATS_LINES functions plus the SQL it ran.
+PROFILE_HEADER = 'X-Profile'
+PROFILE_ENABLED = os.environ.get('CRM_PROFILE') == '1'
+PROFILE_STATS_LINES = 40
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    if _metrics_flusher is None:
+        start_metrics_flusher()
+    if request.headers.get(PROFILE_HEADER) and (PROFILE_ENABLED or app.debug):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return  # another request in this process is being profiled
+        g.profiler, _local.queries = profiler, []
+
+@app.after_request
+def record_request_metrics(response):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        response = profile_report(profiler, response)
+    g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    # Streamed responses keep the request context until the body is sent, so
+    # this runs after the last chunk.
+    started = g.get('request_started')
+    if started is None:
+        return
+    status = g.get('response_status', 500)
+    labels = (('method', request.method), ('route', request.url_rule.rule if request.url_rule else 'unmatched'),
+              ('status', str(status)))
+    observe('crm_http_request_duration_seconds', labels, time.perf_counter() - started)
+
+def profile_report(profiler, response):
+    try:
+        if not response.direct_passthrough:
+            response.get_data()  # run streamed bodies under the profiler too
+    finally:
+        profiler.disable()
+        queries, _local.queries = _local.queries, None
+    out = io.StringIO()
+    sql_total = sum(seconds for _, seconds in queries)
+    out.write(f"{request.method} {request.full_path} -> {response.status}\n")
+    out.write(f"{len(queries)} SQL statements, {sql_total * 1000:.2f} ms\n")
+    for label, seconds in sorted(queries, key=lambda q: -q[1])[:10]:
+        out.write(f"  {seconds * 1000:8.2f} ms  {label}\n")
+    out.write('\n')
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_STATS_LINES)
+    response.close()
+    return Response(out.getvalue(), mimetype='text/plain', headers={'X-Profiled-Status': str(response.status_code)})
+
+def _template_started(sender, template, context, **extra):
+    _local.template_started = time.perf_counter()
+
+def _template_finished(sender, template, context, **extra):
+    started = getattr(_local, 'template_started', None)
+    if started is not None:
+        observe('crm_template_render_duration_seconds', (('template', template.name),), time.perf_counter() - started)
+        _local.template_started = None
+
+before_render_template.connect(_template_started, app)
+template_rendered.connect(_template_finished, app)
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# Schema migrations, applied in order. The index of a migration in MIGRATIONS
+# plus one is the schema version it produces; the current version is stored
+# in config under 'schema_version'. Never edit a released migration, append a
+# new one instead.
+def _migrate_base_schema(cur):
     cur.execute('''
         CREATE TABLE IF NOT EXISTS customers (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -53,46 +388,972 @@ def init_db():
             timestamp TEXT
         )
     ''')
-    conn.commit()
-    conn.close()
+
+def _migrate_query_indexes(cur):
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_interactions_customer_date ON interactions (customer_id, date)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_interactions_date ON interactions (date)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_chat_history_timestamp ON chat_history (timestamp)')
+
+# SQLite has no regexp replace, so triggers strip the usual phone punctuation
+# by hand. Numbers longer than ten digits are also indexed without their
+# country code so local-format searches still prefix-match.
+_PHONE_DIGITS_SQL = "replace(replace(replace(replace(replace(replace(coalesce({0}, ''), '-', ''), ' ', ''), '(', ''), ')', ''), '.', ''), '+', '')"
+_PHONE_INDEX_SQL = "CASE WHEN length({0}) > 10 THEN {0} || ' ' || substr({0}, -10) ELSE {0} END"
+
+def _phone_index_sql(column):
+    return _PHONE_INDEX_SQL.format(_PHONE_DIGITS_SQL.format(column))
+
+def _migrate_customer_search(cur):
+    cur.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS customers_fts USING fts5(
+            name, account, email, phone,
+            tokenize = "unicode61 remove_diacritics 2",
+            prefix = '2 3 4'
+        )
+    ''')
+    cur.execute('INSERT INTO customers_fts (rowid, name, account, email, phone) '
+                'SELECT id, name, account, email, ' + _phone_index_sql('phone') + ' FROM customers')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS customers_fts_insert AFTER INSERT ON customers BEGIN
+            INSERT INTO customers_fts (rowid, name, account, email, phone)
+            VALUES (new.id, new.name, new.account, new.email, %s);
+        END
+    ''' % _phone_index_sql('new.phone'))
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS customers_fts_update AFTER UPDATE OF name, account, email, phone ON customers BEGIN
+            UPDATE customers_fts SET name = new.name, account = new.account, email = new.email, phone = %s
+            WHERE rowid = new.id;
+        END
+    ''' % _phone_index_sql('new.phone'))
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS customers_fts_delete AFTER DELETE ON customers BEGIN
+            DELETE FROM customers_fts WHERE rowid = old.id;
+        END
+    ''')
+
+def _migrate_customer_sort_indexes(cur):
+    # Expressions must match SORT_COLUMNS exactly for the planner to use them.
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_customers_name ON customers (name COLLATE NOCASE, id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_customers_account ON customers (account COLLATE NOCASE, id)')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_customers_email ON customers (coalesce(email, '') COLLATE NOCASE, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_customers_phone ON customers (coalesce(phone, '') COLLATE NOCASE, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_customers_created_at ON customers (coalesce(created_at, ''), id)")
+
+def _migrate_insight_cache(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS insight_cache (
+            customer_id INTEGER PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            insight TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            last_used_at TEXT NOT NULL
+        )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_insight_cache_last_used ON insight_cache (last_used_at)')
+
+def _migrate_llm_jobs(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS llm_jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            customer_id INTEGER,
+            prompt TEXT NOT NULL,
+            payload TEXT,
+            fingerprint TEXT,
+            status TEXT NOT NULL,
+            result TEXT,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_llm_jobs_status ON llm_jobs (status, updated_at)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_llm_jobs_customer ON llm_jobs (customer_id, kind, status)')
+
+def _migrate_insight_batches(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS insight_batches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filter TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            seconds REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS insight_batch_items (
+            batch_id INTEGER NOT NULL,
+            customer_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            completion_tokens INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            PRIMARY KEY (batch_id, customer_id)
+        ) WITHOUT ROWID
+    ''')
+
+def _migrate_chat_sessions(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            id TEXT PRIMARY KEY,
+            customer_id INTEGER,
+            summary TEXT NOT NULL DEFAULT '',
+            summarized_through INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_chat_sessions_updated_at ON chat_sessions (updated_at)')
+    cur.execute('ALTER TABLE chat_history ADD COLUMN session_id TEXT')
+    cur.execute('ALTER TABLE chat_history ADD COLUMN ai_text TEXT')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_chat_history_session ON chat_history (session_id, id)')
+
+# One row per customer with its interaction count and first/last interaction
+# date, kept current by triggers so pages and prompts never aggregate
+# interactions at read time. A delete or date change that moves the first or
+# last date re-reads it with one seek on idx_interactions_customer_date.
+# last_insight_at is written by store_cached_insight() and record_insight().
+def _migrate_customer_summary(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS customer_summary (
+            customer_id INTEGER PRIMARY KEY,
+            interaction_count INTEGER NOT NULL DEFAULT 0,
+            first_interaction TEXT,
+            last_interaction TEXT,
+            last_insight_at TEXT
+        )
+    ''')
+    cur.execute('''
+        INSERT OR IGNORE INTO customer_summary (customer_id, interaction_count, first_interaction, last_interaction, last_insight_at)
+        SELECT c.id, count(i.id), min(i.date), max(i.date), (SELECT created_at FROM insight_cache WHERE customer_id = c.id)
+        FROM customers c LEFT JOIN interactions i ON i.customer_id = c.id GROUP BY c.id
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS customer_summary_customer_insert AFTER INSERT ON customers BEGIN
+            INSERT OR IGNORE INTO customer_summary (customer_id) VALUES (new.id);
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS customer_summary_customer_delete AFTER DELETE ON customers BEGIN
+            DELETE FROM customer_summary WHERE customer_id = old.id;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS customer_summary_interaction_insert AFTER INSERT ON interactions BEGIN
+            UPDATE customer_summary SET
+                interaction_count = interaction_count + 1,
+                first_interaction = CASE WHEN first_interaction IS NULL OR new.date < first_interaction THEN new.date ELSE first_interaction END,
+                last_interaction = CASE WHEN last_interaction IS NULL OR new.date > last_interaction THEN new.date ELSE last_interaction END
+            WHERE customer_id = new.customer_id;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS customer_summary_interaction_delete AFTER DELETE ON interactions BEGIN
+            UPDATE customer_summary SET
+                interaction_count = interaction_count - 1,
+                first_interaction = CASE WHEN old.date = first_interaction
+                    THEN (SELECT min(date) FROM interactions WHERE customer_id = old.customer_id) ELSE first_interaction END,
+                last_interaction = CASE WHEN old.date = last_interaction
+                    THEN (SELECT max(date) FROM interactions WHERE customer_id = old.customer_id) ELSE last_interaction END
+            WHERE customer_id = old.customer_id;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS customer_summary_interaction_update AFTER UPDATE OF customer_id, date ON interactions BEGIN
+            UPDATE customer_summary SET
+                interaction_count = interaction_count + (customer_id = new.customer_id) - (customer_id = old.customer_id),
+                first_interaction = (SELECT min(date) FROM interactions WHERE customer_id = customer_summary.customer_id),
+                last_interaction = (SELECT max(date) FROM interactions WHERE customer_id = customer_summary.customer_id)
+            WHERE customer_id IN (old.customer_id, new.customer_id);
+        END
+    ''')
+    # Expressions must match SORT_COLUMNS exactly for the planner to use them.
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_customer_summary_count ON customer_summary (interaction_count, customer_id)')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_customer_summary_last ON customer_summary (coalesce(last_interaction, ''), customer_id)")
+
+# Duplicate detection. customer_keys holds each customer's blocking keys
+# (see customer_keys_for()); they are computed in Python, so triggers only drop
+# them when the fields change and index_customer_keys() fills them in again.
+# customer_duplicates is the review queue of scored pairs, lower id first.
+def _migrate_customer_dedup(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS customer_keys (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            customer_id INTEGER NOT NULL,
+            PRIMARY KEY (kind, key, customer_id)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_customer_keys_customer ON customer_keys (customer_id)')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS customer_duplicates (
+            customer_id INTEGER NOT NULL,
+            duplicate_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            status TEXT NOT NULL DEFAULT 'open',
+            found_at TEXT NOT NULL,
+            PRIMARY KEY (customer_id, duplicate_id)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_customer_duplicates_duplicate ON customer_duplicates (duplicate_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_customer_duplicates_status ON customer_duplicates (status, score)')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS customer_keys_update AFTER UPDATE OF name, email, phone ON customers BEGIN
+            DELETE FROM customer_keys WHERE customer_id = old.id;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS customer_keys_delete AFTER DELETE ON customers BEGIN
+            DELETE FROM customer_keys WHERE customer_id = old.id;
+            DELETE FROM customer_duplicates WHERE customer_id = old.id OR duplicate_id = old.id;
+        END
+    ''')
+    index_customer_keys(cur)
+
+def _migrate_insight_batch_settings(cur):
+    # Older batches have NULL settings and resume with the defaults.
+    cur.execute('ALTER TABLE insight_batches ADD COLUMN workers INTEGER')
+    cur.execute('ALTER TABLE insight_batches ADD COLUMN rpm INTEGER')
+    cur.execute('ALTER TABLE insight_batches ADD COLUMN tpm INTEGER')
+
+def _migrate_interaction_timeline_index(cur):
+    # The timeline sorts undated notes as '' so keyset paging can reach them.
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_interactions_customer_timeline ON interactions (customer_id, coalesce(date, ''))")
+
+def _migrate_customer_summary_backfill(cur):
+    # Recreates summary rows lost before the triggers covered every write, so
+    # the summary sorts, which inner-join the table, list every customer.
+    cur.execute('''
+        INSERT OR IGNORE INTO customer_summary (customer_id, interaction_count, first_interaction, last_interaction)
+        SELECT c.id, count(i.id), min(i.date), max(i.date)
+        FROM customers c LEFT JOIN interactions i ON i.customer_id = c.id
+        WHERE NOT EXISTS (SELECT 1 FROM customer_summary s WHERE s.customer_id = c.id)
+        GROUP BY c.id
+    ''')
+
+MIGRATIONS = [
+    _migrate_base_schema,
+    _migrate_query_indexes,
+    _migrate_customer_search,
+    _migrate_customer_sort_indexes,
+    _migrate_insight_cache,
+    _migrate_llm_jobs,
+    _migrate_insight_batches,
+    _migrate_chat_sessions,
+    _migrate_customer_summary,
+    _migrate_customer_dedup,
+    _migrate_insight_batch_settings,
+    _migrate_interaction_timeline_index,
+    _migrate_customer_summary_backfill,
+]
+
+def init_db():
+    conn = sqlite3.connect(DB, timeout=30, isolation_level=None)
+    try:
+        conn.execute('CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT)')
+        # BEGIN IMMEDIATE serializes concurrent starters; the loser re-reads the
+        # version after the winner commits and finds nothing left to do.
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute("SELECT value FROM config WHERE key = 'schema_version'").fetchone()
+        version = int(row[0]) if row else 0
+        cur = conn.cursor()
+        for migration in MIGRATIONS[version:]:
+            migration(cur)
+        if version < len(MIGRATIONS):
+            cur.execute("INSERT OR REPLACE INTO config (key, value) VALUES ('schema_version', ?)", (str(len(MIGRATIONS)),))
+        conn.execute('COMMIT')
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+def ensure_schema():
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if not _schema_ready:
+            init_db()
+            _schema_ready = True
+
+# Config values are cached per process. set_config() drops the local entry at
+# once; other worker processes pick up the change within CONFIG_CACHE_TTL.
+CONFIG_CACHE_TTL = 30
+_config_cache = {}
+
+def get_config(key):
+    entry = _config_cache.get(key)
+    if entry is not None and entry[1] > time.monotonic():
+        return entry[0]
+    row = get_db().execute('SELECT value FROM config WHERE key = ?', (key,)).fetchone()
+    value = row[0] if row else None
+    _config_cache[key] = (value, time.monotonic() + CONFIG_CACHE_TTL)
+    return value
+
+def set_config(key, value):
+    conn = get_db()
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)', (key, value))
+    _config_cache.pop(key, None)
 
 def get_api_key():
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    cur.execute('SELECT value FROM config WHERE key = "groq_api_key"')
-    row = cur.fetchone()
-    conn.close()
-    return row[0] if row else None
+    return get_config('groq_api_key')
 
 def set_api_key(key):
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    cur.execute('INSERT OR REPLACE INTO config (key, value) VALUES ("groq_api_key", ?)', (key,))
-    conn.commit()
-    conn.close()
+    set_config('groq_api_key', key)
+
+# One Groq client per process, rebuilt only when the API key changes, so AI
+# routes reuse its pooled keep-alive connections instead of a fresh TLS
+# handshake per request.
+LLM_TIMEOUT = 60
+LLM_MAX_CONNECTIONS = 20
+_llm_client = None
+_llm_client_key = None
+_llm_lock = threading.Lock()
+
+def _close_http_client(http_client, pid):
+    # A forked worker shares the parent's sockets and must leave them open.
+    if os.getpid() == pid:
+        http_client.close()
+
+def get_llm_client(api_key):
+    global _llm_client, _llm_client_key
+    with _llm_lock:
+        if _llm_client is None or _llm_client_key != api_key:
+            http_client = httpx.Client(
+                timeout=LLM_TIMEOUT,
+                limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS),
+            )
+            # Retries are done by create_completion(), which also holds the per-key slot.
+            _llm_client = Groq(api_key=api_key, http_client=http_client, max_retries=0)
+            # A replaced client may still be serving calls and streams in other
+            # threads; its pool is closed once the last of them lets go of it.
+            weakref.finalize(_llm_client, _close_http_client, http_client, os.getpid())
+            _llm_client_key = api_key
+        return _llm_client
+
+# Generated insights are cached per customer under a hash of the model and the
+# full prompt, which already contains every customer field and interaction, so
+# any change to the data (or to the prompt wording) misses the cache. Writes
+# that change a customer also drop its entry outright.
+LLM_MODEL = "llama3-70b-8192"
+INSIGHT_CACHE_TTL = 7 * 24 * 3600
+INSIGHT_CACHE_MAX_ENTRIES = 10000
+
+def insight_fingerprint(prompt):
+    return hashlib.sha256(f'{LLM_MODEL}\n{prompt}'.encode()).hexdigest()
+
+def get_cached_insight(customer_id, fingerprint):
+    conn = get_db()
+    row = conn.execute('SELECT insight, created_at FROM insight_cache WHERE customer_id = ? AND fingerprint = ? AND created_at > ?',
+                       (customer_id, fingerprint, (datetime.now() - timedelta(seconds=INSIGHT_CACHE_TTL)).isoformat())).fetchone()
+    if row:
+        with conn:
+            conn.execute('UPDATE insight_cache SET last_used_at = ? WHERE customer_id = ?', (datetime.now().isoformat(), customer_id))
+    return row
+
+def store_cached_insight(customer_id, fingerprint, insight):
+    conn = get_db()
+    now = datetime.now()
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO insight_cache (customer_id, fingerprint, insight, created_at, last_used_at) VALUES (?, ?, ?, ?, ?)',
+                     (customer_id, fingerprint, insight, now.isoformat(), now.isoformat()))
+        conn.execute('UPDATE customer_summary SET last_insight_at = ? WHERE customer_id = ?', (now.isoformat(), customer_id))
+        conn.execute('DELETE FROM insight_cache WHERE created_at <= ?', ((now - timedelta(seconds=INSIGHT_CACHE_TTL)).isoformat(),))
+        conn.execute('''DELETE FROM insight_cache WHERE customer_id IN (
+                            SELECT customer_id FROM insight_cache ORDER BY last_used_at
+                            LIMIT max(0, (SELECT count(*) FROM insight_cache) - ?))''', (INSIGHT_CACHE_MAX_ENTRIES,))
+
+def record_insight(customer_id):
+    # For insights that are not cached (custom questions).
+    conn = get_db()
+    with conn:
+        conn.execute('UPDATE customer_summary SET last_insight_at = ? WHERE customer_id = ?', (datetime.now().isoformat(), customer_id))
+
+def customer_activity(cur, customer_id, insight=True):
+    # One line from customer_summary for prompts. The insight time is left out
+    # of cached insight prompts, where it would change the fingerprint.
+    row = cur.execute('SELECT interaction_count, first_interaction, last_interaction, last_insight_at FROM customer_summary WHERE customer_id = ?',
+                      (customer_id,)).fetchone()
+    if not row:
+        return ''
+    count, first, last, last_insight = row
+    # Rows written with a NULL date count but have no first or last date.
+    line = f"{count} interactions, first {(first or '?')[:10]}, last {(last or '?')[:10]}" if count else "No interactions yet"
+    if insight and last_insight:
+        line += f", last AI insight {last_insight[:10]}"
+    return line
+
+def invalidate_insight(cur, customer_id):
+    cur.execute('DELETE FROM insight_cache WHERE customer_id = ?', (customer_id,))
+
+# At most LLM_CONCURRENCY_PER_KEY calls per API key are in flight in this
+# process; further callers wait up to LLM_TIMEOUT for a slot. Rate-limit and
+# transient errors are retried with exponential backoff and jitter, honouring
+# Retry-After when the API sends one. A call keeps its slot while it backs off,
+# since every other call on a rate-limited key would be refused too.
+LLM_CONCURRENCY_PER_KEY = 4
+LLM_MAX_RETRIES = 4
+LLM_RETRY_BASE_DELAY = 1.0
+LLM_RETRY_MAX_DELAY = 30.0
+LLM_RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+_llm_slots = {}
+
+@contextmanager
+def llm_slot(api_key):
+    with _llm_lock:
+        slots = _llm_slots.get(api_key)
+        if slots is None:
+            slots = _llm_slots[api_key] = threading.BoundedSemaphore(LLM_CONCURRENCY_PER_KEY)
+    if not slots.acquire(timeout=LLM_TIMEOUT):
+        raise RuntimeError("Too many AI requests in progress, try again shortly")
+    try:
+        yield
+    finally:
+        slots.release()
+
+def retry_delay(error, attempt):
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = LLM_RETRY_BASE_DELAY * 2 ** attempt * random.uniform(0.5, 1.5)
+    return min(delay, LLM_RETRY_MAX_DELAY)
+
+def create_completion(api_key, prompt, **options):
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        try:
+            return get_llm_client(api_key).chat.completions.create(
+                model=LLM_MODEL,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.7,
+                max_tokens=500,
+                **options,
+            )
+        except LLM_RETRYABLE_ERRORS as e:
+            if attempt == LLM_MAX_RETRIES:
+                raise
+            inc('crm_llm_retries_total', (('error', type(e).__name__),))
+            time.sleep(retry_delay(e, attempt))
+
+@contextmanager
+def llm_timer(mode):
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield started
+        outcome = 'ok'
+    finally:
+        observe('crm_llm_request_duration_seconds', (('mode', mode), ('outcome', outcome)), time.perf_counter() - started)
+
+def record_llm_tokens(prompt_tokens, completion_tokens):
+    inc('crm_llm_tokens_total', (('type', 'prompt'),), prompt_tokens)
+    inc('crm_llm_tokens_total', (('type', 'completion'),), completion_tokens)
+
+def complete(api_key, prompt):
+    return complete_with_usage(api_key, prompt)[0]
+
+def complete_with_usage(api_key, prompt):
+    with llm_slot(api_key), llm_timer('complete'):
+        completion = create_completion(api_key, prompt)
+    text = completion.choices[0].message.content.strip()
+    usage = completion.usage
+    if usage is None:
+        prompt_tokens, completion_tokens = estimate_tokens(prompt), estimate_tokens(text)
+    else:
+        prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+    record_llm_tokens(prompt_tokens, completion_tokens)
+    return text, prompt_tokens, completion_tokens
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Streaming completions go out as server-sent events. 'delta' carries raw text
+# as it arrives; whenever a line completes, 'html' carries the Markdown of all
+# complete lines plus the unfinished tail, so the page re-renders once per line
+# rather than once per token. 'done' has the final HTML and text, after
+# on_complete(text, html) has persisted them.
+def stream_completion(api_key, prompt, on_complete):
+    def generate():
+        text = ''
+        try:
+            with llm_slot(api_key), llm_timer('stream') as started:
+                for chunk in create_completion(api_key, prompt, stream=True):
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if not delta:
+                        continue
+                    if not text:
+                        observe('crm_llm_first_token_seconds', (), time.perf_counter() - started)
+                    text += delta
+                    if '\n' in delta:
+                        line_end = text.rindex('\n')
+                        yield sse('html', {'html': basic_markdown(text[:line_end].strip()), 'tail': text[line_end + 1:]})
+                    else:
+                        yield sse('delta', {'text': delta})
+            text = text.strip()
+            record_llm_tokens(estimate_tokens(prompt), estimate_tokens(text))
+            html = basic_markdown(text)
+            on_complete(text, html)
+            yield sse('done', {'html': html, 'text': text})
+        except Exception as e:
+            yield sse('error', {'error': str(e)})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Background AI jobs. Blocking generations run on a small per-process thread
+# pool instead of holding a request worker for the whole round trip; the caller
+# gets a job id and polls GET /jobs/<id>. Job rows live in SQLite so any worker
+# process can answer the poll. A process accepts at most LLM_JOB_QUEUE_LIMIT
+# unfinished jobs, and a queued or running job not updated for
+# LLM_JOB_STALE_AFTER seconds is reported as lost (its process went away).
+LLM_JOB_WORKERS = 4
+LLM_JOB_QUEUE_LIMIT = 1000
+LLM_JOB_RETENTION = 24 * 3600
+LLM_JOB_STALE_AFTER = 600
+JOB_POLL_SECONDS = 2
+_job_executor = None
+_job_queue_slots = threading.BoundedSemaphore(LLM_JOB_QUEUE_LIMIT)
+
+class JobQueueFull(Exception):
+    pass
+
+def get_job_executor():
+    global _job_executor
+    with _llm_lock:
+        if _job_executor is None:
+            _job_executor = ThreadPoolExecutor(max_workers=LLM_JOB_WORKERS, thread_name_prefix='llm-job')
+        return _job_executor
+
+def submit_job(kind, prompt, customer_id=None, payload=None, fingerprint=None, wait=False):
+    if not _job_queue_slots.acquire(blocking=wait):
+        raise JobQueueFull("AI job queue is full, try again shortly")
+    job_id = uuid.uuid4().hex
+    now = datetime.now()
+    conn = get_db()
+    try:
+        with conn:
+            conn.execute("DELETE FROM llm_jobs WHERE status IN ('done', 'error') AND updated_at < ?",
+                         ((now - timedelta(seconds=LLM_JOB_RETENTION)).isoformat(),))
+            conn.execute("INSERT INTO llm_jobs (id, kind, customer_id, prompt, payload, fingerprint, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)",
+                         (job_id, kind, customer_id, prompt, payload, fingerprint, now.isoformat(), now.isoformat()))
+        get_job_executor().submit(run_job, job_id)
+    except Exception:
+        _job_queue_slots.release()
+        raise
+    return job_id
+
+def update_job(job_id, status, result=None, error=None):
+    conn = get_db()
+    with conn:
+        conn.execute('UPDATE llm_jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE id = ?',
+                     (status, result, error, datetime.now().isoformat(), job_id))
+
+def run_job(job_id):
+    try:
+        job = get_db().execute('SELECT kind, customer_id, payload, fingerprint, prompt FROM llm_jobs WHERE id = ?', (job_id,)).fetchone()
+        if not job:
+            return
+        kind, customer_id, payload, fingerprint, prompt = job
+        update_job(job_id, 'running')
+        try:
+            api_key = get_api_key()
+            if not api_key:
+                raise RuntimeError("API key not configured")
+            text = complete(api_key, prompt)
+            JOB_HANDLERS[kind](customer_id, payload, fingerprint, text)
+            update_job(job_id, 'done', result=text)
+        except Exception as e:
+            update_job(job_id, 'error', error=str(e))
+    finally:
+        _job_queue_slots.release()
+
+def get_job(job_id):
+    row = get_db().execute('SELECT id, kind, customer_id, payload, status, result, error, created_at, updated_at FROM llm_jobs WHERE id = ?',
+                           (job_id,)).fetchone()
+    if not row:
+        return None
+    job = dict(zip(('id', 'kind', 'customer_id', 'payload', 'status', 'result', 'error', 'created_at', 'updated_at'), row))
+    stale = (datetime.now() - timedelta(seconds=LLM_JOB_STALE_AFTER)).isoformat()
+    if job['status'] in ('queued', 'running') and job['updated_at'] < stale:
+        job['status'], job['error'] = 'error', "Job was lost before it finished"
+    job['html'] = basic_markdown(job['result']) if job['result'] else None
+    return job
+
+def find_active_job(kind, customer_id, fingerprint):
+    row = get_db().execute("""SELECT id FROM llm_jobs WHERE customer_id IS ? AND kind = ? AND status IN ('queued', 'running')
+                              AND fingerprint = ? AND updated_at > ? ORDER BY created_at DESC LIMIT 1""",
+                           (customer_id, kind, fingerprint, (datetime.now() - timedelta(seconds=LLM_JOB_STALE_AFTER)).isoformat())).fetchone()
+    return row[0] if row else None
+
+# Group commit for the small, frequent writes (interaction notes, chat
+# messages). Instead of one transaction per row, callers hand a write function
+# to a per-process writer thread, which runs everything queued so far (waiting
+# up to WRITE_BATCH_DELAY for more, at most WRITE_BATCH_MAX) in one
+# transaction, each write in its own savepoint so a failing one does not undo
+# the others. Callers block until their batch has committed, so a response is
+# only sent once its write is visible to every worker (read-your-writes).
+# With WRITE_SYNC 'full' a batch pays one fsync instead of one per write, but
+# every write also waits out WRITE_BATCH_DELAY. At SERVER_THREADS writers per
+# process that costs more than it saves under either sync level (bench.py
+# writes), so WRITE_MODE defaults to 'commit', one transaction per write on
+# the caller's connection; 'group' only pays off with many concurrent writers.
+WRITE_MODE = os.environ.get('CRM_WRITE_MODE', 'commit')
+WRITE_BATCH_DELAY = float(os.environ.get('CRM_WRITE_BATCH_DELAY_MS', 1)) / 1000
+WRITE_BATCH_MAX = 256
+WRITE_QUEUE_LIMIT = 10000
+WRITE_TIMEOUT = 30
+_write_queue = None
+
+def get_write_queue():
+    global _write_queue
+    with _llm_lock:
+        if _write_queue is None:
+            _write_queue = queue.Queue(WRITE_QUEUE_LIMIT)
+            threading.Thread(target=run_write_batches, args=(_write_queue,), name='group-commit', daemon=True).start()
+        return _write_queue
+
+def queued_write(fn, *args):
+    if WRITE_MODE == 'commit':
+        conn = get_db()
+        with conn:
+            return fn(conn.cursor(), *args)
+    future = Future()
+    get_write_queue().put((fn, args, future), timeout=WRITE_TIMEOUT)
+    return future.result(timeout=WRITE_TIMEOUT)
+
+def run_write_batches(writes):
+    conn = get_db()
+    while True:
+        batch = [writes.get()]
+        deadline = time.monotonic() + WRITE_BATCH_DELAY
+        while len(batch) < WRITE_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(writes.get(timeout=remaining) if remaining > 0 else writes.get_nowait())
+            except queue.Empty:
+                break
+        results = []
+        cur = conn.cursor()
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+            for fn, args, future in batch:
+                cur.execute('SAVEPOINT queued_write')
+                try:
+                    results.append((future, fn(cur, *args), None))
+                    cur.execute('RELEASE queued_write')
+                except Exception as e:
+                    cur.execute('ROLLBACK TO queued_write')
+                    cur.execute('RELEASE queued_write')
+                    results.append((future, None, e))
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            results = [(future, None, e) for _, _, future in batch]
+        inc('crm_write_batches_total')
+        inc('crm_write_batch_rows_total', (), len(batch))
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+_SEARCH_TOKEN = re.compile(r'[^\W_]+')
+_PHONE_QUERY = re.compile(r'^[\d\s().+-]+$')
+
+def phone_digits(value):
+    return re.sub(r'\D', '', value or '')
+
+def fts_query(search_query):
+    # Phone-looking input is collapsed to the digit string the index stores;
+    # everything else becomes an AND of prefix terms.
+    if _PHONE_QUERY.match(search_query):
+        digits = phone_digits(search_query)
+        return f'"{digits}"*' if digits else ''
+    return ' '.join(f'"{token}"*' for token in _SEARCH_TOKEN.findall(search_query))
+
+# The customer table is paged with keyset cursors: each page carries the sort
+# key and id of its last row, so fetching page N costs the same as page 1.
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+SORT_COLUMNS = {
+    'id': 'c.id',
+    'name': 'c.name COLLATE NOCASE',
+    'account': 'c.account COLLATE NOCASE',
+    'email': "coalesce(c.email, '') COLLATE NOCASE",
+    'phone': "coalesce(c.phone, '') COLLATE NOCASE",
+    'created_at': "coalesce(c.created_at, '')",
+    'interactions': 's.interaction_count',
+    'last_contact': "coalesce(s.last_interaction, '')",
+}
+# Columns whose first click sorts descending (newest, busiest first).
+SORT_DESC_FIRST = {'id', 'interactions', 'last_contact'}
+# Summary sorts break ties on s.customer_id so the whole ORDER BY matches the
+# summary index; SQLite does not carry c.id = s.customer_id into the sort.
+# They also inner-join the summary so SQLite can walk that index: a LEFT JOIN
+# forces a full sort. Every other listing LEFT JOINs it, so a customer missing
+# its summary row still shows up, with 0 notes.
+SORT_TIEBREAK = {'interactions': 's.customer_id', 'last_contact': 's.customer_id'}
+
+def encode_cursor(key, row_id):
+    return base64.urlsafe_b64encode(json.dumps([key, row_id]).encode()).decode().rstrip('=')
+
+def decode_cursor(token):
+    # Cursors come back from the client, so anything that is not a scalar
+    # sort key and an integer id is rejected before it reaches a query.
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        return None
+    if not isinstance(payload, list) or len(payload) != 2:
+        return None
+    key, row_id = payload
+    if not isinstance(key, (str, int, float, type(None))) or not isinstance(row_id, int) or isinstance(row_id, bool):
+        return None
+    return key, row_id
+
+SORT_HEADERS = [
+    ('id', 'ID'),
+    ('name', 'Name'),
+    ('account', 'Account'),
+    ('email', 'Email'),
+    ('phone', 'Phone'),
+    ('created_at', 'Created At'),
+    ('interactions', 'Notes'),
+    ('last_contact', 'Last Contact'),
+]
+
+def resolve_sort(search_query, sort, direction):
+    # A search with no explicit sort column is ordered by relevance (sort None).
+    if search_query and sort not in SORT_COLUMNS and fts_query(search_query):
+        return None, 'asc'
+    sort = sort if sort in SORT_COLUMNS else 'id'
+    if direction not in ('asc', 'desc'):
+        direction = 'desc' if sort in SORT_DESC_FIRST else 'asc'
+    return sort, direction
+
+def list_customers(cur, search_query='', sort=None, direction=None, after=None, limit=PAGE_SIZE):
+    match = fts_query(search_query) if search_query else ''
+    sort, direction = resolve_sort(search_query, sort, direction)
+    relevance = sort is None
+    sort_expr = 'customers_fts.rank' if relevance else SORT_COLUMNS[sort]
+    id_expr = SORT_TIEBREAK.get(sort, 'c.id')
+    columns = f'c.id, c.name, c.account, c.email, c.phone, c.created_at, {sort_expr}, coalesce(s.interaction_count, 0), s.last_interaction'
+    join = 'JOIN' if sort in SORT_TIEBREAK else 'LEFT JOIN'
+    where, params = [], []
+    if relevance:
+        sql = f'SELECT {columns} FROM customers_fts JOIN customers c ON c.id = customers_fts.rowid {join} customer_summary s ON s.customer_id = c.id'
+        where.append('customers_fts MATCH ?')
+        params.append(match)
+    else:
+        sql = f'SELECT {columns} FROM customers c {join} customer_summary s ON s.customer_id = c.id'
+        if match:
+            where.append('c.id IN (SELECT rowid FROM customers_fts WHERE customers_fts MATCH ?)')
+            params.append(match)
+        elif search_query:
+            # Nothing indexable in the query (e.g. only punctuation): fall back to a substring scan.
+            where.append('(c.name LIKE ? OR c.account LIKE ? OR c.email LIKE ? OR c.phone LIKE ?)')
+            params.extend([f'%{search_query}%'] * 4)
+    op, order = ('<', 'DESC') if direction == 'desc' else ('>', 'ASC')
+    if after is not None:
+        key, row_id = after
+        if sort_expr == 'c.id':
+            where.append(f'c.id {op} ?')
+            params.append(row_id)
+        else:
+            # The single-column bound lets SQLite seek the sort index; the row
+            # value comparison then breaks ties on id.
+            where.append(f'{sort_expr} {op}= ? AND ({sort_expr}, {id_expr}) {op} (?, ?)')
+            params.extend([key, key, row_id])
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += f' ORDER BY {sort_expr} {order}' if sort_expr == 'c.id' else f' ORDER BY {sort_expr} {order}, {id_expr} {order}'
+    sql += ' LIMIT ?'
+    params.append(limit + 1)
+    cur.execute(sql, params)
+    rows = cur.fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][6], rows[-1][0])
+    return rows, next_cursor
+
+# Model output is rendered in one pass over its lines with patterns compiled
+# once at import. Everything is HTML-escaped before any markup is added, so
+# the model cannot inject tags into the page. Supported: # headings, - * + and
+# 1. lists (nested by indentation), ``` fences, --- rules, **bold**, *italic*
+# and `code`; other lines become paragraphs with <br> between their lines.
+_MD_HEADING = re.compile(r'\s*(#{1,6})\s+(.*)')
+_MD_LIST_ITEM = re.compile(r'(\s*)(?:([-*+])|\d{1,9}[.)])\s+(.*)')
+_MD_RULE = re.compile(r'\s*([-*_])(?:\s*\1){2,}\s*')
+_MD_FENCE = re.compile(r'\s*```')
+_MD_INLINE = re.compile(r'`([^`\n]+)`|\*\*([^*\n]+)\*\*|\*([^*\s](?:[^*\n]*[^*\s])?)\*')
+
+def _md_inline(match):
+    code, strong, em = match.groups()
+    if code is not None:
+        return f'<code>{code}</code>'
+    if strong is not None:
+        return f'<strong>{strong}</strong>'
+    return f'<em>{em}</em>'
+
+def _md_spans(text):
+    if '*' not in text and '`' not in text:
+        return text
+    return _MD_INLINE.sub(_md_inline, text)
 
 def basic_markdown(text):
-    text = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', text)
-    text = re.sub(r'\*(.*?)\*', r'<em>\1</em>', text)
-    text = re.sub(r'^\s*#\s+(.*)$', r'<h1>\1</h1>', text, flags=re.M)
-    text = re.sub(r'^\s*##\s+(.*)$', r'<h2>\1</h2>', text, flags=re.M)
-    text = re.sub(r'^\s*###\s+(.*)$', r'<h3>\1</h3>', text, flags=re.M)
-    text = re.sub(r'^\s*-\s+(.*)$', r'<li>\1</li>', text, flags=re.M)
-    text = re.sub(r'(<li>.*</li>)', r'<ul>\1</ul>', text, flags=re.S)
-    text = text.replace('\n', '<br>')
-    return text
+    out = []
+    paragraph = []
+    lists = []  # open lists as (indent, tag), innermost last
+    code = None
 
-@app.route('/', methods=['GET', 'POST'])
-def home():
-    init_db()
-    api_key = get_api_key()
-    if not api_key:
-        if request.method == 'POST':
-            key = request.form.get('api_key')
-            if key:
-                set_api_key(key)
-                return redirect(url_for('home'))
-        return render_template_string('''
+    def close_paragraph():
+        if paragraph:
+            out.append(f"<p>{'<br>'.join(paragraph)}</p>")
+            paragraph.clear()
+
+    def close_lists(indent=-1):
+        while lists and lists[-1][0] > indent:
+            out.append(f'</li></{lists.pop()[1]}>')
+
+    for line in escape(text, quote=False).split('\n'):
+        if code is not None:
+            if _MD_FENCE.match(line):
+                out.append('<pre><code>' + '\n'.join(code) + '</code></pre>')
+                code = None
+            else:
+                code.append(line)
+            continue
+        if not line.strip():
+            close_paragraph()
+            continue
+        item = _MD_LIST_ITEM.match(line)
+        if item and not _MD_RULE.fullmatch(line):
+            close_paragraph()
+            indent, tag = len(item.group(1).expandtabs(4)), 'ul' if item.group(2) else 'ol'
+            if lists and indent > lists[-1][0]:
+                lists.append((indent, tag))
+                out.append(f'<{tag}>')
+            else:
+                close_lists(indent)
+                if lists and lists[-1][1] == tag:
+                    out.append('</li>')
+                else:
+                    close_lists(indent - 1)
+                    lists.append((indent, tag))
+                    out.append(f'<{tag}>')
+            out.append(f'<li>{_md_spans(item.group(3))}')
+            continue
+        if lists and line[:1].isspace():
+            # An indented line inside a list continues the current item.
+            out.append(f'<br>{_md_spans(line.strip())}')
+            continue
+        close_lists()
+        if _MD_FENCE.match(line):
+            close_paragraph()
+            code = []
+            continue
+        heading = _MD_HEADING.fullmatch(line)
+        if heading:
+            close_paragraph()
+            level = len(heading.group(1))
+            out.append(f'<h{level}>{_md_spans(heading.group(2).strip())}</h{level}>')
+        elif _MD_RULE.fullmatch(line):
+            close_paragraph()
+            out.append('<hr>')
+        else:
+            paragraph.append(_md_spans(line.strip()))
+    close_paragraph()
+    close_lists()
+    if code is not None:
+        out.append('<pre><code>' + '\n'.join(code) + '</code></pre>')
+    return ''.join(out)
+
+CUSTOMER_ROWS_TEMPLATE = '''
+                {% for cust in customers %}
+                <tr>
+                    <td>{{ cust[0] }}</td>
+                    <td>{{ cust[1] }}</td>
+                    <td>{{ cust[2] }}</td>
+                    <td>{{ cust[3] or '' }}</td>
+                    <td>{{ cust[4] or '' }}</td>
+                    <td>{{ cust[5] or '' }}</td>
+                    <td>{{ cust[7] }}</td>
+                    <td>{{ (cust[8] or '')[:10] }}</td>
+                    <td>
+                        <a href="/edit/{{ cust[0] }}" class="btn btn-warning btn-sm"><i class="bi bi-pencil"></i> Edit</a>
+                        <a href="/delete/{{ cust[0] }}" class="btn btn-danger btn-sm" onclick="return confirm('Are you sure?');"><i class="bi bi-trash"></i> Delete</a>
+                    </td>
+                    <td>
+                        <a href="/insight/{{ cust[0] }}" class="btn btn-info btn-sm"><i class="bi bi-lightbulb"></i> Generate</a>
+                    </td>
+                    <td>
+                        <a href="/interactions/{{ cust[0] }}" class="btn btn-primary btn-sm"><i class="bi bi-chat-dots"></i> View/Add</a>
+                    </td>
+                </tr>
+                {% endfor %}
+'''
+
+# Shared client for stream_completion(): reads the SSE frames off a fetch()
+# body (EventSource cannot POST) and paints them into target.
+STREAM_MARKDOWN_TEMPLATE = '''
+    <script>
+        async function streamMarkdown(url, options, target, hooks = {}) {
+            const response = await fetch(url, options);
+            if (!response.ok || !response.body) throw new Error('HTTP ' + response.status);
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '', html = '', tail = '';
+            function paint() {
+                target.innerHTML = html;
+                if (tail) {
+                    if (html) target.appendChild(document.createElement('br'));
+                    target.appendChild(document.createTextNode(tail));
+                }
+                if (hooks.onPaint) hooks.onPaint();
+            }
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                let end;
+                while ((end = buffer.indexOf('\\n\\n')) >= 0) {
+                    const frame = buffer.slice(0, end);
+                    buffer = buffer.slice(end + 2);
+                    let event = 'message', data = '';
+                    frame.split('\\n').forEach(line => {
+                        if (line.startsWith('event: ')) event = line.slice(7);
+                        else if (line.startsWith('data: ')) data += line.slice(6);
+                    });
+                    const payload = JSON.parse(data || '{}');
+                    if (event === 'error') throw new Error(payload.error);
+                    if (event === 'delta') {
+                        tail += payload.text;
+                    } else if (event === 'html') {
+                        html = payload.html;
+                        tail = payload.tail;
+                    } else if (event === 'done') {
+                        html = payload.html;
+                        tail = '';
+                        paint();
+                        if (hooks.onDone) hooks.onDone(payload);
+                        return payload;
+                    }
+                    paint();
+                }
+            }
+            throw new Error('Stream ended early');
+        }
+    </script>
+'''
+
+API_KEY_TEMPLATE = '''
 <!doctype html>
 <html lang="en">
 <head>
@@ -114,24 +1375,9 @@ def home():
     </div>
 </body>
 </html>
-        ''')
-
-    search_query = request.args.get('search', '')
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    sql = 'SELECT id, name, account, email, phone, created_at FROM customers'
-    params = ""
-    if search_query:
-        sql += ' WHERE name LIKE ? OR account LIKE ? OR email LIKE ? OR phone LIKE ?'
-        params = (f'%{search_query}%', f'%{search_query}%', f'%{search_query}%', f'%{search_query}%')
-    sql += ' ORDER BY id DESC'
-    cur.execute(sql, params)
-    customers = cur.fetchall()
-    cur.execute('SELECT user_message, ai_response, timestamp FROM chat_history ORDER BY timestamp DESC LIMIT 5')
-    chat_history = cur.fetchall()
-    conn.close()
+'''
 
-    return render_template_string('''
+HOME_TEMPLATE = '''
 <!doctype html>
 <html lang="en">
 <head>
@@ -143,7 +1389,7 @@ def home():
     <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/js/bootstrap.bundle.min.js"></script>
     <script src="https://cdnjs.cloudflare.com/ajax/libs/animejs/3.2.1/anime.min.js"></script>
     <style>
-        .table th { cursor: pointer; }
+        .table th a { display: block; }
         .container { perspective: 1000px; }
         .table tr, .btn { opacity: 0; transform: translateZ(-100px) rotateX(45deg); transition: transform 0.3s ease; }
         .table tr.visible, .btn.visible { opacity: 1; transform: translateZ(0) rotateX(0deg); }
@@ -157,6 +1403,7 @@ def home():
         .chat-message { margin: 5px 0; padding: 8px; border-radius: 5px; }
         .user-message { background-color: #007bff; color: white; margin-left: 20%; }
         .ai-message { background-color: #f1f1f1; margin-right: 20%; }
+        .ai-message > :last-child { margin-bottom: 0; }
         .chat-input { display: flex; padding: 10px; border-top: 1px solid #ddd; }
         .chat-input input { flex-grow: 1; border: none; padding: 5px; }
         .chat-input button { background-color: #007bff; color: white; border: none; padding: 5px 10px; border-radius: 5px; }
@@ -177,6 +1424,7 @@ def home():
                 </form>
             </div>
             <div class="col-md-4 text-end">
+                <a href="/duplicates" class="btn btn-warning"><i class="bi bi-people"></i> Duplicates</a>
                 <a href="/export" class="btn btn-info"><i class="bi bi-download"></i> Export CSV</a>
             </div>
         </div>
@@ -202,40 +1450,27 @@ def home():
         <table class="table table-striped table-hover" id="customerTable">
             <thead class="table-dark">
                 <tr>
-                    <th onclick="sortTable(0)">ID <i class="bi bi-sort-down"></i></th>
-                    <th onclick="sortTable(1)">Name <i class="bi bi-sort-down"></i></th>
-                    <th onclick="sortTable(2)">Account <i class="bi bi-sort-down"></i></th>
-                    <th onclick="sortTable(3)">Email <i class="bi bi-sort-down"></i></th>
-                    <th onclick="sortTable(4)">Phone <i class="bi bi-sort-down"></i></th>
-                    <th onclick="sortTable(5)">Created At <i class="bi bi-sort-down"></i></th>
+                    {% for col, label in sort_headers %}
+                    <th>
+                        <a href="{{ url_for('home', search=search_query or None, sort=col, dir='desc' if sort == col and direction == 'asc' else 'asc', per_page=per_page if per_page != page_size else None) }}" class="text-white text-decoration-none">
+                            {{ label }} <i class="bi {{ ('bi-sort-down' if direction == 'desc' else 'bi-sort-up') if sort == col else 'bi-arrow-down-up' }}"></i>
+                        </a>
+                    </th>
+                    {% endfor %}
                     <th>Actions</th>
                     <th>AI Insight</th>
                     <th>Interactions</th>
                 </tr>
             </thead>
             <tbody>
-                {% for cust in customers %}
-                <tr>
-                    <td>{{ cust[0] }}</td>
-                    <td>{{ cust[1] }}</td>
-                    <td>{{ cust[2] }}</td>
-                    <td>{{ cust[3] or '' }}</td>
-                    <td>{{ cust[4] or '' }}</td>
-                    <td>{{ cust[5] or '' }}</td>
-                    <td>
-                        <a href="/edit/{{ cust[0] }}" class="btn btn-warning btn-sm"><i class="bi bi-pencil"></i> Edit</a>
-                        <a href="/delete/{{ cust[0] }}" class="btn btn-danger btn-sm" onclick="return confirm('Are you sure?');"><i class="bi bi-trash"></i> Delete</a>
-                    </td>
-                    <td>
-                        <a href="/insight/{{ cust[0] }}" class="btn btn-info btn-sm"><i class="bi bi-lightbulb"></i> Generate</a>
-                    </td>
-                    <td>
-                        <a href="/interactions/{{ cust[0] }}" class="btn btn-primary btn-sm"><i class="bi bi-chat-dots"></i> View/Add</a>
-                    </td>
-                </tr>
-                {% endfor %}
+                {% include 'customer_rows.html' %}
             </tbody>
         </table>
+        {% if next_url %}
+        <div class="text-center mb-4">
+            <a href="{{ next_url }}" id="loadMore" class="btn btn-outline-primary"><i class="bi bi-arrow-down-circle"></i> Load more</a>
+        </div>
+        {% endif %}
         {% if not customers %}
         <p class="text-muted">No customers found. Add one above!</p>
         {% endif %}
@@ -245,108 +1480,171 @@ def home():
             <i class="bi bi-chat-fill"></i>
         </div>
         <div class="chat-window" id="chatWindow">
-            <div class="chat-header">AI Assistant</div>
-            <div class="chat-body" id="chatBody">
-                {% for msg in chat_history %}
-                <div class="chat-message user-message">{{ msg[0] }}</div>
-                <div class="chat-message ai-message">{{ msg[1] | safe }}</div>
-                {% endfor %}
+            <div class="chat-header d-flex justify-content-between align-items-center">
+                AI Assistant
+                <i class="bi bi-plus-square" role="button" title="New conversation" onclick="newChatSession()"></i>
             </div>
+            <div class="chat-body" id="chatBody"></div>
             <div class="chat-input">
                 <input type="text" id="chatInput" placeholder="Ask about customers or anything...">
                 <button onclick="sendMessage()">Send</button>
             </div>
         </div>
     </div>
+    {% include 'stream_markdown.html' %}
     <script>
-        function sortTable(n) {
-            var table = document.getElementById("customerTable");
-            var rows, switching = true, dir = "asc", switchcount = 0;
-            while (switching) {
-                switching = false;
-                rows = table.rows;
-                for (var i = 1; i < (rows.length - 1); i++) {
-                    var shouldSwitch = false;
-                    var x = rows[i].getElementsByTagName("TD")[n];
-                    var y = rows[i + 1].getElementsByTagName("TD")[n];
-                    if (dir == "asc") {
-                        if (x.innerHTML.toLowerCase() > y.innerHTML.toLowerCase()) {
-                            shouldSwitch = true;
-                            break;
-                        }
-                    } else if (dir == "desc") {
-                        if (x.innerHTML.toLowerCase() < y.innerHTML.toLowerCase()) {
-                            shouldSwitch = true;
-                            break;
-                        }
-                    }
-                }
-                if (shouldSwitch) {
-                    rows[i].parentNode.insertBefore(rows[i + 1], rows[i]);
-                    switching = true;
-                    switchcount++;
-                } else {
-                    if (switchcount == 0 && dir == "asc") {
-                        dir = "desc";
-                        switching = true;
-                    }
-                }
-            }
-        }
-
         // Anime.js scroll-triggered animations
         document.addEventListener('DOMContentLoaded', function() {
-            const rows = document.querySelectorAll('#customerTable tbody tr');
-            const buttons = document.querySelectorAll('.btn');
+            // Only elements that have not been revealed yet are tracked, and the
+            // scroll handler runs at most once per animation frame.
+            let pending = [];
+            function trackPending() {
+                pending = Array.from(document.querySelectorAll('#customerTable tbody tr:not(.visible), .btn:not(.visible)'));
+            }
 
             function checkVisibility() {
-                rows.forEach((row, index) => {
-                    const rect = row.getBoundingClientRect();
-                    if (rect.top < window.innerHeight && rect.bottom >= 0) {
+                let rowDelay = 0, buttonDelay = 0;
+                pending = pending.filter(el => {
+                    const rect = el.getBoundingClientRect();
+                    if (rect.top >= window.innerHeight || rect.bottom < 0) return true;
+                    if (el.tagName === 'TR') {
                         anime({
-                            targets: row,
+                            targets: el,
                             translateZ: [100, 0],
                             rotateX: [45, 0],
                             opacity: [0, 1],
                             duration: 1000,
-                            delay: index * 100,
+                            delay: rowDelay++ * 100,
                             easing: 'easeOutCubic'
                         });
-                        row.classList.add('visible');
-                    }
-                });
-
-                buttons.forEach((button, index) => {
-                    const rect = button.getBoundingClientRect();
-                    if (rect.top < window.innerHeight && rect.bottom >= 0 && !button.classList.contains('visible')) {
+                    } else {
                         anime({
-                            targets: button,
+                            targets: el,
                             translateZ: [50, 0],
                             rotateY: [30, 0],
                             opacity: [0, 1],
                             duration: 800,
-                            delay: index * 50,
+                            delay: buttonDelay++ * 50,
                             easing: 'easeOutQuad'
                         });
-                        button.classList.add('visible');
                     }
+                    el.classList.add('visible');
+                    return false;
                 });
             }
 
-            window.addEventListener('scroll', checkVisibility);
+            let scheduled = false;
+            window.addEventListener('scroll', function() {
+                if (scheduled) return;
+                scheduled = true;
+                requestAnimationFrame(function() {
+                    scheduled = false;
+                    checkVisibility();
+                });
+            }, { passive: true });
+            trackPending();
             checkVisibility();
+
+            // Keyset scrolling: fetch the next page of rows when the "Load more" link comes into view.
+            const loadMore = document.getElementById('loadMore');
+            if (loadMore && 'IntersectionObserver' in window) {
+                let loading = false;
+                const observer = new IntersectionObserver(async function(entries) {
+                    if (!entries[0].isIntersecting || loading) return;
+                    loading = true;
+                    const url = new URL(loadMore.href);
+                    url.searchParams.set('format', 'json');
+                    try {
+                        const data = await (await fetch(url)).json();
+                        document.querySelector('#customerTable tbody').insertAdjacentHTML('beforeend', data.html);
+                        if (data.next) {
+                            loadMore.href = data.next;
+                        } else {
+                            observer.disconnect();
+                            loadMore.parentNode.remove();
+                        }
+                        trackPending();
+                        checkVisibility();
+                    } finally {
+                        loading = false;
+                    }
+                });
+                observer.observe(loadMore);
+            }
+        });
+
+        // Chatbot functionality. History is fetched when the window is first
+        // opened, and older pages load as the user scrolls to the top.
+        let historyUrl = {{ url_for('chat_history') | tojson }};
+        let historyLoading = false;
+
+        function chatBubbles(userText, aiHtml) {
+            const userBubble = document.createElement('div');
+            userBubble.className = 'chat-message user-message';
+            userBubble.textContent = userText;
+            const aiBubble = document.createElement('div');
+            aiBubble.className = 'chat-message ai-message';
+            aiBubble.innerHTML = aiHtml;
+            return [userBubble, aiBubble];
+        }
+
+        async function loadChatHistory() {
+            if (!historyUrl || historyLoading) return;
+            historyLoading = true;
+            const chatBody = document.getElementById('chatBody');
+            try {
+                const response = await fetch(historyUrl);
+                const data = await response.json();
+                const fromBottom = chatBody.scrollHeight - chatBody.scrollTop;
+                for (const msg of data.messages) {
+                    chatBody.prepend(...chatBubbles(msg.user_message, msg.ai_response));
+                }
+                chatBody.scrollTop = chatBody.scrollHeight - fromBottom;
+                historyUrl = data.next;
+            } finally {
+                historyLoading = false;
+            }
+        }
+
+        document.getElementById('chatBody').addEventListener('scroll', function() {
+            if (this.scrollTop < 40) loadChatHistory();
         });
 
-        // Chatbot functionality
         function toggleChat() {
             const chatWindow = document.getElementById('chatWindow');
             chatWindow.style.display = chatWindow.style.display === 'block' ? 'none' : 'block';
             if (chatWindow.style.display === 'block') {
                 document.getElementById('chatInput').focus();
-                scrollChatToBottom();
+                if (!chatWindow.dataset.loaded) {
+                    chatWindow.dataset.loaded = '1';
+                    loadChatHistory().then(scrollChatToBottom);
+                } else {
+                    scrollChatToBottom();
+                }
             }
         }
 
+        // The conversation id is kept across page loads so follow-up questions
+        // keep their context; "New conversation" starts a fresh session.
+        async function chatSessionId() {
+            let sessionId = localStorage.getItem('chatSession');
+            if (!sessionId) {
+                const response = await fetch({{ url_for('create_chat_session') | tojson }}, { method: 'POST' });
+                sessionId = (await response.json()).session_id;
+                localStorage.setItem('chatSession', sessionId);
+            }
+            return sessionId;
+        }
+
+        function newChatSession() {
+            localStorage.removeItem('chatSession');
+            const divider = document.createElement('div');
+            divider.className = 'text-center text-muted small my-2';
+            divider.textContent = 'New conversation';
+            document.getElementById('chatBody').append(divider);
+            scrollChatToBottom();
+        }
+
         function scrollChatToBottom() {
             const chatBody = document.getElementById('chatBody');
             chatBody.scrollTop = chatBody.scrollHeight;
@@ -358,21 +1656,19 @@ def home():
             if (!message) return;
 
             const chatBody = document.getElementById('chatBody');
-            chatBody.innerHTML += `<div class="chat-message user-message">${message}</div>`;
+            const [userBubble, aiBubble] = chatBubbles(message, '');
+            chatBody.append(userBubble, aiBubble);
             input.value = '';
             scrollChatToBottom();
 
             try {
-                const response = await fetch('/chat', {
+                await streamMarkdown('/chat/stream', {
                     method: 'POST',
                     headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ message: message })
-                });
-                const data = await response.json();
-                chatBody.innerHTML += `<div class="chat-message ai-message">${data.response}</div>`;
-                scrollChatToBottom();
+                    body: JSON.stringify({ message: message, session_id: await chatSessionId() })
+                }, aiBubble, { onPaint: scrollChatToBottom });
             } catch (error) {
-                chatBody.innerHTML += `<div class="chat-message ai-message">Error: ${error.message}</div>`;
+                aiBubble.textContent = 'Error: ' + error.message;
                 scrollChatToBottom();
             }
         }
@@ -383,7 +1679,306 @@ def home():
     </script>
 </body>
 </html>
-    ''', customers=customers, search_query=search_query, chat_history=chat_history)
+    '''
+
+@app.route('/', methods=['GET', 'POST'])
+def home():
+    api_key = get_api_key()
+    if not api_key:
+        if request.method == 'POST':
+            key = request.form.get('api_key')
+            if key:
+                set_api_key(key)
+                return redirect(url_for('home'))
+        return render_template('api_key.html')
+
+    search_query = request.args.get('search', '')
+    sort, direction = resolve_sort(search_query, request.args.get('sort'), request.args.get('dir'))
+    per_page = min(max(request.args.get('per_page', PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    cursor_token = request.args.get('after')
+    after = decode_cursor(cursor_token) if cursor_token else None
+    conn = get_db()
+    cur = conn.cursor()
+    customers, next_cursor = list_customers(cur, search_query, sort, direction, after, per_page)
+    next_url = None
+    if next_cursor:
+        next_url = url_for('home', search=search_query or None, sort=sort, dir=direction if sort else None,
+                           per_page=per_page if per_page != PAGE_SIZE else None, after=next_cursor)
+    if request.args.get('format') == 'json':
+        return {"html": render_template('customer_rows.html', customers=customers), "next": next_url}
+    return render_template('home.html', customers=customers, next_url=next_url, search_query=search_query,
+                           sort_headers=SORT_HEADERS, sort=sort, direction=direction, per_page=per_page, page_size=PAGE_SIZE)
+
+# /chat sends the model only the customers relevant to the message, found
+# through the search index, plus their latest interactions, and stops adding
+# context once CHAT_CONTEXT_TOKENS (estimated at ~4 characters per token) is
+# spent. Whatever budget is left goes to the most recent interactions overall.
+CHAT_CONTEXT_TOKENS = 1500
+CHAT_CONTEXT_CUSTOMERS = 10
+CHAT_CONTEXT_NOTES_PER_CUSTOMER = 3
+CHAT_CONTEXT_RECENT_NOTES = 10
+_CHAT_ID_MENTION = re.compile(r'(?:#|\bid\s*:?\s*|\bcustomer\s+)(\d+)\b', re.I)
+_CHAT_STOPWORDS = frozenset('''
+    a about all an and any are as at be by can could details do does for from get give has have how i in info is it
+    me my of on or our please show tell that the their them there this to us was we what when where which who why
+    with you your customer customers client clients account accounts email emails phone phones contact contacts
+    interaction interactions note notes recent last latest'''.split())
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+def customer_context(cur, customer):
+    lines = [f"ID: {customer[0]}, Name: {customer[1]}, Account: {customer[2]}, Email: {customer[3] or 'N/A'}, Phone: {customer[4] or 'N/A'}",
+             f"  Activity: {customer_activity(cur, customer[0])}"]
+    cur.execute('SELECT date, note FROM interactions WHERE customer_id = ? ORDER BY date DESC LIMIT ?',
+                (customer[0], CHAT_CONTEXT_NOTES_PER_CUSTOMER))
+    lines.extend(f"  - Date: {i[0]}, Note: {i[1]}" for i in cur.fetchall())
+    return '\n'.join(lines)
+
+def retrieve_chat_context(cur, message, budget=CHAT_CONTEXT_TOKENS, recent_notes=True, exclude=()):
+    customers = []
+    ids = [int(n) for n in _CHAT_ID_MENTION.findall(message)][:CHAT_CONTEXT_CUSTOMERS]
+    if ids:
+        cur.execute(f'SELECT id, name, account, email, phone FROM customers WHERE id IN ({", ".join("?" * len(ids))})', ids)
+        customers.extend(cur.fetchall())
+    skip = _CHAT_STOPWORDS.union(str(i) for i in ids)
+    terms = [t for t in _SEARCH_TOKEN.findall(message.lower()) if len(t) > 1 and t not in skip]
+    if terms and len(customers) < CHAT_CONTEXT_CUSTOMERS:
+        cur.execute('''SELECT c.id, c.name, c.account, c.email, c.phone
+                       FROM customers_fts JOIN customers c ON c.id = customers_fts.rowid
+                       WHERE customers_fts MATCH ? ORDER BY customers_fts.rank LIMIT ?''',
+                    (' OR '.join(f'"{t}"*' for t in terms), CHAT_CONTEXT_CUSTOMERS))
+        seen = {c[0] for c in customers}
+        customers.extend(c for c in cur.fetchall() if c[0] not in seen)
+
+    customer_lines = []
+    for c in [c for c in customers if c[0] not in exclude][:CHAT_CONTEXT_CUSTOMERS]:
+        block = customer_context(cur, c)
+        if estimate_tokens(block) > budget:
+            break
+        budget -= estimate_tokens(block)
+        customer_lines.append(block)
+    # No total count here: it would scan the whole table on every chat.
+    customer_lines.append(f"({len(customer_lines)} customers shown; others in the CRM were not relevant to the query.)")
+
+    interaction_lines = []
+    cur.execute('SELECT customer_id, date, note FROM interactions ORDER BY date DESC LIMIT ?', (CHAT_CONTEXT_RECENT_NOTES if recent_notes else 0,))
+    for i in cur.fetchall():
+        line = f"Customer ID: {i[0]}, Date: {i[1]}, Note: {i[2]}"
+        if estimate_tokens(line) > budget:
+            break
+        budget -= estimate_tokens(line)
+        interaction_lines.append(line)
+    return '\n'.join(customer_lines), '\n'.join(interaction_lines)
+
+# A chat session keeps a conversation going across /chat calls. Each turn
+# sends the model the session's rolling summary, the latest turns verbatim
+# (up to CHAT_SESSION_HISTORY_TOKENS) and only the customer data retrieved for
+# the new message, on a smaller budget than a standalone prompt; the global
+# recent-interactions block goes out on the first turn only. Once the
+# unsummarized turns outgrow the budget, all but the last
+# CHAT_SESSION_KEEP_TURNS are folded into the summary by a background job.
+CHAT_SESSION_CONTEXT_TOKENS = 600
+CHAT_SESSION_HISTORY_TOKENS = 1000
+CHAT_SESSION_KEEP_TURNS = 4
+_CHAT_SESSION_ID = re.compile(r'^[0-9a-f]{32}$')
+
+def open_chat_session(cur, session_id=None, customer_id=None):
+    # Unknown but well-formed ids (e.g. a session pruned by retention) start
+    # over under the same id, so a client can keep the id it has stored.
+    if session_id is not None and not isinstance(session_id, str):
+        return None
+    if session_id and not _CHAT_SESSION_ID.match(session_id):
+        return None
+    session_id = session_id or uuid.uuid4().hex
+    now = datetime.now().isoformat()
+    conn = get_db()
+    with conn:
+        conn.execute('INSERT OR IGNORE INTO chat_sessions (id, customer_id, created_at, updated_at) VALUES (?, ?, ?, ?)',
+                     (session_id, customer_id, now, now))
+    cur.execute('SELECT id, customer_id, summary, summarized_through FROM chat_sessions WHERE id = ?', (session_id,))
+    return dict(zip(('id', 'customer_id', 'summary', 'summarized_through'), cur.fetchone()))
+
+def chat_session_turns(cur, session):
+    cur.execute('SELECT id, user_message, coalesce(ai_text, ai_response) FROM chat_history WHERE session_id = ? AND id > ? ORDER BY id',
+                (session['id'], session['summarized_through']))
+    return cur.fetchall()
+
+def format_turn(turn):
+    return f"User: {turn[1]}\nAssistant: {turn[2]}"
+
+def session_chat_prompt(cur, session, user_message):
+    turns = chat_session_turns(cur, session)
+    recent, budget = [], CHAT_SESSION_HISTORY_TOKENS
+    for turn in reversed(turns):
+        block = format_turn(turn)
+        if recent and estimate_tokens(block) > budget:
+            break
+        budget -= estimate_tokens(block)
+        recent.insert(0, block)
+    sections = ["You are an AI assistant for a Customer Relationship Manager, in an ongoing conversation with the user."]
+    pinned = ()
+    if session['customer_id']:
+        cur.execute('SELECT id, name, account, email, phone FROM customers WHERE id = ?', (session['customer_id'],))
+        customer = cur.fetchone()
+        if customer:
+            pinned = (customer[0],)
+            sections.append(f"This conversation is about this customer:\n{customer_context(cur, customer)}")
+    if session['summary']:
+        sections.append(f"Summary of the earlier conversation:\n{session['summary']}")
+    if recent:
+        sections.append("Latest turns:\n" + '\n'.join(recent))
+    has_history = bool(turns or session['summary'])
+    customer_data, interaction_data = retrieve_chat_context(cur, user_message, CHAT_SESSION_CONTEXT_TOKENS,
+                                                            recent_notes=not has_history, exclude=pinned)
+    sections.append(f"Customer data relevant to the new message:\n{customer_data or 'None beyond the conversation above.'}")
+    if interaction_data:
+        sections.append(f"Recent interactions:\n{interaction_data}")
+    sections.append(f"""The user now says: '{user_message}'
+Provide a concise, professional response in Markdown format. Use the conversation so far to resolve references such as "they" or "that account". If the query is about a specific customer, use their data. For general queries, provide helpful information related to CRM or the app's features.""")
+    return '\n\n'.join(sections)
+
+def chat_summary_prompt(summary, turns):
+    return f"""Update the running summary of a conversation between a CRM user and an AI assistant.
+Keep customer names and IDs, facts learned about them, decisions, and open questions. Drop pleasantries. Answer with the summary only, under 150 words.
+Current summary:
+{summary or 'None yet.'}
+New turns:
+{chr(10).join(format_turn(t) for t in turns)}"""
+
+def summarize_chat_session(cur, session_id):
+    cur.execute('SELECT id, customer_id, summary, summarized_through FROM chat_sessions WHERE id = ?', (session_id,))
+    row = cur.fetchone()
+    if not row:
+        return
+    session = dict(zip(('id', 'customer_id', 'summary', 'summarized_through'), row))
+    turns = chat_session_turns(cur, session)
+    if len(turns) <= CHAT_SESSION_KEEP_TURNS or sum(estimate_tokens(format_turn(t)) for t in turns) <= CHAT_SESSION_HISTORY_TOKENS:
+        return
+    if find_active_job('chat_summary', None, session_id):
+        return
+    fold = turns[:-CHAT_SESSION_KEEP_TURNS]
+    payload = json.dumps({'session_id': session_id, 'from': session['summarized_through'], 'through': fold[-1][0]})
+    try:
+        submit_job('chat_summary', chat_summary_prompt(session['summary'], fold), payload=payload, fingerprint=session_id)
+    except JobQueueFull:
+        pass  # The next turn tries again.
+
+def store_chat_summary(payload, summary):
+    fold = json.loads(payload)
+    conn = get_db()
+    with conn:
+        # Only applies on top of the summary the job was built from.
+        conn.execute('UPDATE chat_sessions SET summary = ?, summarized_through = ?, updated_at = ? WHERE id = ? AND summarized_through = ?',
+                     (summary, fold['through'], datetime.now().isoformat(), fold['session_id'], fold['from']))
+
+def insert_chat(cur, user_message, response_html, session_id, response_text):
+    now = datetime.now().isoformat()
+    cur.execute('INSERT INTO chat_history (user_message, ai_response, timestamp, session_id, ai_text) VALUES (?, ?, ?, ?, ?)',
+                (user_message, response_html, now, session_id, response_text))
+    if session_id:
+        cur.execute('UPDATE chat_sessions SET updated_at = ? WHERE id = ?', (now, session_id))
+    return cur.lastrowid
+
+def save_chat(user_message, response_html, session_id=None, response_text=None):
+    queued_write(insert_chat, user_message, response_html, session_id, response_text)
+    if session_id:
+        summarize_chat_session(get_db().cursor(), session_id)
+    schedule_chat_retention()
+
+# Chat history is read newest first in keyset pages over the timestamp index,
+# so the widget can load older messages on demand. Rows older than
+# CHAT_RETENTION_DAYS are moved to a gzipped JSONL file in CHAT_ARCHIVE_DIR
+# (set CHAT_ARCHIVE_DIR to None to just delete them); each process runs the
+# retention pass in the background at most once per CHAT_RETENTION_INTERVAL.
+# CRM_CHAT_RETENTION_DAYS=0 turns the automatic pass off.
+CHAT_HISTORY_PAGE_SIZE = 20
+CHAT_HISTORY_MAX_PAGE_SIZE = 100
+CHAT_RETENTION_DAYS = int(os.environ.get('CRM_CHAT_RETENTION_DAYS', 90))
+CHAT_RETENTION_INTERVAL = 3600
+CHAT_ARCHIVE_DIR = 'chat_archive'
+CHAT_ARCHIVE_BATCH_ROWS = 5000
+_chat_retention_due = 0.0
+
+def list_chat_history(cur, before=None, limit=CHAT_HISTORY_PAGE_SIZE):
+    sql, params = 'SELECT id, user_message, ai_response, timestamp FROM chat_history', []
+    if before is not None:
+        key, row_id = before
+        sql += ' WHERE timestamp <= ? AND (timestamp, id) < (?, ?)'
+        params.extend([key, key, row_id])
+    sql += ' ORDER BY timestamp DESC, id DESC LIMIT ?'
+    params.append(limit + 1)
+    rows = cur.execute(sql, params).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][3], rows[-1][0])
+    return rows, next_cursor
+
+def archive_chat_history(days=CHAT_RETENTION_DAYS, archive_dir=CHAT_ARCHIVE_DIR):
+    cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+    conn = sqlite3.connect(DB, timeout=30, isolation_level=None)
+    archive, path, moved = None, None, 0
+    try:
+        while True:
+            # One batch per write transaction: a second process running the
+            # same pass waits here and then finds the rows already gone.
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute('SELECT id, user_message, ai_response, timestamp, session_id, ai_text FROM chat_history WHERE timestamp < ? ORDER BY timestamp, id LIMIT ?',
+                                (cutoff, CHAT_ARCHIVE_BATCH_ROWS)).fetchall()
+            if not rows:
+                conn.execute('DELETE FROM chat_sessions WHERE updated_at < ?', (cutoff,))
+                conn.execute('COMMIT')
+                break
+            if archive_dir:
+                if archive is None:
+                    os.makedirs(archive_dir, exist_ok=True)
+                    path = os.path.join(archive_dir, f"chat-history-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.jsonl.gz")
+                    archive = gzip.open(path, 'wt', encoding='utf-8')
+                for row in rows:
+                    archive.write(json.dumps(dict(zip(('id', 'user_message', 'ai_response', 'timestamp', 'session_id', 'ai_text'), row))) + '\n')
+                archive.flush()
+            conn.executemany('DELETE FROM chat_history WHERE id = ?', ((row[0],) for row in rows))
+            conn.execute('COMMIT')
+            moved += len(rows)
+    finally:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        conn.close()
+        if archive is not None:
+            archive.close()
+    return moved, path
+
+def schedule_chat_retention():
+    global _chat_retention_due
+    if not CHAT_RETENTION_DAYS:
+        return
+    now = time.monotonic()
+    with _llm_lock:
+        if now < _chat_retention_due:
+            return
+        _chat_retention_due = now + CHAT_RETENTION_INTERVAL
+    threading.Thread(target=archive_chat_history, daemon=True).start()
+
+@app.route('/chat/history')
+def chat_history():
+    limit = min(max(request.args.get('limit', CHAT_HISTORY_PAGE_SIZE, type=int), 1), CHAT_HISTORY_MAX_PAGE_SIZE)
+    cursor_token = request.args.get('before')
+    before = decode_cursor(cursor_token) if cursor_token else None
+    if cursor_token and before is None:
+        return {"error": "Invalid cursor"}, 400
+    rows, next_cursor = list_chat_history(get_db().cursor(), before, limit)
+    messages = [{"id": r[0], "user_message": r[1], "ai_response": r[2], "timestamp": r[3]} for r in rows]
+    return {"messages": messages, "next": url_for('chat_history', before=next_cursor, limit=limit) if next_cursor else None}
+
+@app.cli.command('archive-chat-history')
+@click.option('--days', type=click.IntRange(0), default=CHAT_RETENTION_DAYS or 90, show_default=True, help='Keep messages newer than this.')
+@click.option('--no-archive', is_flag=True, help='Delete old messages without writing an archive file.')
+def archive_chat_history_command(days, no_archive):
+    """Move chat messages older than --days into a compressed archive."""
+    ensure_schema()
+    moved, path = archive_chat_history(days, None if no_archive else CHAT_ARCHIVE_DIR)
+    click.echo(f"Archived {moved} chat messages" + (f" to {path}" if path else ""))
 
 @app.route('/chat', methods=['POST'])
 def chat():
@@ -396,43 +1991,346 @@ def chat():
     if not user_message:
         return {"error": "No message provided"}, 400
 
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    cur.execute('SELECT id, name, account, email, phone FROM customers')
-    customers = cur.fetchall()
-    customer_data = '\n'.join([f"ID: {c[0]}, Name: {c[1]}, Account: {c[2]}, Email: {c[3] or 'N/A'}, Phone: {c[4] or 'N/A'}" for c in customers])
-    cur.execute('SELECT date, note FROM interactions ORDER BY date DESC LIMIT 10')
-    interactions = cur.fetchall()
-    interaction_data = '\n'.join([f"Date: {i[0]}, Note: {i[1]}" for i in interactions])
-    conn.close()
-
-    client = Groq(api_key=api_key)
-    prompt = f"""You are an AI assistant for a Customer Relationship Manager. Answer the user's query: '{user_message}'.
-Customer data:
-{customer_data or 'No customers available.'}
-Recent interactions:
-{interaction_data or 'No interactions available.'}
-Provide a concise, professional response in Markdown format. If the query is about a specific customer, use their data. For general queries, provide helpful information related to CRM or the app's features."""
+    cur = get_db().cursor()
+    session = open_chat_session(cur, data.get('session_id'))
+    if not session:
+        return {"error": "Invalid session_id"}, 400
+    prompt = session_chat_prompt(cur, session, user_message)
+    if data.get('async'):
+        try:
+            job_id = submit_job('chat', prompt, payload=json.dumps({'message': user_message, 'session_id': session['id']}))
+        except JobQueueFull as e:
+            return {"error": str(e)}, 503
+        return {"job_id": job_id, "status_url": url_for('job_status', job_id=job_id), "session_id": session['id']}, 202
     try:
-        completion = client.chat.completions.create(
-            model="llama3-70b-8192",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7,
-            max_tokens=500,
-        )
-        response = completion.choices[0].message.content.strip()
-        response_html = basic_markdown(response)
+        response_text = complete(api_key, prompt)
+        response_html = basic_markdown(response_text)
+        save_chat(user_message, response_html, session['id'], response_text)
+        return {"response": response_html, "session_id": session['id']}
+    except Exception as e:
+        return {"error": str(e)}, 500
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    api_key = get_api_key()
+    if not api_key:
+        return {"error": "API key not configured"}, 403
+
+    data = request.get_json()
+    user_message = data.get('message')
+    if not user_message:
+        return {"error": "No message provided"}, 400
+
+    cur = get_db().cursor()
+    session = open_chat_session(cur, data.get('session_id'))
+    if not session:
+        return {"error": "Invalid session_id"}, 400
+    prompt = session_chat_prompt(cur, session, user_message)
+    response = stream_completion(api_key, prompt, lambda text, html: save_chat(user_message, html, session['id'], text))
+    response.headers['X-Chat-Session'] = session['id']
+    return response
+
+@app.route('/chat/sessions', methods=['POST'])
+def create_chat_session():
+    data = request.get_json(silent=True) or {}
+    customer_id = data.get('customer_id')
+    if customer_id is not None and not isinstance(customer_id, int):
+        return {"error": "customer_id must be an integer"}, 400
+    cur = get_db().cursor()
+    if customer_id is not None and not cur.execute('SELECT 1 FROM customers WHERE id = ?', (customer_id,)).fetchone():
+        return {"error": "Customer not found"}, 404
+    session = open_chat_session(cur, customer_id=customer_id)
+    return {"session_id": session['id'], "customer_id": customer_id}, 201
+
+@app.route('/chat/sessions/<session_id>')
+def chat_session(session_id):
+    cur = get_db().cursor()
+    row = cur.execute('SELECT id, customer_id, summary, summarized_through, created_at, updated_at FROM chat_sessions WHERE id = ?',
+                      (session_id,)).fetchone()
+    if not row:
+        return {"error": "Session not found"}, 404
+    session = dict(zip(('id', 'customer_id', 'summary', 'summarized_through', 'created_at', 'updated_at'), row))
+    session['turns'] = [{"id": t[0], "user_message": t[1], "response": t[2]} for t in chat_session_turns(cur, session)]
+    return session
+
+# Writes shared by the form routes and the JSON API. They run on the caller's
+# cursor and leave committing to the caller, so a batch can group many of them
+# into one transaction.
+CUSTOMER_FIELDS = ('name', 'account', 'email', 'phone')
+
+def create_customer(cur, name, account, email=None, phone=None):
+    now = datetime.now().isoformat()
+    cur.execute('INSERT INTO customers (name, account, email, phone, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (name, account, email, phone, now, now))
+    customer_id = cur.lastrowid
+    index_customer_keys(cur, [customer_id])
+    record_duplicates(cur, [(customer_id, row[0], score) for score, row in find_duplicates(cur, customer_id)])
+    return customer_id
+
+def update_customer(cur, customer_id, fields):
+    # Only the given fields change; returns False if there is no such customer.
+    assignments = ', '.join(f'{name} = ?' for name in fields)
+    cur.execute(f'UPDATE customers SET {assignments}, updated_at = ? WHERE id = ?',
+                (*fields.values(), datetime.now().isoformat(), customer_id))
+    updated = cur.rowcount > 0
+    if updated and not fields.keys().isdisjoint(('name', 'email', 'phone')):
+        index_customer_keys(cur, [customer_id])
+    invalidate_insight(cur, customer_id)
+    return updated
+
+def delete_customer(cur, customer_id):
+    cur.execute('DELETE FROM customers WHERE id = ?', (customer_id,))
+    deleted = cur.rowcount > 0
+    cur.execute('DELETE FROM interactions WHERE customer_id = ?', (customer_id,))
+    invalidate_insight(cur, customer_id)
+    return deleted
+
+def add_interaction(cur, customer_id, note, date=None):
+    cur.execute('INSERT INTO interactions (customer_id, date, note) VALUES (?, ?, ?)',
+                (customer_id, date or datetime.now().isoformat(), note))
+    invalidate_insight(cur, customer_id)
+    return cur.lastrowid
+
+def remove_interaction(cur, interaction_id):
+    cur.execute('SELECT customer_id FROM interactions WHERE id = ?', (interaction_id,))
+    row = cur.fetchone()
+    if not row:
+        return False
+    cur.execute('DELETE FROM interactions WHERE id = ?', (interaction_id,))
+    invalidate_insight(cur, row[0])
+    return True
+
+# Duplicate customers are found by blocking: a customer is only compared with
+# the customers that share one of its keys (normalized email, phone digits,
+# surname Soundex plus first initial), so a scan is one pass over
+# customer_keys instead of a comparison of every pair. A key shared by more
+# than DEDUP_MAX_BLOCK customers (a switchboard number, a very common name)
+# says little and is skipped. Candidates are scored on the fields both records
+# have: names and accounts by Jaro-Winkler similarity, normalized emails and
+# phones by equality, weighted by DEDUP_WEIGHTS. create_customer()
+# checks each new customer; scan_duplicates() covers rows that arrived by
+# import or raw SQL, and both queue pairs in customer_duplicates for review.
+DEDUP_THRESHOLD = 0.85
+DEDUP_MAX_BLOCK = 50
+DEDUP_WEIGHTS = {'name': 0.35, 'email': 0.3, 'phone': 0.2, 'account': 0.15}
+DEDUP_EXACT_FIELDS = ('email', 'phone')
+DEDUP_PAGE_SIZE = 100
+DEDUP_INDEX_CHUNK = 5000
+DEDUP_MATCH_SQL = 'SELECT id, name, account, email, phone FROM customers WHERE id IN ({})'
+DEDUP_UPSERT_SQL = '''INSERT INTO customer_duplicates (customer_id, duplicate_id, score, found_at) VALUES (?, ?, ?, ?)
+                      ON CONFLICT (customer_id, duplicate_id) DO UPDATE SET score = excluded.score'''
+_NAME_TOKEN = re.compile(r'[a-z]+')
+_SOUNDEX = str.maketrans('bfpvcgjkqsxzdtlmnr', '111122222222334556')
+_GMAIL_DOMAINS = {'gmail.com', 'googlemail.com'}
+
+def fold_text(value):
+    return unicodedata.normalize('NFKD', value or '').encode('ascii', 'ignore').decode().lower()
+
+def normalize_email(email):
+    local, at, domain = (email or '').strip().lower().rpartition('@')
+    local = local.split('+', 1)[0]
+    if not at or not local or not domain:
+        return ''
+    if domain in _GMAIL_DOMAINS:
+        local, domain = local.replace('.', ''), 'gmail.com'
+    return f'{local}@{domain}'
+
+def phone_key(phone):
+    # The last ten digits, so numbers match with or without a country code.
+    digits = phone_digits(phone)
+    return digits[-10:] if len(digits) >= 7 else ''
+
+def name_tokens(name):
+    # "Smith, John" reads as "John Smith".
+    last, comma, first = fold_text(name).partition(',')
+    return _NAME_TOKEN.findall(f'{first} {last}' if comma else last)
+
+def soundex(word):
+    codes = word.translate(_SOUNDEX)
+    key, previous = word[0], codes[0]
+    for code in codes[1:]:
+        if code.isdigit():
+            if code != previous:
+                key += code
+            previous = code
+        elif code not in 'hw':
+            previous = ''
+    return (key + '000')[:4]
+
+def name_key(name):
+    tokens = name_tokens(name)
+    if len(tokens) < 2:
+        return soundex(tokens[0]) if tokens else ''
+    return f'{soundex(tokens[-1])} {tokens[0][0]}'
+
+def customer_keys_for(name, email, phone):
+    # The name key is kept even when empty so every indexed customer has a row.
+    keys = [('name', name_key(name))]
+    for kind, key in (('email', normalize_email(email)), ('phone', phone_key(phone))):
+        if key:
+            keys.append((kind, key))
+    return keys
+
+def index_customer_keys(cur, customer_ids=None):
+    # Recomputes the keys of the given customers, or of every customer that
+    # has none. Returns the number of customers indexed.
+    if customer_ids is None:
+        cur.execute('SELECT id, name, email, phone FROM customers c '
+                    'WHERE NOT EXISTS (SELECT 1 FROM customer_keys k WHERE k.customer_id = c.id)')
+    else:
+        placeholders = ','.join('?' * len(customer_ids))
+        cur.execute(f'DELETE FROM customer_keys WHERE customer_id IN ({placeholders})', customer_ids)
+        cur.execute(f'SELECT id, name, email, phone FROM customers WHERE id IN ({placeholders})', customer_ids)
+    writer = cur.connection.cursor()
+    indexed = 0
+    while rows := cur.fetchmany(DEDUP_INDEX_CHUNK):
+        writer.executemany('INSERT OR IGNORE INTO customer_keys (kind, key, customer_id) VALUES (?, ?, ?)',
+                           [(kind, key, row[0]) for row in rows for kind, key in customer_keys_for(*row[1:])])
+        indexed += len(rows)
+    return indexed
+
+def jaro_winkler(a, b):
+    if a == b:
+        return 1.0
+    if not a or not b:
+        return 0.0
+    window = max(max(len(a), len(b)) // 2 - 1, 0)
+    taken = [False] * len(b)
+    matches_a = []
+    for i, ch in enumerate(a):
+        end = i + window + 1
+        j = b.find(ch, max(0, i - window), end)
+        while j != -1 and taken[j]:
+            j = b.find(ch, j + 1, end)
+        if j != -1:
+            taken[j] = True
+            matches_a.append(ch)
+    if not matches_a:
+        return 0.0
+    matches_b = [ch for ch, hit in zip(b, taken) if hit]
+    m = len(matches_a)
+    transpositions = sum(x != y for x, y in zip(matches_a, matches_b)) / 2
+    jaro = (m / len(a) + m / len(b) + (m - transpositions) / m) / 3
+    prefix = 0
+    for x, y in zip(a[:4], b[:4]):
+        if x != y:
+            break
+        prefix += 1
+    return jaro + prefix * 0.1 * (1 - jaro)
+
+def match_fields(name, account, email, phone):
+    return {'name': ' '.join(sorted(name_tokens(name))), 'account': fold_text(account).strip(),
+            'email': normalize_email(email), 'phone': phone_key(phone)}
 
-        conn = sqlite3.connect(DB)
+def match_score(a, b, threshold=0.0):
+    # Exact fields are scored first; a pair that cannot reach threshold even
+    # with identical names and accounts scores 0 without running Jaro-Winkler.
+    total = weights = fuzzy_weights = 0.0
+    fuzzy = []
+    for field, weight in DEDUP_WEIGHTS.items():
+        if a[field] and b[field]:
+            weights += weight
+            if field in DEDUP_EXACT_FIELDS:
+                total += weight * (a[field] == b[field])
+            else:
+                fuzzy.append((field, weight))
+                fuzzy_weights += weight
+    if not weights or total + fuzzy_weights < threshold * weights:
+        return 0.0
+    for field, weight in fuzzy:
+        total += weight * jaro_winkler(a[field], b[field])
+    return total / weights
+
+def find_duplicates(cur, customer_id, threshold=DEDUP_THRESHOLD):
+    # Incremental check for one customer: returns [(score, row)] best first,
+    # leaving out pairs already dismissed.
+    cur.execute('SELECT name, account, email, phone FROM customers WHERE id = ?', (customer_id,))
+    customer = cur.fetchone()
+    if not customer:
+        return []
+    candidates = set()
+    for kind, key in customer_keys_for(customer[0], customer[2], customer[3]):
+        if key:
+            cur.execute('SELECT customer_id FROM customer_keys WHERE kind = ? AND key = ? LIMIT ?', (kind, key, DEDUP_MAX_BLOCK + 1))
+            block = [row[0] for row in cur.fetchall()]
+            if len(block) <= DEDUP_MAX_BLOCK:
+                candidates.update(block)
+    cur.execute("SELECT duplicate_id FROM customer_duplicates WHERE customer_id = ? AND status = 'dismissed' "
+                "UNION ALL SELECT customer_id FROM customer_duplicates WHERE duplicate_id = ? AND status = 'dismissed'",
+                (customer_id, customer_id))
+    candidates.difference_update(row[0] for row in cur.fetchall())
+    candidates.discard(customer_id)
+    if not candidates:
+        return []
+    fields = match_fields(*customer)
+    cur.execute(DEDUP_MATCH_SQL.format(','.join('?' * len(candidates))), list(candidates))
+    matches = [(match_score(fields, match_fields(*row[1:]), threshold), row) for row in cur.fetchall()]
+    return sorted((match for match in matches if match[0] >= threshold), key=lambda match: (-match[0], match[1][0]))
+
+def record_duplicates(cur, pairs):
+    now = datetime.now().isoformat()
+    cur.executemany(DEDUP_UPSERT_SQL, [(min(a, b), max(a, b), score, now) for a, b, score in pairs])
+
+def scan_duplicates(threshold=DEDUP_THRESHOLD, max_block=DEDUP_MAX_BLOCK, rebuild=False):
+    conn = get_db()
+    start = time.perf_counter()
+    with conn:
         cur = conn.cursor()
-        cur.execute('INSERT INTO chat_history (user_message, ai_response, timestamp) VALUES (?, ?, ?)',
-                    (user_message, response_html, datetime.now().isoformat()))
-        conn.commit()
-        conn.close()
+        if rebuild:
+            cur.execute('DELETE FROM customer_keys')
+        report = {'indexed': index_customer_keys(cur), 'blocks': 0, 'skipped_blocks': 0, 'compared': 0}
+    # Blocks come off the primary key in order, so grouping needs no sort.
+    blocks = conn.execute("SELECT group_concat(customer_id) FROM customer_keys WHERE key != '' "
+                          "GROUP BY kind, key HAVING count(*) > 1")
+    cur = conn.cursor()
+    compared = set()
+    pairs = []
+    for (ids,) in blocks:
+        ids = ids.split(',')
+        if len(ids) > max_block:
+            report['skipped_blocks'] += 1
+            continue
+        report['blocks'] += 1
+        cur.execute(DEDUP_MATCH_SQL.format(','.join('?' * len(ids))), ids)
+        rows = sorted(cur.fetchall())
+        fields = [match_fields(*row[1:]) for row in rows]
+        for i, a in enumerate(rows):
+            for j in range(i + 1, len(rows)):
+                pair = (a[0], rows[j][0])
+                if pair in compared:
+                    continue
+                compared.add(pair)
+                score = match_score(fields[i], fields[j], threshold)
+                if score >= threshold:
+                    pairs.append((*pair, score))
+    with conn:
+        record_duplicates(conn.cursor(), pairs)
+    report['compared'] = len(compared)
+    report['found'] = len(pairs)
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    return report
 
-        return {"response": response_html}
-    except Exception as e:
-        return {"error": str(e)}, 500
+def merge_customers(cur, survivor_id, duplicate_id):
+    # Moves the duplicate's interactions and chat sessions onto the survivor,
+    # fills in the survivor's missing email and phone from it, and deletes it.
+    # Returns the number of interactions moved, or None if either is missing.
+    if survivor_id == duplicate_id:
+        return None
+    cur.execute('SELECT id, email, phone FROM customers WHERE id IN (?, ?)', (survivor_id, duplicate_id))
+    rows = {row[0]: row for row in cur.fetchall()}
+    if len(rows) < 2:
+        return None
+    survivor, duplicate = rows[survivor_id], rows[duplicate_id]
+    cur.execute('UPDATE interactions SET customer_id = ? WHERE customer_id = ?', (survivor_id, duplicate_id))
+    moved = cur.rowcount
+    cur.execute('UPDATE chat_sessions SET customer_id = ? WHERE customer_id = ?', (survivor_id, duplicate_id))
+    fields = {field: duplicate[i] for i, field in ((1, 'email'), (2, 'phone')) if duplicate[i] and not survivor[i]}
+    if fields:
+        update_customer(cur, survivor_id, fields)
+    else:
+        invalidate_insight(cur, survivor_id)
+    delete_customer(cur, duplicate_id)
+    return moved
 
 @app.route('/add', methods=['POST'])
 def add():
@@ -440,48 +2338,24 @@ def add():
     account = request.form.get('account')
     email = request.form.get('email')
     phone = request.form.get('phone')
-    now = datetime.now().isoformat()
     if name and account:
-        conn = sqlite3.connect(DB)
+        conn = get_db()
         cur = conn.cursor()
-        cur.execute('INSERT INTO customers (name, account, email, phone, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
-                    (name, account, email, phone, now, now))
+        customer_id = create_customer(cur, name, account, email, phone)
         conn.commit()
-        conn.close()
+        cur.execute('SELECT 1 FROM customer_duplicates WHERE duplicate_id = ? LIMIT 1', (customer_id,))
+        if cur.fetchone():
+            return redirect(url_for('customer_duplicates', customer_id=customer_id))
     return redirect(url_for('home'))
 
 @app.route('/delete/<int:customer_id>')
 def delete(customer_id):
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    cur.execute('DELETE FROM customers WHERE id = ?', (customer_id,))
-    cur.execute('DELETE FROM interactions WHERE customer_id = ?', (customer_id,))
+    conn = get_db()
+    delete_customer(conn.cursor(), customer_id)
     conn.commit()
-    conn.close()
     return redirect(url_for('home'))
 
-@app.route('/edit/<int:customer_id>', methods=['GET', 'POST'])
-def edit(customer_id):
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    if request.method == 'POST':
-        name = request.form.get('name')
-        account = request.form.get('account')
-        email = request.form.get('email')
-        phone = request.form.get('phone')
-        now = datetime.now().isoformat()
-        if name and account:
-            cur.execute('UPDATE customers SET name = ?, account = ?, email = ?, phone = ?, updated_at = ? WHERE id = ?',
-                        (name, account, email, phone, now, customer_id))
-            conn.commit()
-            conn.close()
-            return redirect(url_for('home'))
-    cur.execute('SELECT name, account, email, phone FROM customers WHERE id = ?', (customer_id,))
-    customer = cur.fetchone()
-    conn.close()
-    if not customer:
-        return "Customer not found", 404
-    return render_template_string('''
+EDIT_TEMPLATE = '''
 <!doctype html>
 <html lang="en">
 <head>
@@ -516,27 +2390,157 @@ def edit(customer_id):
     </div>
 </body>
 </html>
-    ''', name=customer[0], account=customer[1], email=customer[2] or '', phone=customer[3] or '')
+    '''
 
-@app.route('/interactions/<int:customer_id>', methods=['GET', 'POST'])
-def interactions(customer_id):
-    conn = sqlite3.connect(DB)
+@app.route('/edit/<int:customer_id>', methods=['GET', 'POST'])
+def edit(customer_id):
+    conn = get_db()
     cur = conn.cursor()
-    cur.execute('SELECT name FROM customers WHERE id = ?', (customer_id,))
+    if request.method == 'POST':
+        name = request.form.get('name')
+        account = request.form.get('account')
+        email = request.form.get('email')
+        phone = request.form.get('phone')
+        if name and account:
+            update_customer(cur, customer_id, {'name': name, 'account': account, 'email': email, 'phone': phone})
+            conn.commit()
+            return redirect(url_for('home'))
+    cur.execute('SELECT name, account, email, phone FROM customers WHERE id = ?', (customer_id,))
     customer = cur.fetchone()
     if not customer:
-        conn.close()
         return "Customer not found", 404
-    if request.method == 'POST':
-        note = request.form.get('note')
-        if note:
-            now = datetime.now().isoformat()
-            cur.execute('INSERT INTO interactions (customer_id, date, note) VALUES (?, ?, ?)', (customer_id, now, note))
-            conn.commit()
-    cur.execute('SELECT id, date, note FROM interactions WHERE customer_id = ? ORDER BY date DESC', (customer_id,))
-    inters = cur.fetchall()
-    conn.close()
-    return render_template_string('''
+    return render_template('edit.html', name=customer[0], account=customer[1], email=customer[2] or '', phone=customer[3] or '')
+
+DUPLICATES_TEMPLATE = '''
+<!doctype html>
+<html lang="en">
+<head>
+    <meta charset="utf-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <title>Possible Duplicates</title>
+    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css" rel="stylesheet">
+</head>
+<body>
+    <div class="container mt-5">
+        {% if customer %}
+        <h1 class="mb-4">Possible duplicates of {{ customer[1] }}</h1>
+        {% else %}
+        <h1 class="mb-4">Possible Duplicates <small class="text-muted">({{ open_pairs }} to review)</small></h1>
+        {% endif %}
+        {% if pairs %}
+        <table class="table table-striped align-middle">
+            <thead>
+                <tr>
+                    <th>Match</th>
+                    <th>Customer</th>
+                    <th>Customer</th>
+                    <th></th>
+                </tr>
+            </thead>
+            <tbody>
+                {% for score, a, b in pairs %}
+                <tr>
+                    <td>{{ '%.0f' % (score * 100) }}%</td>
+                    {% for c in (a, b) %}
+                    <td>
+                        <a href="/interactions/{{ c[0] }}">#{{ c[0] }} {{ c[1] }}</a><br>
+                        <small class="text-muted">{{ c[2] }}{% if c[3] %} &middot; {{ c[3] }}{% endif %}{% if c[4] %} &middot; {{ c[4] }}{% endif %}</small>
+                    </td>
+                    {% endfor %}
+                    <td class="text-end">
+                        <form method="post" action="/merge/{{ b[0] }}/into/{{ a[0] }}" class="d-inline" onsubmit="return confirm('Merge #{{ b[0] }} into #{{ a[0] }}?');">
+                            <button type="submit" class="btn btn-primary btn-sm">Keep #{{ a[0] }}</button>
+                        </form>
+                        <form method="post" action="/merge/{{ a[0] }}/into/{{ b[0] }}" class="d-inline" onsubmit="return confirm('Merge #{{ a[0] }} into #{{ b[0] }}?');">
+                            <button type="submit" class="btn btn-outline-primary btn-sm">Keep #{{ b[0] }}</button>
+                        </form>
+                        <form method="post" action="/duplicates/{{ a[0] }}/{{ b[0] }}/dismiss" class="d-inline">
+                            {% if customer %}<input type="hidden" name="from" value="{{ customer[0] }}">{% endif %}
+                            <button type="submit" class="btn btn-secondary btn-sm">Not duplicates</button>
+                        </form>
+                    </td>
+                </tr>
+                {% endfor %}
+            </tbody>
+        </table>
+        {% else %}
+        <p class="text-muted">No possible duplicates found.</p>
+        {% endif %}
+        <a href="/" class="btn btn-secondary">Back to Home</a>
+    </div>
+</body>
+</html>
+    '''
+
+@app.route('/duplicates')
+def duplicates():
+    cur = get_db().cursor()
+    cur.execute('''
+        SELECT d.score, a.id, a.name, a.account, a.email, a.phone, b.id, b.name, b.account, b.email, b.phone
+        FROM customer_duplicates d
+        JOIN customers a ON a.id = d.customer_id
+        JOIN customers b ON b.id = d.duplicate_id
+        WHERE d.status = 'open'
+        ORDER BY d.score DESC
+        LIMIT ?
+    ''', (DEDUP_PAGE_SIZE,))
+    pairs = [(row[0], row[1:6], row[6:]) for row in cur.fetchall()]
+    cur.execute("SELECT count(*) FROM customer_duplicates WHERE status = 'open'")
+    return render_template('duplicates.html', pairs=pairs, open_pairs=cur.fetchone()[0], customer=None)
+
+@app.route('/duplicates/<int:customer_id>')
+def customer_duplicates(customer_id):
+    cur = get_db().cursor()
+    cur.execute('SELECT id, name, account, email, phone FROM customers WHERE id = ?', (customer_id,))
+    customer = cur.fetchone()
+    if not customer:
+        return "Customer not found", 404
+    pairs = [(score, customer, row) for score, row in find_duplicates(cur, customer_id)]
+    return render_template('duplicates.html', pairs=pairs, customer=customer)
+
+@app.route('/duplicates/<int:customer_id>/<int:duplicate_id>/dismiss', methods=['POST'])
+def dismiss_duplicate(customer_id, duplicate_id):
+    conn = get_db()
+    conn.execute("INSERT INTO customer_duplicates (customer_id, duplicate_id, score, status, found_at) VALUES (?, ?, 0, 'dismissed', ?) "
+                 "ON CONFLICT (customer_id, duplicate_id) DO UPDATE SET status = 'dismissed'",
+                 (min(customer_id, duplicate_id), max(customer_id, duplicate_id), datetime.now().isoformat()))
+    conn.commit()
+    back = request.form.get('from', type=int)
+    return redirect(url_for('customer_duplicates', customer_id=back) if back else url_for('duplicates'))
+
+@app.route('/merge/<int:duplicate_id>/into/<int:survivor_id>', methods=['POST'])
+def merge(duplicate_id, survivor_id):
+    conn = get_db()
+    if merge_customers(conn.cursor(), survivor_id, duplicate_id) is None:
+        return "Customer not found", 404
+    conn.commit()
+    return redirect(url_for('interactions', customer_id=survivor_id))
+
+@app.cli.command('find-duplicates')
+@click.option('--threshold', type=click.FloatRange(0, 1), default=DEDUP_THRESHOLD, show_default=True, help='Minimum match score.')
+@click.option('--max-block', type=click.IntRange(2), default=DEDUP_MAX_BLOCK, show_default=True,
+              help='Skip blocking keys shared by more customers than this.')
+@click.option('--rebuild-keys', is_flag=True, help='Recompute every blocking key first.')
+def find_duplicates_command(threshold, max_block, rebuild_keys):
+    """Scan all customers for likely duplicates and queue them for review at /duplicates."""
+    report = scan_duplicates(threshold, max_block, rebuild_keys)
+    click.echo(f"Indexed {report['indexed']} customers; compared {report['compared']} pairs in {report['blocks']} blocks "
+               f"({report['skipped_blocks']} oversized blocks skipped); found {report['found']} likely duplicates "
+               f"in {report['seconds']}s.")
+
+INTERACTION_ROWS_TEMPLATE = '''
+                {% for inter in interactions %}
+                <tr>
+                    <td>{{ inter[1] }}</td>
+                    <td>{{ inter[2] }}</td>
+                    <td>
+                        <a href="/delete_interaction/{{ inter[0] }}/{{ customer_id }}" class="btn btn-danger btn-sm" onclick="return confirm('Delete this interaction?');">Delete</a>
+                    </td>
+                </tr>
+                {% endfor %}
+'''
+
+INTERACTIONS_TEMPLATE = '''
 <!doctype html>
 <html lang="en">
 <head>
@@ -554,7 +2558,7 @@ def interactions(customer_id):
                 <button type="submit" class="btn btn-primary">Add Note</button>
             </div>
         </form>
-        <table class="table table-striped">
+        <table class="table table-striped" id="interactionTable">
             <thead>
                 <tr>
                     <th>Date</th>
@@ -563,73 +2567,100 @@ def interactions(customer_id):
                 </tr>
             </thead>
             <tbody>
-                {% for inter in interactions %}
-                <tr>
-                    <td>{{ inter[1] }}</td>
-                    <td>{{ inter[2] }}</td>
-                    <td>
-                        <a href="/delete_interaction/{{ inter[0] }}/{{ customer_id }}" class="btn btn-danger btn-sm" onclick="return confirm('Delete this interaction?');">Delete</a>
-                    </td>
-                </tr>
-                {% endfor %}
+                {% include 'interaction_rows.html' %}
             </tbody>
         </table>
+        {% if next_url %}
+        <div class="text-center mb-3">
+            <a href="{{ next_url }}" id="loadMore" class="btn btn-outline-primary">Load older notes</a>
+        </div>
+        {% endif %}
         <a href="/" class="btn btn-secondary mt-3">Back to Home</a>
     </div>
+    <script>
+        // Older notes load as the "Load older notes" link scrolls into view.
+        const loadMore = document.getElementById('loadMore');
+        if (loadMore && 'IntersectionObserver' in window) {
+            let loading = false;
+            const observer = new IntersectionObserver(async function(entries) {
+                if (!entries[0].isIntersecting || loading) return;
+                loading = true;
+                const url = new URL(loadMore.href);
+                url.searchParams.set('format', 'json');
+                try {
+                    const data = await (await fetch(url)).json();
+                    document.querySelector('#interactionTable tbody').insertAdjacentHTML('beforeend', data.html);
+                    if (data.next) {
+                        loadMore.href = data.next;
+                    } else {
+                        observer.disconnect();
+                        loadMore.parentNode.remove();
+                    }
+                } finally {
+                    loading = false;
+                }
+            });
+            observer.observe(loadMore);
+        }
+    </script>
 </body>
 </html>
-    ''', name=customer[0], interactions=inters, customer_id=customer_id)
+    '''
 
-@app.route('/delete_interaction/<int:interaction_id>/<int:customer_id>')
-def delete_interaction(interaction_id, customer_id):
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    cur.execute('DELETE FROM interactions WHERE id = ?', (interaction_id,))
-    conn.commit()
-    conn.close()
-    return redirect(url_for('interactions', customer_id=customer_id))
+# A customer's timeline is read newest first in keyset pages over the
+# (customer_id, date) index, so long-running accounts cost one page per view.
+INTERACTIONS_PAGE_SIZE = 50
 
-@app.route('/insight/<int:customer_id>', methods=['GET'])
-def insight(customer_id):
-    api_key = get_api_key()
-    if not api_key:
-        return redirect(url_for('home'))
-    conn = sqlite3.connect(DB)
+def list_interactions(cur, customer_id, after=None, limit=INTERACTIONS_PAGE_SIZE):
+    sql, params = 'SELECT id, date, note FROM interactions WHERE customer_id = ?', [customer_id]
+    if after is not None:
+        key, row_id = after
+        sql += " AND coalesce(date, '') <= ? AND (coalesce(date, ''), id) < (?, ?)"
+        params.extend([key, key, row_id])
+    sql += " ORDER BY coalesce(date, '') DESC, id DESC LIMIT ?"
+    params.append(limit + 1)
+    rows = cur.execute(sql, params).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][1] or '', rows[-1][0])
+    return rows, next_cursor
+
+@app.route('/interactions/<int:customer_id>', methods=['GET', 'POST'])
+def interactions(customer_id):
+    conn = get_db()
     cur = conn.cursor()
-    cur.execute('SELECT name, account, email, phone FROM customers WHERE id = ?', (customer_id,))
+    cur.execute('SELECT name FROM customers WHERE id = ?', (customer_id,))
     customer = cur.fetchone()
-    cur.execute('SELECT date, note FROM interactions WHERE customer_id = ? ORDER BY date DESC', (customer_id,))
-    inters = cur.fetchall()
-    conn.close()
     if not customer:
         return "Customer not found", 404
-    name, account, email, phone = customer
-    inter_notes = '\n'.join([f"{i[0]}: {i[1]}" for i in inters])
-    client = Groq(api_key=api_key)
-    prompt = f"""Provide an advanced, personalized business insight or relationship management suggestion for customer '{name}'.
-Account: '{account}', Email: '{email or "N/A"}', Phone: '{phone or "N/A"}'.
-Recent interactions:
-{inter_notes or "No interactions yet."}
-Make it dynamic, actionable, professional, and consider all provided data for tailored advice.
-Output in Markdown format with sections like ## Overview, ## Recommendations, ## Next Steps, using bold **text** for emphasis, lists - for items."""
-    try:
-        completion = client.chat.completions.create(
-            model="llama3-70b-8192",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7,
-            max_tokens=500,
-        )
-        insight_text = completion.choices[0].message.content.strip()
-        insight_html = basic_markdown(insight_text)
-    except Exception as e:
-        insight_html = f"Error: {str(e)}"
-    return render_template_string('''
+    if request.method == 'POST':
+        note = request.form.get('note')
+        if note:
+            queued_write(add_interaction, customer_id, note)
+    cursor_token = request.args.get('after')
+    after = decode_cursor(cursor_token) if cursor_token else None
+    inters, next_cursor = list_interactions(cur, customer_id, after)
+    next_url = url_for('interactions', customer_id=customer_id, after=next_cursor) if next_cursor else None
+    if request.args.get('format') == 'json':
+        return {"html": render_template('interaction_rows.html', interactions=inters, customer_id=customer_id), "next": next_url}
+    return render_template('interactions.html', name=customer[0], interactions=inters, customer_id=customer_id, next_url=next_url)
+
+@app.route('/delete_interaction/<int:interaction_id>/<int:customer_id>')
+def delete_interaction(interaction_id, customer_id):
+    conn = get_db()
+    remove_interaction(conn.cursor(), interaction_id)
+    conn.commit()
+    return redirect(url_for('interactions', customer_id=customer_id))
+
+INSIGHT_TEMPLATE = '''
 <!doctype html>
 <html lang="en">
 <head>
     <meta charset="utf-8">
     <meta name="viewport" content="width=device-width, initial-scale=1">
     <title>AI Insight for {{ name }}</title>
+    {% if refresh_url %}<meta http-equiv="refresh" content="{{ poll_seconds }};url={{ refresh_url }}">{% endif %}
     <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css" rel="stylesheet">
     <link href="https://cdn.jsdelivr.net/npm/bootstrap-icons/font/bootstrap-icons.css" rel="stylesheet">
     <style>
@@ -656,13 +2687,19 @@ Output in Markdown format with sections like ## Overview, ## Recommendations, ##
                 <h4 class="mb-0">Generated Insight</h4>
             </div>
             <div class="card-body">
-                {{ insight | safe }}
+                <div id="insightBody">{{ insight | safe }}</div>
+                {% if stream_url %}
+                <noscript><a href="{{ url_for('insight', customer_id=customer_id, stream=0, refresh=request.args.get('refresh')) }}">Generate insight</a></noscript>
+                {% endif %}
+                {% if generated_at %}
+                <p class="text-muted small mt-3 mb-0"><i class="bi bi-clock-history"></i> Cached insight generated {{ generated_at[:16] | replace('T', ' ') }}. Regenerate for a fresh one.</p>
+                {% endif %}
             </div>
         </div>
         <div class="mt-4 text-center">
-            <a href="{{ url_for('insight', customer_id=customer_id) }}" class="btn btn-warning me-2"><i class="bi bi-arrow-repeat"></i> Regenerate Insight</a>
+            <a href="{{ url_for('insight', customer_id=customer_id, refresh=1) }}" class="btn btn-warning me-2"><i class="bi bi-arrow-repeat"></i> Regenerate Insight</a>
             <form action="{{ url_for('add_insight_note', customer_id=customer_id) }}" method="post" style="display: inline;">
-                <input type="hidden" name="insight" value="{{ raw_insight }}">
+                <input type="hidden" name="insight" id="rawInsight" value="{{ raw_insight }}">
                 <button type="submit" class="btn btn-success me-2"><i class="bi bi-save"></i> Save as Interaction Note</button>
             </form>
             <a href="{{ url_for('interactions', customer_id=customer_id) }}" class="btn btn-primary me-2"><i class="bi bi-chat-dots"></i> View Interactions</a>
@@ -673,67 +2710,119 @@ Output in Markdown format with sections like ## Overview, ## Recommendations, ##
             <form action="{{ url_for('custom_insight', customer_id=customer_id) }}" method="post">
                 <div class="input-group">
                     <input type="text" name="custom_prompt" placeholder="Ask a custom question about this customer..." class="form-control" required>
+                    <noscript><input type="hidden" name="stream" value="0"></noscript>
                     <button type="submit" class="btn btn-info">Query AI</button>
                 </div>
             </form>
         </div>
     </div>
+    {% if stream_url %}
+    {% include 'stream_markdown.html' %}
+    <script>
+        const insightBody = document.getElementById('insightBody');
+        insightBody.innerHTML = '<span class="text-muted">Generating insight...</span>';
+        streamMarkdown({{ stream_url | tojson }}, {}, insightBody, {
+            onDone: payload => { document.getElementById('rawInsight').value = payload.text; }
+        }).catch(error => { insightBody.textContent = 'Error: ' + error.message; });
+    </script>
+    {% endif %}
 </body>
 </html>
-    ''', name=name, account=account, email=email, phone=phone, insight=insight_html, raw_insight=insight_text, customer_id=customer_id)
+    '''
 
-@app.route('/add_insight_note/<int:customer_id>', methods=['POST'])
-def add_insight_note(customer_id):
-    insight = request.form.get('insight')
-    if insight:
-        now = datetime.now().isoformat()
-        conn = sqlite3.connect(DB)
-        cur = conn.cursor()
-        cur.execute('INSERT INTO interactions (customer_id, date, note) VALUES (?, ?, ?)', (customer_id, now, f"AI Insight: {insight}"))
-        conn.commit()
-        conn.close()
-    return redirect(url_for('insight', customer_id=customer_id))
+# Insight prompts carry the most recent notes only; older history is reduced
+# to a one-line summary so prompt size stays flat as an account ages.
+INSIGHT_PROMPT_NOTES = 20
 
-@app.route('/custom_insight/<int:customer_id>', methods=['POST'])
-def custom_insight(customer_id):
-    custom_prompt = request.form.get('custom_prompt')
-    api_key = get_api_key()
-    if not api_key or not custom_prompt:
-        return redirect(url_for('insight', customer_id=customer_id))
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
+def recent_interaction_notes(cur, customer_id, limit=INSIGHT_PROMPT_NOTES):
+    cur.execute('SELECT date, note FROM interactions WHERE customer_id = ? ORDER BY date DESC, id DESC LIMIT ?', (customer_id, limit))
+    lines = [f"{date}: {note}" for date, note in cur.fetchall()]
+    if len(lines) == limit:
+        cur.execute('SELECT interaction_count, first_interaction FROM customer_summary WHERE customer_id = ?', (customer_id,))
+        row = cur.fetchone()
+        if row and row[0] > limit:
+            lines.append(f"(plus {row[0] - limit} earlier interactions since {row[1]}, not shown)")
+    return '\n'.join(lines)
+
+def insight_prompt(cur, customer_id):
     cur.execute('SELECT name, account, email, phone FROM customers WHERE id = ?', (customer_id,))
     customer = cur.fetchone()
-    cur.execute('SELECT date, note FROM interactions WHERE customer_id = ? ORDER BY date DESC', (customer_id,))
-    inters = cur.fetchall()
-    conn.close()
+    if not customer:
+        return None, None
+    name, account, email, phone = customer
+    inter_notes = recent_interaction_notes(cur, customer_id)
+    prompt = f"""Provide an advanced, personalized business insight or relationship management suggestion for customer '{name}'.
+Account: '{account}', Email: '{email or "N/A"}', Phone: '{phone or "N/A"}'.
+Activity: {customer_activity(cur, customer_id, insight=False)}.
+Recent interactions:
+{inter_notes or "No interactions yet."}
+Make it dynamic, actionable, professional, and consider all provided data for tailored advice.
+Output in Markdown format with sections like ## Overview, ## Recommendations, ## Next Steps, using bold **text** for emphasis, lists - for items."""
+    return customer, prompt
+
+@app.route('/insight/<int:customer_id>', methods=['GET'])
+def insight(customer_id):
+    api_key = get_api_key()
+    if not api_key:
+        return redirect(url_for('home'))
+    customer, prompt = insight_prompt(get_db().cursor(), customer_id)
     if not customer:
         return "Customer not found", 404
     name, account, email, phone = customer
-    inter_notes = '\n'.join([f"{i[0]}: {i[1]}" for i in inters])
-    client = Groq(api_key=api_key)
-    full_prompt = f"""Based on customer '{name}' data: Account '{account}', Email '{email or "N/A"}', Phone '{phone or "N/A"}'.
-Interactions: {inter_notes or "None"}.
-Answer this query: {custom_prompt}
-Output in Markdown."""
-    try:
-        completion = client.chat.completions.create(
-            model="llama3-70b-8192",
-            messages=[{"role": "user", "content": full_prompt}],
-            temperature=0.7,
-            max_tokens=500,
-        )
-        custom_text = completion.choices[0].message.content.strip()
-        custom_html = basic_markdown(custom_text)
-    except Exception as e:
-        custom_html = f"Error: {str(e)}"
-    return render_template_string('''
+    fingerprint = insight_fingerprint(prompt)
+    cached = None if request.args.get('refresh') == '1' else get_cached_insight(customer_id, fingerprint)
+    insight_text, generated_at, insight_html, stream_url, refresh_url = '', None, '', None, None
+    if cached:
+        insight_text, generated_at = cached
+        insight_html = basic_markdown(insight_text)
+    elif request.args.get('stream') == '0':
+        # Without JavaScript the insight is generated as a background job and
+        # the page reloads itself until the job has finished.
+        job = get_job(request.args['job']) if request.args.get('job') else None
+        if job and job['status'] == 'done':
+            insight_text, insight_html = job['result'], job['html']
+        elif job and job['status'] == 'error':
+            insight_html = f"Error: {job['error']}"
+        else:
+            try:
+                job_id = job['id'] if job else queue_insight(customer_id, prompt, fingerprint)
+                refresh_url = url_for('insight', customer_id=customer_id, stream=0, job=job_id)
+                insight_html = 'Generating insight...'
+            except JobQueueFull as e:
+                insight_html = f"Error: {str(e)}"
+    else:
+        # The page renders at once and the browser streams the insight into it.
+        stream_url = url_for('insight_stream', customer_id=customer_id)
+    return render_template('insight.html', name=name, account=account, email=email, phone=phone, insight=insight_html, raw_insight=insight_text,
+                           generated_at=generated_at, stream_url=stream_url, refresh_url=refresh_url, poll_seconds=JOB_POLL_SECONDS,
+                           customer_id=customer_id)
+
+@app.route('/insight/<int:customer_id>/stream')
+def insight_stream(customer_id):
+    api_key = get_api_key()
+    if not api_key:
+        return {"error": "API key not configured"}, 403
+    customer, prompt = insight_prompt(get_db().cursor(), customer_id)
+    if not customer:
+        return {"error": "Customer not found"}, 404
+    fingerprint = insight_fingerprint(prompt)
+    return stream_completion(api_key, prompt, lambda text, html: store_cached_insight(customer_id, fingerprint, text))
+
+@app.route('/add_insight_note/<int:customer_id>', methods=['POST'])
+def add_insight_note(customer_id):
+    insight = request.form.get('insight')
+    if insight:
+        queued_write(add_interaction, customer_id, f"AI Insight: {insight}")
+    return redirect(url_for('insight', customer_id=customer_id))
+
+CUSTOM_INSIGHT_TEMPLATE = '''
 <!doctype html>
 <html lang="en">
 <head>
     <meta charset="utf-8">
     <meta name="viewport" content="width=device-width, initial-scale=1">
     <title>Custom AI Insight for {{ name }}</title>
+    {% if refresh_url %}<meta http-equiv="refresh" content="{{ poll_seconds }};url={{ refresh_url }}">{% endif %}
     <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css" rel="stylesheet">
     <link href="https://cdn.jsdelivr.net/npm/bootstrap-icons/font/bootstrap-icons.css" rel="stylesheet">
     <style>
@@ -749,31 +2838,997 @@ Output in Markdown."""
                 <h4 class="mb-0">Query: {{ query }}</h4>
             </div>
             <div class="card-body">
-                {{ response | safe }}
+                <div id="responseBody">{{ response | safe }}</div>
             </div>
         </div>
         <div class="mt-4 text-center">
             <a href="{{ url_for('insight', customer_id=customer_id) }}" class="btn btn-primary"><i class="bi bi-arrow-left"></i> Back to Insight</a>
         </div>
     </div>
+    {% if stream_url %}
+    {% include 'stream_markdown.html' %}
+    <script>
+        const responseBody = document.getElementById('responseBody');
+        responseBody.innerHTML = '<span class="text-muted">Thinking...</span>';
+        streamMarkdown({{ stream_url | tojson }}, {}, responseBody)
+            .catch(error => { responseBody.textContent = 'Error: ' + error.message; });
+    </script>
+    {% endif %}
 </body>
 </html>
-    ''', name=name, query=custom_prompt, response=custom_html, customer_id=customer_id)
+    '''
+
+def custom_insight_prompt(cur, customer_id, custom_prompt):
+    cur.execute('SELECT name, account, email, phone FROM customers WHERE id = ?', (customer_id,))
+    customer = cur.fetchone()
+    if not customer:
+        return None, None
+    name, account, email, phone = customer
+    inter_notes = recent_interaction_notes(cur, customer_id)
+    full_prompt = f"""Based on customer '{name}' data: Account '{account}', Email '{email or "N/A"}', Phone '{phone or "N/A"}'.
+Activity: {customer_activity(cur, customer_id)}.
+Interactions: {inter_notes or "None"}.
+Answer this query: {custom_prompt}
+Output in Markdown."""
+    return customer, full_prompt
+
+@app.route('/custom_insight/<int:customer_id>', methods=['GET', 'POST'])
+def custom_insight(customer_id):
+    if request.method == 'GET':
+        return custom_insight_job(customer_id, request.args.get('job'))
+    custom_prompt = request.form.get('custom_prompt')
+    api_key = get_api_key()
+    if not api_key or not custom_prompt:
+        return redirect(url_for('insight', customer_id=customer_id))
+    customer, full_prompt = custom_insight_prompt(get_db().cursor(), customer_id, custom_prompt)
+    if not customer:
+        return "Customer not found", 404
+    custom_html, stream_url = '', None
+    if request.form.get('stream') == '0':
+        try:
+            job_id = submit_job('custom_insight', full_prompt, customer_id=customer_id, payload=custom_prompt)
+        except JobQueueFull as e:
+            return render_template('custom_insight.html', name=customer[0], query=custom_prompt, response=f"Error: {str(e)}",
+                                   customer_id=customer_id)
+        return redirect(url_for('custom_insight', customer_id=customer_id, job=job_id))
+    else:
+        stream_url = url_for('custom_insight_stream', customer_id=customer_id, q=custom_prompt)
+    return render_template('custom_insight.html', name=customer[0], query=custom_prompt, response=custom_html,
+                           stream_url=stream_url, customer_id=customer_id)
+
+@app.route('/custom_insight/<int:customer_id>/stream')
+def custom_insight_stream(customer_id):
+    custom_prompt = request.args.get('q')
+    api_key = get_api_key()
+    if not api_key:
+        return {"error": "API key not configured"}, 403
+    if not custom_prompt:
+        return {"error": "No query provided"}, 400
+    customer, full_prompt = custom_insight_prompt(get_db().cursor(), customer_id, custom_prompt)
+    if not customer:
+        return {"error": "Customer not found"}, 404
+    return stream_completion(api_key, full_prompt, lambda text, html: record_insight(customer_id))
+
+def custom_insight_job(customer_id, job_id):
+    job = get_job(job_id) if job_id else None
+    if not job or job['kind'] != 'custom_insight' or job['customer_id'] != customer_id:
+        return redirect(url_for('insight', customer_id=customer_id))
+    customer = get_db().execute('SELECT name FROM customers WHERE id = ?', (customer_id,)).fetchone()
+    if not customer:
+        return "Customer not found", 404
+    refresh_url = None
+    if job['status'] == 'done':
+        custom_html = job['html']
+    elif job['status'] == 'error':
+        custom_html = f"Error: {job['error']}"
+    else:
+        custom_html, refresh_url = 'Thinking...', url_for('custom_insight', customer_id=customer_id, job=job_id)
+    return render_template('custom_insight.html', name=customer[0], query=job['payload'], response=custom_html,
+                           refresh_url=refresh_url, poll_seconds=JOB_POLL_SECONDS, customer_id=customer_id)
+
+def queue_insight(customer_id, prompt, fingerprint):
+    # Asking twice for the same insight while it is being generated joins the running job.
+    return find_active_job('insight', customer_id, fingerprint) or \
+        submit_job('insight', prompt, customer_id=customer_id, fingerprint=fingerprint)
+
+# What a finished job does with its text, by job kind.
+JOB_HANDLERS = {
+    'insight': lambda customer_id, payload, fingerprint, text: store_cached_insight(customer_id, fingerprint, text),
+    'custom_insight': lambda customer_id, payload, fingerprint, text: record_insight(customer_id),
+    'chat': lambda customer_id, payload, fingerprint, text: save_chat(json.loads(payload)['message'], basic_markdown(text),
+                                                                     json.loads(payload)['session_id'], text),
+    'chat_summary': lambda customer_id, payload, fingerprint, text: store_chat_summary(payload, text),
+}
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = get_job(job_id)
+    if not job:
+        return {"error": "Job not found"}, 404
+    return job
+
+@app.route('/insight/<int:customer_id>/job', methods=['POST'])
+def insight_job(customer_id):
+    if not get_api_key():
+        return {"error": "API key not configured"}, 403
+    customer, prompt = insight_prompt(get_db().cursor(), customer_id)
+    if not customer:
+        return {"error": "Customer not found"}, 404
+    try:
+        job_id = queue_insight(customer_id, prompt, insight_fingerprint(prompt))
+    except JobQueueFull as e:
+        return {"error": str(e)}, 503
+    return {"job_id": job_id, "status_url": url_for('job_status', job_id=job_id)}, 202
+
+def queue_insights(customer_ids, refresh=False):
+    # Batch mode: one job per customer whose cached insight is missing or stale.
+    # Once the queue is full the remaining customers are returned as skipped,
+    # so the caller keeps the ids of the jobs that did get queued.
+    cur = get_db().cursor()
+    jobs, cached, missing = {}, [], []
+    for n, customer_id in enumerate(customer_ids):
+        customer, prompt = insight_prompt(cur, customer_id)
+        if not customer:
+            missing.append(customer_id)
+            continue
+        fingerprint = insight_fingerprint(prompt)
+        if not refresh and get_cached_insight(customer_id, fingerprint):
+            cached.append(customer_id)
+            continue
+        try:
+            jobs[customer_id] = queue_insight(customer_id, prompt, fingerprint)
+        except JobQueueFull:
+            return jobs, cached, missing, customer_ids[n:]
+    return jobs, cached, missing, []
+
+@app.route('/jobs/insights', methods=['POST'])
+def batch_insight_jobs():
+    if not get_api_key():
+        return {"error": "API key not configured"}, 403
+    data = request.get_json(silent=True) or {}
+    customer_ids = data.get('customer_ids')
+    if not isinstance(customer_ids, list) or not all(isinstance(i, int) for i in customer_ids):
+        return {"error": "customer_ids must be a list of integers"}, 400
+    if len(customer_ids) > LLM_JOB_QUEUE_LIMIT:
+        return {"error": f"At most {LLM_JOB_QUEUE_LIMIT} customers per batch"}, 400
+    jobs, cached, missing, skipped = queue_insights(customer_ids, refresh=bool(data.get('refresh')))
+    if skipped and not jobs:
+        return {"error": "AI job queue is full, try again shortly", "cached": cached, "missing": missing, "skipped": skipped}, 503
+    return {"jobs": jobs, "cached": cached, "missing": missing, "skipped": skipped}, 202
+
+# Insight batches generate insights for a filtered set of customers outside
+# the job queue. The customer list is written to insight_batch_items up front
+# and every item is checkpointed as it finishes, so a batch that dies part way
+# resumes where it stopped. Calls fan out over INSIGHT_BATCH_WORKERS threads and
+# are paced to stay inside a requests- and tokens-per-minute budget (0 turns a
+# limit off); results go to insight_cache, where /insight picks them up.
+INSIGHT_BATCH_WORKERS = 4
+INSIGHT_BATCH_RPM = 30
+INSIGHT_BATCH_TPM = 6000
+INSIGHT_BATCH_CHUNK = 500
+INSIGHT_BATCH_MAX_IDS = 10000
+INSIGHT_MAX_TOKENS = 500
+_running_batches = set()
+
+class RateBudget:
+    def __init__(self, rpm, tpm):
+        self.rpm, self.tpm = rpm, tpm
+        self.window = deque()
+        self.tokens = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens):
+        # Waits until the last minute's requests leave room for one more call
+        # of `tokens`, then records it. Returns the entry for settle().
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.window and self.window[0][0] <= now - 60:
+                    self.tokens -= self.window.popleft()[1]
+                if (not self.rpm or len(self.window) < self.rpm) and \
+                        (not self.tpm or not self.window or self.tokens + tokens <= self.tpm):
+                    entry = [now, tokens]
+                    self.window.append(entry)
+                    self.tokens += tokens
+                    return entry
+                wait = self.window[0][0] + 60 - now
+            time.sleep(min(max(wait, 0.01), 1))
+
+    def settle(self, entry, tokens):
+        # Replaces the estimate with what the API actually reported.
+        with self.lock:
+            if entry in self.window:
+                self.tokens += tokens - entry[1]
+            entry[1] = tokens
+
+def batch_customer_ids(cur, search_query='', customer_ids=None, limit=None):
+    sql, params = 'SELECT id FROM customers', []
+    if search_query:
+        sql += ' WHERE id IN (SELECT rowid FROM customers_fts WHERE customers_fts MATCH ?)'
+        params.append(fts_query(search_query) or '""')
+    # An empty list selects nobody; only None means every customer.
+    if customer_ids is not None:
+        sql += (' AND' if params else ' WHERE') + f" id IN ({','.join('?' * len(customer_ids))})"
+        params.extend(customer_ids)
+    sql += ' ORDER BY id'
+    if limit:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    return cur.execute(sql, params)
+
+def create_insight_batch(search_query='', customer_ids=None, limit=None, refresh=False,
+                         workers=INSIGHT_BATCH_WORKERS, rpm=INSIGHT_BATCH_RPM, tpm=INSIGHT_BATCH_TPM):
+    conn = get_db()
+    now = datetime.now().isoformat()
+    batch_filter = {'search': search_query, 'customer_ids': customer_ids, 'limit': limit, 'refresh': refresh}
+    with conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO insight_batches (filter, status, created_at, updated_at, workers, rpm, tpm) VALUES (?, 'pending', ?, ?, ?, ?, ?)",
+                    (json.dumps(batch_filter), now, now, workers, rpm, tpm))
+        batch_id = cur.lastrowid
+        cur.executemany('INSERT INTO insight_batch_items (batch_id, customer_id) VALUES (?, ?)',
+                        ((batch_id, row[0]) for row in batch_customer_ids(conn.cursor(), search_query, customer_ids, limit)))
+    return batch_id
+
+def get_insight_batch(batch_id):
+    conn = get_db()
+    row = conn.execute('SELECT id, filter, status, created_at, updated_at, seconds, workers, rpm, tpm FROM insight_batches WHERE id = ?',
+                       (batch_id,)).fetchone()
+    if not row:
+        return None
+    batch = dict(zip(('id', 'filter', 'status', 'created_at', 'updated_at', 'seconds', 'workers', 'rpm', 'tpm'), row))
+    batch['filter'] = json.loads(batch['filter'])
+    counts = {'pending': 0, 'done': 0, 'cached': 0, 'missing': 0, 'error': 0}
+    prompt_tokens = completion_tokens = 0
+    for status, count, prompt_sum, completion_sum in conn.execute(
+            'SELECT status, count(*), sum(prompt_tokens), sum(completion_tokens) FROM insight_batch_items WHERE batch_id = ? GROUP BY status',
+            (batch_id,)):
+        counts[status] = count
+        prompt_tokens += prompt_sum
+        completion_tokens += completion_sum
+    seconds = batch['seconds'] or 0
+    batch.update(counts=counts, total=sum(counts.values()), prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                 total_tokens=prompt_tokens + completion_tokens,
+                 insights_per_minute=round(counts['done'] / seconds * 60, 1) if seconds else 0,
+                 tokens_per_minute=round((prompt_tokens + completion_tokens) / seconds * 60) if seconds else 0)
+    return batch
+
+def run_insight_batch(batch_id, workers=None, rpm=None, tpm=None):
+    # Settings left as None come from the batch row, so a resume runs with
+    # the concurrency and budget the batch was started with.
+    with _llm_lock:
+        if batch_id in _running_batches:
+            return
+        _running_batches.add(batch_id)
+    conn = get_db()
+    start = time.perf_counter()
+    status = 'error'
+    try:
+        api_key = get_api_key()
+        if not api_key:
+            raise RuntimeError("API key not configured")
+        row = conn.execute('SELECT filter, workers, rpm, tpm FROM insight_batches WHERE id = ?', (batch_id,)).fetchone()
+        refresh = json.loads(row[0]).get('refresh')
+        workers = next(v for v in (workers, row[1], INSIGHT_BATCH_WORKERS) if v is not None)
+        rpm = next(v for v in (rpm, row[2], INSIGHT_BATCH_RPM) if v is not None)
+        tpm = next(v for v in (tpm, row[3], INSIGHT_BATCH_TPM) if v is not None)
+        with conn:
+            conn.execute("UPDATE insight_batches SET status = 'running', updated_at = ? WHERE id = ?", (datetime.now().isoformat(), batch_id))
+        budget = RateBudget(rpm, tpm)
+
+        def generate(customer_id):
+            item_conn = get_db()
+            customer, prompt = insight_prompt(item_conn.cursor(), customer_id)
+            result = ('missing', 0, 0, None)
+            if customer:
+                fingerprint = insight_fingerprint(prompt)
+                result = ('cached', 0, 0, None)
+                if refresh or not get_cached_insight(customer_id, fingerprint):
+                    entry = budget.acquire(estimate_tokens(prompt) + INSIGHT_MAX_TOKENS)
+                    try:
+                        text, prompt_tokens, completion_tokens = complete_with_usage(api_key, prompt)
+                        budget.settle(entry, prompt_tokens + completion_tokens)
+                        store_cached_insight(customer_id, fingerprint, text)
+                        result = ('done', prompt_tokens, completion_tokens, None)
+                    except Exception as e:
+                        result = ('error', 0, 0, str(e))
+            with item_conn:
+                item_conn.execute('UPDATE insight_batch_items SET status = ?, prompt_tokens = ?, completion_tokens = ?, error = ? WHERE batch_id = ? AND customer_id = ?',
+                                  result + (batch_id, customer_id))
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='insight-batch') as pool:
+            after = 0
+            while True:
+                # Items left 'pending' by a crash are picked up again on resume.
+                chunk = [r[0] for r in conn.execute("SELECT customer_id FROM insight_batch_items WHERE batch_id = ? AND status = 'pending' AND customer_id > ? ORDER BY customer_id LIMIT ?",
+                                                    (batch_id, after, INSIGHT_BATCH_CHUNK))]
+                if not chunk:
+                    break
+                list(pool.map(generate, chunk))
+                after = chunk[-1]
+        status = 'done'
+    finally:
+        with conn:
+            conn.execute('UPDATE insight_batches SET status = ?, updated_at = ?, seconds = seconds + ? WHERE id = ?',
+                         (status, datetime.now().isoformat(), time.perf_counter() - start, batch_id))
+        with _llm_lock:
+            _running_batches.discard(batch_id)
+
+@app.route('/batches/insights', methods=['POST'])
+def create_insight_batch_route():
+    if not get_api_key():
+        return {"error": "API key not configured"}, 403
+    data = request.get_json(silent=True) or {}
+    customer_ids = data.get('customer_ids')
+    if customer_ids is not None and (not isinstance(customer_ids, list) or not all(isinstance(i, int) for i in customer_ids)):
+        return {"error": "customer_ids must be a list of integers"}, 400
+    if customer_ids is not None and len(customer_ids) > INSIGHT_BATCH_MAX_IDS:
+        return {"error": f"At most {INSIGHT_BATCH_MAX_IDS} customer_ids per batch; use search or limit for more"}, 400
+    options = {}
+    for name in ('limit', 'workers', 'rpm', 'tpm'):
+        value = data.get(name)
+        if value is not None and (not isinstance(value, int) or value < 0):
+            return {"error": f"{name} must be a non-negative integer"}, 400
+        if value is not None and name != 'limit':
+            options[name] = value
+    if options.get('workers') == 0:
+        return {"error": "workers must be at least 1"}, 400
+    batch_id = create_insight_batch(data.get('search') or '', customer_ids, data.get('limit'), bool(data.get('refresh')), **options)
+    threading.Thread(target=run_insight_batch, args=(batch_id,), daemon=True).start()
+    return {"batch_id": batch_id, "status_url": url_for('insight_batch_status', batch_id=batch_id)}, 202
+
+@app.route('/batches/<int:batch_id>')
+def insight_batch_status(batch_id):
+    batch = get_insight_batch(batch_id)
+    if not batch:
+        return {"error": "Batch not found"}, 404
+    return batch
+
+@app.route('/batches/<int:batch_id>/resume', methods=['POST'])
+def resume_insight_batch_route(batch_id):
+    if not get_insight_batch(batch_id):
+        return {"error": "Batch not found"}, 404
+    threading.Thread(target=run_insight_batch, args=(batch_id,), daemon=True).start()
+    return {"batch_id": batch_id, "status_url": url_for('insight_batch_status', batch_id=batch_id)}, 202
+
+def parse_customer_ids(ctx, param, value):
+    try:
+        return [int(i) for i in value.split(',') if i.strip()] or None
+    except ValueError:
+        raise click.BadParameter("expected comma-separated customer ids, e.g. 4,8,15")
+
+@app.cli.command('precompute-insights')
+@click.option('--search', default='', help='Only customers matching this search.')
+@click.option('--ids', 'customer_ids', default='', callback=parse_customer_ids, help='Comma-separated customer ids.')
+@click.option('--limit', type=int, default=None, help='Only the first N matching customers by id.')
+@click.option('--refresh', is_flag=True, help='Regenerate insights that are already cached.')
+@click.option('--resume', 'resume_id', type=int, default=None, help='Continue an unfinished batch.')
+@click.option('--workers', type=click.IntRange(1), default=None, help=f'Worker threads (default {INSIGHT_BATCH_WORKERS}).')
+@click.option('--rpm', type=click.IntRange(0), default=None, help=f'Requests per minute, 0 for no limit (default {INSIGHT_BATCH_RPM}).')
+@click.option('--tpm', type=click.IntRange(0), default=None, help=f'Tokens per minute, 0 for no limit (default {INSIGHT_BATCH_TPM}).')
+def precompute_insights_command(search, customer_ids, limit, refresh, resume_id, workers, rpm, tpm):
+    """Generate and cache insights for a filtered set of customers."""
+    if not get_api_key():
+        raise click.ClickException("API key not configured")
+    if resume_id is None:
+        settings = {name: value for name, value in (('workers', workers), ('rpm', rpm), ('tpm', tpm)) if value is not None}
+        batch_id = create_insight_batch(search, customer_ids, limit, refresh, **settings)
+    else:
+        if not get_insight_batch(resume_id):
+            raise click.ClickException(f"No batch {resume_id}")
+        batch_id = resume_id
+    click.echo(f"Batch {batch_id}: {get_insight_batch(batch_id)['counts']['pending']} customers to process")
+    start = time.perf_counter()
+    run_insight_batch(batch_id, workers, rpm, tpm)
+    elapsed = time.perf_counter() - start
+    batch = get_insight_batch(batch_id)
+    counts = batch['counts']
+    click.echo(f"Generated {counts['done']} insights, {counts['cached']} already cached, {counts['missing']} missing, "
+               f"{counts['error']} failed in {elapsed:.1f}s ({batch['insights_per_minute']} insights/min); "
+               f"{batch['total_tokens']} tokens ({batch['prompt_tokens']} prompt, {batch['completion_tokens']} completion, "
+               f"{batch['tokens_per_minute']}/min)")
+    if counts['pending']:
+        click.echo(f"{counts['pending']} customers left; continue with --resume {batch_id}", err=True)
+
+# Exports stream straight from a cursor in EXPORT_CHUNK_ROWS batches, so memory
+# stays flat and the header row goes out before the table is read.
+EXPORT_CHUNK_ROWS = 1000
+EXPORTS = {
+    'customers': ('SELECT id, name, account, email, phone, created_at, updated_at FROM customers ORDER BY id',
+                  ['ID', 'Name', 'Account', 'Email', 'Phone', 'Created At', 'Updated At']),
+    'interactions': ('SELECT id, customer_id, date, note FROM interactions ORDER BY id',
+                     ['ID', 'Customer ID', 'Date', 'Note']),
+    'chat_history': ('SELECT id, user_message, ai_response, timestamp FROM chat_history ORDER BY id',
+                     ['ID', 'User Message', 'AI Response', 'Timestamp']),
+}
+
+def stream_csv(sql, header, compress=False):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    # wbits=31 writes a gzip container; a sync flush per chunk keeps bytes moving.
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def drain():
+        data = buf.getvalue().encode()
+        buf.seek(0)
+        buf.truncate()
+        return gz.compress(data) + gz.flush(zlib.Z_SYNC_FLUSH) if gz else data
+
+    writer.writerow(header)
+    yield drain()
+    cur = get_db().cursor()
+    cur.execute(sql)
+    while True:
+        rows = cur.fetchmany(EXPORT_CHUNK_ROWS)
+        if not rows:
+            break
+        writer.writerows(rows)
+        yield drain()
+    if gz:
+        yield gz.flush()
 
 @app.route('/export')
-def export():
-    conn = sqlite3.connect(DB)
+@app.route('/export/<dataset>')
+def export(dataset='customers'):
+    if dataset not in EXPORTS:
+        return "Unknown export", 404
+    sql, header = EXPORTS[dataset]
+    compress = request.args.get('gzip') == '1'
+    filename = f'{dataset}.csv.gz' if compress else f'{dataset}.csv'
+    return Response(stream_with_context(stream_csv(sql, header, compress)),
+                    mimetype='application/gzip' if compress else 'text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+# Bulk import reads the same column layout /export writes (CSV headers or JSONL
+# keys, case-insensitive). Rows are inserted IMPORT_BATCH_ROWS at a time in one
+# transaction each; the ID column is ignored so imported rows never collide
+# with existing ids, and rows whose email already exists are skipped. Imported
+# rows get their blocking keys at the end; `flask find-duplicates` scores them.
+IMPORT_BATCH_ROWS = 5000
+IMPORT_REPORTED_ERRORS = 100
+IMPORT_SQL = '''INSERT INTO customers (name, account, email, phone, created_at, updated_at)
+                SELECT ?, ?, ?, ?, ?, ?
+                WHERE ? = '' OR NOT EXISTS (SELECT 1 FROM customers WHERE coalesce(email, '') COLLATE NOCASE = ?)'''
+
+def import_format(filename):
+    name = (filename or '').lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    return 'jsonl' if name.endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+def _import_records(stream, fmt):
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'jsonl':
+        for line_no, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield line_no, record if isinstance(record, dict) else None
+    else:
+        reader = csv.DictReader(text)
+        for record in reader:
+            yield reader.line_num, record
+
+def import_customers(stream, fmt='csv'):
+    conn = get_db()
+    now = datetime.now().isoformat()
+    report = {'imported': 0, 'duplicates': 0, 'rejected': 0, 'errors': []}
+    seen_emails = set()
+    batch = []
+    start = time.perf_counter()
+
+    def flush():
+        with conn:
+            cur = conn.executemany(IMPORT_SQL, batch)
+        report['imported'] += cur.rowcount
+        report['duplicates'] += len(batch) - cur.rowcount
+        batch.clear()
+
+    def reject(line_no, reason):
+        report['rejected'] += 1
+        if len(report['errors']) < IMPORT_REPORTED_ERRORS:
+            report['errors'].append({'line': line_no, 'error': reason})
+
+    # A file that stops being readable part way keeps the rows already read;
+    # the report says how far it got.
+    try:
+        for line_no, record in _import_records(stream, fmt):
+            if record is None:
+                reject(line_no, 'malformed row')
+                continue
+            fields = {str(key).strip().lower().replace(' ', '_'): str(value).strip()
+                      for key, value in record.items() if key is not None and value is not None}
+            name, account = fields.get('name'), fields.get('account')
+            if not name or not account:
+                reject(line_no, 'name and account are required')
+                continue
+            email = fields.get('email') or ''
+            if email:
+                if email.lower() in seen_emails:
+                    report['duplicates'] += 1
+                    continue
+                seen_emails.add(email.lower())
+            created = fields.get('created_at') or now
+            batch.append((name, account, email or None, fields.get('phone') or None,
+                          created, fields.get('updated_at') or created, email, email))
+            if len(batch) >= IMPORT_BATCH_ROWS:
+                flush()
+    except (UnicodeDecodeError, OSError, EOFError, csv.Error) as e:
+        report['error'] = f"Could not read file: {e}"
+    if batch:
+        flush()
+    with conn:
+        index_customer_keys(conn.cursor())
+    elapsed = time.perf_counter() - start
+    report['seconds'] = round(elapsed, 3)
+    report['rows_per_sec'] = round((report['imported'] + report['duplicates'] + report['rejected']) / elapsed, 1) if elapsed else 0
+    return report
+
+@app.route('/import', methods=['POST'])
+def import_route():
+    upload = request.files.get('file')
+    if not upload:
+        return {"error": "No file provided"}, 400
+    fmt = request.form.get('format') or import_format(upload.filename)
+    if fmt not in ('csv', 'jsonl'):
+        return {"error": "Unsupported format"}, 400
+    stream = upload.stream
+    if (upload.filename or '').lower().endswith('.gz'):
+        stream = gzip.GzipFile(fileobj=stream)
+    report = import_customers(stream, fmt)
+    return report, 400 if 'error' in report else 200
+
+@app.cli.command('import-customers')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Defaults to the file extension.')
+def import_customers_command(path, fmt):
+    """Bulk-load customers from a CSV or JSONL file (optionally .gz)."""
+    opener = gzip.open if path.lower().endswith('.gz') else open
+    with opener(path, 'rb') as stream:
+        report = import_customers(stream, fmt or import_format(path))
+    click.echo(f"Imported {report['imported']} customers in {report['seconds']}s "
+               f"({report['rows_per_sec']} rows/s); {report['duplicates']} duplicates skipped, "
+               f"{report['rejected']} rows rejected.")
+    for error in report['errors']:
+        click.echo(f"  line {error['line']}: {error['error']}", err=True)
+    if 'error' in report:
+        raise click.ClickException(report['error'])
+
+# JSON API, versioned by URL prefix. Reads carry an ETag and answer
+# If-None-Match with 304; writes accept If-Match and answer 412 when the
+# resource changed since it was read. POST accepts one object or a list, and
+# the batch endpoints mix creates, updates and deletes; either way every item
+# is validated first and all writes commit in one transaction or none do.
+API_PREFIX = '/api/v1'
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+API_BATCH_MAX = 1000
+
+def api_error(message, status, **extra):
+    return {"error": message, **extra}, status
+
+def api_json(payload, status=200):
+    response = jsonify(payload)
+    response.status_code = status
+    if request.method == 'GET':
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
+def api_precondition_failed(payload):
+    # If-Match is checked against the ETag a GET of the same resource returns.
+    if not request.if_match:
+        return False
+    return not request.if_match.contains(generate_etag(jsonify(payload).get_data()))
+
+def customer_json(row):
+    return dict(zip(('id', 'name', 'account', 'email', 'phone', 'created_at', 'updated_at'), row))
+
+def interaction_json(row):
+    return dict(zip(('id', 'customer_id', 'date', 'note'), row))
+
+def get_customer_json(cur, customer_id):
+    cur.execute('SELECT id, name, account, email, phone, created_at, updated_at FROM customers WHERE id = ?', (customer_id,))
+    row = cur.fetchone()
+    return customer_json(row) if row else None
+
+def get_interaction_json(cur, interaction_id):
+    cur.execute('SELECT id, customer_id, date, note FROM interactions WHERE id = ?', (interaction_id,))
+    row = cur.fetchone()
+    return interaction_json(row) if row else None
+
+def validate_customer(data, partial=False):
+    if not isinstance(data, dict):
+        return None, "expected an object"
+    unknown = set(data) - set(CUSTOMER_FIELDS) - {'id'}
+    if unknown:
+        return None, f"unknown fields: {', '.join(sorted(unknown))}"
+    fields = {name: data[name] for name in CUSTOMER_FIELDS if name in data}
+    for name, value in fields.items():
+        if value is not None and not isinstance(value, str):
+            return None, f"{name} must be a string"
+    for name in ('name', 'account'):
+        if (name in fields or not partial) and not (fields.get(name) or '').strip():
+            return None, f"{name} is required"
+    if partial and not fields:
+        return None, "no fields to update"
+    return fields, None
+
+def validate_interaction(data, customer_id=None):
+    if not isinstance(data, dict):
+        return None, "expected an object"
+    unknown = set(data) - {'customer_id', 'note', 'date'}
+    if unknown:
+        return None, f"unknown fields: {', '.join(sorted(unknown))}"
+    customer_id = customer_id or data.get('customer_id')
+    if not isinstance(customer_id, int):
+        return None, "customer_id must be an integer"
+    if not isinstance(data.get('note'), str) or not data['note'].strip():
+        return None, "note is required"
+    if data.get('date') is not None:
+        try:
+            datetime.fromisoformat(data['date'])
+        except (TypeError, ValueError):
+            return None, "date must be an ISO 8601 timestamp"
+    return {'customer_id': customer_id, 'note': data['note'], 'date': data.get('date')}, None
+
+def validate_batch(items, validate):
+    if not isinstance(items, list):
+        return None, api_error("expected a list", 400)
+    if len(items) > API_BATCH_MAX:
+        return None, api_error(f"at most {API_BATCH_MAX} items per request", 413)
+    valid, errors = [], []
+    for index, item in enumerate(items):
+        fields, error = validate(item)
+        if error:
+            errors.append({"index": index, "error": error})
+        valid.append(fields)
+    if errors:
+        return None, api_error("validation failed", 400, errors=errors)
+    return valid, None
+
+def api_limit():
+    return min(max(request.args.get('limit', API_PAGE_SIZE, type=int), 1), API_MAX_PAGE_SIZE)
+
+@app.route(f'{API_PREFIX}/customers', methods=['GET'])
+def api_list_customers():
+    search_query = request.args.get('search', '')
+    sort = request.args.get('sort')
+    if sort and sort not in SORT_COLUMNS:
+        return api_error(f"sort must be one of: {', '.join(SORT_COLUMNS)}", 400)
+    cursor_token = request.args.get('after')
+    after = decode_cursor(cursor_token) if cursor_token else None
+    if cursor_token and after is None:
+        return api_error("invalid cursor", 400)
+    cur = get_db().cursor()
+    rows, next_cursor = list_customers(cur, search_query, sort, request.args.get('dir'), after, api_limit())
+    ids = [row[0] for row in rows]
+    customers = {}
+    if ids:
+        cur.execute(f"SELECT id, name, account, email, phone, created_at, updated_at FROM customers WHERE id IN ({','.join('?' * len(ids))})", ids)
+        customers = {row[0]: customer_json(row) for row in cur.fetchall()}
+    return api_json({"customers": [customers[i] for i in ids if i in customers], "next": next_cursor})
+
+@app.route(f'{API_PREFIX}/customers', methods=['POST'])
+def api_create_customers():
+    data = request.get_json(silent=True)
+    single = isinstance(data, dict)
+    items, error = validate_batch([data] if single else data, validate_customer)
+    if error:
+        return error
+    conn = get_db()
+    with conn:
+        cur = conn.cursor()
+        ids = [create_customer(cur, **fields) for fields in items]
     cur = conn.cursor()
-    cur.execute('SELECT id, name, account, email, phone, created_at, updated_at FROM customers')
-    customers = cur.fetchall()
-    conn.close()
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['ID', 'Name', 'Account', 'Email', 'Phone', 'Created At', 'Updated At'])
-    writer.writerows(customers)
-    output.seek(0)
-    return send_file(io.BytesIO(output.getvalue().encode()), mimetype='text/csv', as_attachment=True, download_name='customers.csv')
+    created = [get_customer_json(cur, customer_id) for customer_id in ids]
+    if single:
+        response = api_json(created[0], 201)
+        response.headers['Location'] = url_for('api_get_customer', customer_id=ids[0])
+        return response
+    return api_json({"customers": created}, 201)
+
+@app.route(f'{API_PREFIX}/customers/<int:customer_id>', methods=['GET'])
+def api_get_customer(customer_id):
+    customer = get_customer_json(get_db().cursor(), customer_id)
+    if not customer:
+        return api_error("customer not found", 404)
+    return api_json(customer)
+
+@app.route(f'{API_PREFIX}/customers/<int:customer_id>', methods=['PATCH'])
+def api_update_customer(customer_id):
+    fields, error = validate_customer(request.get_json(silent=True), partial=True)
+    if error:
+        return api_error(error, 400)
+    conn = get_db()
+    with conn:
+        cur = conn.cursor()
+        current = get_customer_json(cur, customer_id)
+        if not current:
+            return api_error("customer not found", 404)
+        if api_precondition_failed(current):
+            return api_error("customer was modified", 412)
+        update_customer(cur, customer_id, fields)
+    return api_json(get_customer_json(conn.cursor(), customer_id))
+
+@app.route(f'{API_PREFIX}/customers/<int:customer_id>', methods=['DELETE'])
+def api_delete_customer(customer_id):
+    conn = get_db()
+    with conn:
+        cur = conn.cursor()
+        current = get_customer_json(cur, customer_id)
+        if not current:
+            return api_error("customer not found", 404)
+        if api_precondition_failed(current):
+            return api_error("customer was modified", 412)
+        delete_customer(cur, customer_id)
+    return '', 204
+
+@app.route(f'{API_PREFIX}/customers/<int:customer_id>/duplicates', methods=['GET'])
+def api_customer_duplicates(customer_id):
+    cur = get_db().cursor()
+    if not get_customer_json(cur, customer_id):
+        return api_error("customer not found", 404)
+    matches = find_duplicates(cur, customer_id)
+    return api_json({"duplicates": [{"id": row[0], "score": round(score, 3)} for score, row in matches]})
+
+@app.route(f'{API_PREFIX}/customers/<int:customer_id>/merge', methods=['POST'])
+def api_merge_customer(customer_id):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or set(data) != {'duplicate_id'} or not isinstance(data['duplicate_id'], int):
+        return api_error("expected an object with an integer duplicate_id", 400)
+    conn = get_db()
+    with conn:
+        moved = merge_customers(conn.cursor(), customer_id, data['duplicate_id'])
+        if moved is None:
+            return api_error("customers not found", 404)
+    return api_json({"customer": get_customer_json(conn.cursor(), customer_id), "moved_interactions": moved})
+
+@app.route(f'{API_PREFIX}/customers/batch', methods=['POST'])
+def api_batch_customers():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or set(data) - {'create', 'update', 'delete'}:
+        return api_error("expected an object with create, update and/or delete lists", 400)
+    creates, error = validate_batch(data.get('create', []), validate_customer)
+    if error:
+        return error
+    updates, error = validate_batch(data.get('update', []), lambda item: validate_customer(item, partial=True))
+    if error:
+        return error
+    update_ids = [item.get('id') for item in data.get('update', [])]
+    deletes = data.get('delete', [])
+    if not all(isinstance(i, int) for i in update_ids) or not isinstance(deletes, list) or not all(isinstance(i, int) for i in deletes):
+        return api_error("update items need an integer id and delete must be a list of ids", 400)
+    if len(creates) + len(updates) + len(deletes) > API_BATCH_MAX:
+        return api_error(f"at most {API_BATCH_MAX} items per request", 413)
+    conn = get_db()
+    with conn:
+        cur = conn.cursor()
+        created = [create_customer(cur, **fields) for fields in creates]
+        missing = [i for i, fields in zip(update_ids, updates) if not update_customer(cur, i, fields)]
+        missing += [i for i in deletes if not delete_customer(cur, i)]
+        if missing:
+            conn.rollback()
+            return api_error("customers not found", 404, ids=missing)
+    return api_json({"created": created, "updated": update_ids, "deleted": deletes})
+
+@app.route(f'{API_PREFIX}/customers/<int:customer_id>/interactions', methods=['GET'])
+def api_list_interactions(customer_id):
+    cur = get_db().cursor()
+    if not get_customer_json(cur, customer_id):
+        return api_error("customer not found", 404)
+    cursor_token = request.args.get('after')
+    after = decode_cursor(cursor_token) if cursor_token else None
+    if cursor_token and after is None:
+        return api_error("invalid cursor", 400)
+    rows, next_cursor = list_interactions(cur, customer_id, after, api_limit())
+    return api_json({"interactions": [interaction_json((row[0], customer_id, row[1], row[2])) for row in rows], "next": next_cursor})
+
+@app.route(f'{API_PREFIX}/customers/<int:customer_id>/interactions', methods=['POST'])
+def api_create_interactions(customer_id):
+    data = request.get_json(silent=True)
+    single = isinstance(data, dict)
+    items, error = validate_batch([data] if single else data, lambda item: validate_interaction(item, customer_id))
+    if error:
+        return error
+    conn = get_db()
+    with conn:
+        cur = conn.cursor()
+        if not get_customer_json(cur, customer_id):
+            return api_error("customer not found", 404)
+        ids = [add_interaction(cur, customer_id, item['note'], item['date']) for item in items]
+    cur = conn.cursor()
+    created = [get_interaction_json(cur, i) for i in ids]
+    if single:
+        return api_json(created[0], 201)
+    return api_json({"interactions": created}, 201)
+
+@app.route(f'{API_PREFIX}/interactions/<int:interaction_id>', methods=['GET'])
+def api_get_interaction(interaction_id):
+    interaction = get_interaction_json(get_db().cursor(), interaction_id)
+    if not interaction:
+        return api_error("interaction not found", 404)
+    return api_json(interaction)
+
+@app.route(f'{API_PREFIX}/interactions/<int:interaction_id>', methods=['PATCH'])
+def api_update_interaction(interaction_id):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not data or set(data) - {'note', 'date'}:
+        return api_error("expected an object with note and/or date", 400)
+    conn = get_db()
+    with conn:
+        cur = conn.cursor()
+        current = get_interaction_json(cur, interaction_id)
+        if not current:
+            return api_error("interaction not found", 404)
+        # A missing or null date keeps the current one rather than clearing it.
+        date = data['date'] if data.get('date') is not None else current['date']
+        fields, error = validate_interaction({'note': data.get('note', current['note']), 'date': date}, current['customer_id'])
+        if error:
+            return api_error(error, 400)
+        if api_precondition_failed(current):
+            return api_error("interaction was modified", 412)
+        cur.execute('UPDATE interactions SET note = ?, date = ? WHERE id = ?', (fields['note'], fields['date'], interaction_id))
+        invalidate_insight(cur, current['customer_id'])
+    return api_json(get_interaction_json(conn.cursor(), interaction_id))
+
+@app.route(f'{API_PREFIX}/interactions/<int:interaction_id>', methods=['DELETE'])
+def api_delete_interaction(interaction_id):
+    conn = get_db()
+    with conn:
+        cur = conn.cursor()
+        current = get_interaction_json(cur, interaction_id)
+        if not current:
+            return api_error("interaction not found", 404)
+        if api_precondition_failed(current):
+            return api_error("interaction was modified", 412)
+        remove_interaction(cur, interaction_id)
+    return '', 204
+
+@app.route(f'{API_PREFIX}/interactions/batch', methods=['POST'])
+def api_batch_interactions():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or set(data) - {'create', 'delete'}:
+        return api_error("expected an object with create and/or delete lists", 400)
+    creates, error = validate_batch(data.get('create', []), validate_interaction)
+    if error:
+        return error
+    deletes = data.get('delete', [])
+    if not isinstance(deletes, list) or not all(isinstance(i, int) for i in deletes):
+        return api_error("delete must be a list of ids", 400)
+    if len(creates) + len(deletes) > API_BATCH_MAX:
+        return api_error(f"at most {API_BATCH_MAX} items per request", 413)
+    conn = get_db()
+    with conn:
+        cur = conn.cursor()
+        customer_ids = sorted({item['customer_id'] for item in creates})
+        if customer_ids:
+            cur.execute(f"SELECT id FROM customers WHERE id IN ({','.join('?' * len(customer_ids))})", customer_ids)
+            missing = sorted(set(customer_ids) - {row[0] for row in cur.fetchall()})
+            if missing:
+                return api_error("customers not found", 404, ids=missing)
+        created = [add_interaction(cur, item['customer_id'], item['note'], item['date']) for item in creates]
+        missing = [i for i in deletes if not remove_interaction(cur, i)]
+        if missing:
+            conn.rollback()
+            return api_error("interactions not found", 404, ids=missing)
+    return api_json({"created": created, "deleted": deletes})
+
+# Templates live in this module and are served by name from a DictLoader.
+# Jinja compiles each one once, here at import, and keeps the compiled
+# template in its cache; render_template_string would re-parse on every call.
+TEMPLATES = {
+    'api_key.html': API_KEY_TEMPLATE,
+    'home.html': HOME_TEMPLATE,
+    'customer_rows.html': CUSTOMER_ROWS_TEMPLATE,
+    'stream_markdown.html': STREAM_MARKDOWN_TEMPLATE,
+    'edit.html': EDIT_TEMPLATE,
+    'interactions.html': INTERACTIONS_TEMPLATE,
+    'insight.html': INSIGHT_TEMPLATE,
+    'custom_insight.html': CUSTOM_INSIGHT_TEMPLATE,
+    'interaction_rows.html': INTERACTION_ROWS_TEMPLATE,
+    'duplicates.html': DUPLICATES_TEMPLATE,
+}
+app.jinja_loader = DictLoader(TEMPLATES)
+for template_name in TEMPLATES:
+    app.jinja_env.get_template(template_name)
+
+# Serving. gunicorn runs the app as SERVER_WORKERS processes with
+# SERVER_THREADS threads each (`gunicorn 'app:create_app()'` works too). The
+# schema is migrated once before the workers start; every process then opens
+# its own WAL connections. State that must not be shared across a fork -
+# connections, the Groq client, job threads, locks - is rebuilt in the child.
+SERVER_HOST = '0.0.0.0'
+SERVER_PORT = 5000
+SERVER_WORKERS = os.cpu_count() or 1
+SERVER_THREADS = 4
+SERVER_TIMEOUT = 120
+SERVER_GRACEFUL_TIMEOUT = 30
+
+def create_app(database=None):
+    global DB, _schema_ready
+    if database and database != DB:
+        close_db()
+        DB, _schema_ready = database, False
+    ensure_schema()
+    return app
+
+def _reset_after_fork():
+    global _local, _schema_lock, _llm_lock, _llm_client, _llm_client_key, _llm_slots
+    global _job_executor, _job_queue_slots, _running_batches, _config_cache
+    global _metrics_lock, _histograms, _counters, _metrics_flusher, _write_queue
+    # The parent's SQLite connections and httpx pool must not be used here;
+    # drop them without closing, and replace locks another thread may have held.
+    _local = threading.local()
+    _schema_lock = threading.Lock()
+    _llm_lock = threading.Lock()
+    _llm_client = _llm_client_key = None
+    _llm_slots = {}
+    _job_executor = None
+    _write_queue = None
+    _job_queue_slots = threading.BoundedSemaphore(LLM_JOB_QUEUE_LIMIT)
+    _running_batches = set()
+    _config_cache = {}
+    # Counters start from zero in each worker; the parent's are in its own snapshot.
+    _metrics_lock = threading.Lock()
+    _histograms, _counters = {}, {}
+    _metrics_flusher = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def run_server(host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS, threads=SERVER_THREADS):
+    global METRICS_DIR
+    create_app()
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        # gunicorn does not run on Windows; serve from one threaded process there.
+        app.run(host=host, port=port, threaded=True)
+        return
+    metrics_dir = None
+    if not METRICS_DIR:
+        METRICS_DIR = metrics_dir = tempfile.mkdtemp(prefix='crm-metrics-')
+
+    class CRMServer(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'{host}:{port}')
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('timeout', SERVER_TIMEOUT)
+            self.cfg.set('graceful_timeout', SERVER_GRACEFUL_TIMEOUT)
+            self.cfg.set('post_fork', lambda server, worker: start_metrics_flusher())
+            self.cfg.set('worker_exit', lambda server, worker: flush_metrics())
+            if metrics_dir:
+                self.cfg.set('on_exit', lambda server: shutil.rmtree(metrics_dir, ignore_errors=True))
+
+        def load(self):
+            return create_app()
+
+    CRMServer().run()
+
+@app.cli.command('serve', with_appcontext=False)
+@click.option('--host', envvar='CRM_HOST', default=SERVER_HOST, show_default=True)
+@click.option('--port', envvar='CRM_PORT', type=int, default=SERVER_PORT, show_default=True)
+@click.option('--workers', envvar='CRM_WORKERS', type=click.IntRange(1), default=SERVER_WORKERS, show_default=True, help='Worker processes.')
+@click.option('--threads', envvar='CRM_THREADS', type=click.IntRange(1), default=SERVER_THREADS, show_default=True, help='Threads per worker.')
+@click.option('--debug', is_flag=True, help='Single-process development server with the reloader and debugger.')
+def serve_command(host, port, workers, threads, debug):
+    """Run the app with a multi-process production server.
+
+    SIGHUP replaces the workers gracefully. SIGUSR2 starts a new master on
+    the current code next to the old one, which then takes SIGTERM and exits
+    once its requests in flight have finished.
+    """
+    if debug:
+        create_app()
+        app.run(host=host, port=port, debug=True)
+    else:
+        run_server(host, port, workers, threads)
 
 if __name__ == '__main__':
-    # Note: Port 80 requires root privileges (sudo) on most systems. If you encounter a "Permission denied" error, try a higher port like 5000 (e.g., app.run(host='0.0.0.0', port=5000, debug=True)).
-    app.run(host='0.0.0.0', port=80, debug=True)
+    serve_command.main(prog_name='python app.py')
@@ -0,0 +1,1345 @@
+"""Benchmarks for the CRM app.
+
+Every mode seeds a throwaway database first. Run the same mode on two commits
+to compare them.
+
+    python bench.py routes --customers 2000 --requests 400 --threads 4
+    python bench.py search --customers 1000000
+    python bench.py export --customers 2000000
+    python bench.py import --customers 1000000
+    python bench.py render --repeat 200
+    python bench.py llm --calls 200
+    python bench.py chat --sizes 100,10000,1000000
+    python bench.py stream --token-delay 20
+    python bench.py jobs --workers 4 --chats 16
+    python bench.py batch --customers 200 --workers 1,4,8
+    python bench.py markdown --lines 20,2000,20000
+    python bench.py history --messages 200000
+    python bench.py session --turns 20
+    python bench.py api --changes 800 --batch 100
+    python bench.py timeline --notes 50000
+    python bench.py serve --workers 1,2,4 --clients 8
+    python bench.py metrics --customers 100000
+    python bench.py summary --customers 100000
+    python bench.py writes --threads 16 --writes 4000
+    python bench.py dedup --customers 100000 --duplicates 2000
+    python bench.py generate --scale 100k --out crm-100k.db
+    python bench.py suite --scales 10k,100k,1m --workers 1,4 --out before.json
+    python bench.py compare before.json after.json --threshold 10
+"""
+import argparse
+import csv
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+import json
+import platform
+import shutil
+import http.client
+import socket
+import subprocess
+import sys
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta
+
+import app as crm
+
+FIRST_NAMES = ['James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael', 'Linda', 'David', 'Elena',
+               'Wei', 'Aisha', 'Carlos', 'Yuki', 'Olga', 'Kwame', 'Priya', 'Lars', 'Fatima', 'Mateo']
+LAST_NAMES = ['Smith', 'Johnson', 'Garcia', 'Brown', 'Nguyen', 'Patel', 'Kim', 'Muller', 'Rossi', 'Silva',
+              'Okafor', 'Ivanova', 'Tanaka', 'Haddad', 'Novak', 'Larsen', 'Cohen', 'Dubois', 'Kowalski', 'Walker']
+COMPANIES = ['Acme', 'Globex', 'Initech', 'Umbrella', 'Stark', 'Wayne', 'Hooli', 'Vandelay', 'Wonka', 'Tyrell']
+NOTE_TEMPLATES = ['Call with {name} about the {product} renewal', 'Sent {product} pricing to {name}',
+                  '{name} asked for a {product} demo next week', 'Support ticket: {product} sync failing for {name}',
+                  'Quarterly review with {name}, happy with {product}', '{name} is evaluating a competitor to {product}',
+                  'Invoice for {product} overdue, reminded {name}', 'Met {name} at the conference, interested in {product}']
+PRODUCTS = ['Analytics', 'Billing', 'CRM Pro', 'Data Sync', 'Helpdesk', 'Mobile', 'Reporting', 'Storage']
+CHAT_TEMPLATES = ['What should I do next with {name}?', 'Summarize recent activity for {name}',
+                  'Which customers asked about {product}?', 'Draft a follow-up email to {name} about {product}']
+
+# Synthetic data for the suite. Output depends only on the arguments and
+# GENERATOR_VERSION, so generated databases are cached and reused by scale.
+GENERATOR_VERSION = 1
+GENERATOR_EPOCH = datetime(2025, 1, 1)
+SCALES = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000}
+
+
+def seed(customers, notes_per_customer=0):
+    crm.init_db()
+    rng = random.Random(42)
+    conn = sqlite3.connect(crm.DB)
+    now = datetime.now().isoformat()
+
+    def customer_rows():
+        for i in range(customers):
+            first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            company = rng.choice(COMPANIES)
+            yield (f'{first} {last}', f'{company}-{i:07d}', f'{first.lower()}.{last.lower()}{i}@{company.lower()}.com',
+                   f'+1 ({rng.randint(200, 999)}) {rng.randint(200, 999)}-{i % 10000:04d}', now, now)
+
+    conn.executemany(
+        'INSERT INTO customers (name, account, email, phone, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+        customer_rows())
+    conn.executemany(
+        'INSERT INTO interactions (customer_id, date, note) VALUES (?, ?, ?)',
+        ((c, now, f'Follow-up call {n} with customer {c}')
+         for c in range(1, customers + 1) for n in range(notes_per_customer)))
+    conn.execute('INSERT OR REPLACE INTO config (key, value) VALUES ("groq_api_key", "bench")')
+    conn.commit()
+    conn.close()
+
+
+def generate(customers, notes_per_customer=5, chats=None, seed_value=42):
+    # Customers joined over three years; each has an exponentially distributed
+    # number of notes (mean notes_per_customer) dated after it joined, and
+    # chat_history gets `chats` messages (customers // 10 by default) from the last year.
+    crm.init_db()
+    rng = random.Random(seed_value)
+    conn = sqlite3.connect(crm.DB)
+    conn.execute('PRAGMA synchronous=OFF')
+    joined = {}
+
+    def customer_rows():
+        for i in range(customers):
+            first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            company = rng.choice(COMPANIES)
+            created = GENERATOR_EPOCH - timedelta(seconds=rng.randrange(3 * 365 * 86400))
+            joined[i + 1] = created
+            yield (f'{first} {last}', f'{company}-{i:07d}', f'{first.lower()}.{last.lower()}{i}@{company.lower()}.com',
+                   f'+1 ({rng.randint(200, 999)}) {rng.randint(200, 999)}-{i % 10000:04d}',
+                   created.isoformat(), created.isoformat())
+
+    def note_rows():
+        for customer_id, created in joined.items():
+            span = max(1, int((GENERATOR_EPOCH - created).total_seconds()))
+            for _ in range(min(int(rng.expovariate(1 / notes_per_customer)) if notes_per_customer else 0, 50 * notes_per_customer)):
+                note = rng.choice(NOTE_TEMPLATES).format(name=rng.choice(FIRST_NAMES), product=rng.choice(PRODUCTS))
+                yield customer_id, (created + timedelta(seconds=rng.randrange(span))).isoformat(), note
+
+    def chat_rows():
+        for _ in range(customers // 10 if chats is None else chats):
+            question = rng.choice(CHAT_TEMPLATES).format(name=rng.choice(FIRST_NAMES), product=rng.choice(PRODUCTS))
+            yield (question, f'<p>Follow up about <strong>{rng.choice(PRODUCTS)}</strong> this week.</p>',
+                   (GENERATOR_EPOCH - timedelta(seconds=rng.randrange(365 * 86400))).isoformat())
+
+    with conn:
+        conn.executemany('INSERT INTO customers (name, account, email, phone, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                         customer_rows())
+        conn.executemany('INSERT INTO interactions (customer_id, date, note) VALUES (?, ?, ?)', note_rows())
+        conn.executemany('INSERT INTO chat_history (user_message, ai_response, timestamp) VALUES (?, ?, ?)', chat_rows())
+        conn.execute('INSERT OR REPLACE INTO config (key, value) VALUES ("groq_api_key", "bench")')
+    conn.close()
+
+
+def use_generated_db(scale, args):
+    # Generates the scale once into args.data_dir, then gives each run a fresh copy.
+    customers = SCALES[scale]
+    os.makedirs(args.data_dir, exist_ok=True)
+    cached = os.path.join(args.data_dir, f'crm-{scale}-n{args.notes}-s{args.seed}-v{GENERATOR_VERSION}.db')
+    if not os.path.exists(cached):
+        start = time.perf_counter()
+        crm.DB = cached + '.tmp'
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(crm.DB + suffix):
+                os.remove(crm.DB + suffix)
+        generate(customers, args.notes, None, args.seed)
+        os.replace(crm.DB, cached)
+        print(f'generated {scale} in {time.perf_counter() - start:.0f}s: {cached}')
+    crm.close_db()
+    crm._schema_ready = False
+    use_temp_db()
+    shutil.copyfile(cached, crm.DB)
+    return customers
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    """OpenAI-compatible /chat/completions endpoint with a canned answer."""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    reply = '## Overview\n- **Call** the customer this week.\n- Offer the annual plan.'
+    latency = 0.0
+    token_delay = 0.0
+    rate_limit = 0.0
+    fail_after = None  # streamed tokens before an error event, None for no error
+    connections = 0
+    rate_limited = 0
+    last_prompt = ''
+    prompts = []
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        type(self).last_prompt = '\n'.join(m.get('content', '') for m in request.get('messages', []))
+        self.prompts.append(self.last_prompt)
+        time.sleep(self.latency)
+        if random.random() < self.rate_limit:
+            return self.too_many_requests()
+        if request.get('stream'):
+            return self.stream_reply()
+        # A non-streaming reply costs the same generation time, paid up front.
+        time.sleep(self.token_delay * len(self.reply.split(' ')))
+        body = json.dumps({
+            'id': 'stub', 'object': 'chat.completion', 'created': int(time.time()), 'model': 'stub',
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': self.reply}}],
+            'usage': {'prompt_tokens': 100, 'completion_tokens': 20, 'total_tokens': 120},
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def too_many_requests(self):
+        type(self).rate_limited += 1
+        body = json.dumps({'error': {'message': 'Rate limit reached', 'type': 'requests', 'code': 'rate_limit_exceeded'}}).encode()
+        self.send_response(429)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Retry-After', '0.05')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream_reply(self):
+        # Streams the reply word by word as OpenAI-style SSE chunks, then closes.
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        for n, token in enumerate(self.reply.split(' ')):
+            if n == self.fail_after:
+                error = {'error': {'message': 'stub failure mid-stream', 'type': 'server_error'}}
+                self.wfile.write(f'data: {json.dumps(error)}\n\n'.encode())
+                return
+            chunk = {'id': 'stub', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': 'stub',
+                     'choices': [{'index': 0, 'delta': {'content': token + ' '}, 'finish_reason': None}]}
+            self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+            self.wfile.flush()
+            time.sleep(self.token_delay)
+        self.wfile.write(b'data: [DONE]\n\n')
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_llm(latency_ms=0, token_delay_ms=0, rate_limit=0.0):
+    StubLLMHandler.latency = latency_ms / 1000
+    StubLLMHandler.token_delay = token_delay_ms / 1000
+    StubLLMHandler.rate_limit = rate_limit
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubLLMHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # The Groq SDK reads its base URL from the environment when a client is built.
+    os.environ['GROQ_BASE_URL'] = f'http://127.0.0.1:{server.server_port}'
+    return server
+
+
+def use_temp_db():
+    workdir = tempfile.mkdtemp(prefix='crm-bench-')
+    crm.DB = os.path.join(workdir, 'bench.db')
+
+
+def run(method, path, requests, threads, data=None):
+    per_thread = max(1, requests // threads)
+    errors = []
+
+    def worker():
+        client = crm.app.test_client()
+        for _ in range(per_thread):
+            resp = client.open(path, method=method, data=data)
+            # Streamed routes only produce their body when it is read, and
+            # closing the response tears down the generator's app context.
+            resp.get_data()
+            resp.close()
+            if resp.status_code >= 400:
+                errors.append(resp.status_code)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return per_thread * threads / elapsed, len(errors)
+
+
+ROUTES = [
+    ('GET', '/', None),
+    ('GET', '/?search=Garcia', None),
+    ('POST', '/add', {'name': 'Bench', 'account': 'ACC-BENCH', 'email': 'b@example.com', 'phone': '555'}),
+    ('GET', '/edit/1', None),
+    ('GET', '/interactions/1', None),
+    ('POST', '/interactions/1', {'note': 'bench note'}),
+    ('GET', '/export', None),
+]
+
+
+def bench_routes(args):
+    use_temp_db()
+    seed(args.customers, args.notes)
+    print(f'{"route":<28}{"req/s":>10}{"errors":>8}')
+    for method, path, data in ROUTES:
+        rps, errors = run(method, path, args.requests, args.threads, data)
+        print(f'{method + " " + path:<28}{rps:>10.1f}{errors:>8}')
+
+
+LIKE_SQL = ('SELECT id, name, account, email, phone, created_at FROM customers '
+            'WHERE name LIKE ? OR account LIKE ? OR email LIKE ? OR phone LIKE ? ORDER BY id DESC')
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        rows = fn()
+    return (time.perf_counter() - start) / repeat * 1000, len(rows)
+
+
+def bench_search(args):
+    use_temp_db()
+    start = time.perf_counter()
+    seed(args.customers)
+    print(f'seeded {args.customers} customers in {time.perf_counter() - start:.1f}s')
+    cur = crm.get_db().cursor()
+    queries = ['Tanaka', 'olga.novak', 'Umbrella-00042', '555', '(312) 4', 'zzzz']
+    print(f'{"query":<18}{"LIKE ms":>10}{"rows":>9}{"FTS ms":>10}{"rows":>9}')
+    for q in queries:
+        pattern = f'%{q}%'
+        like_ms, like_rows = timed(lambda: cur.execute(LIKE_SQL, (pattern,) * 4).fetchall(), args.repeat)
+        fts_ms, fts_rows = timed(lambda: crm.list_customers(cur, q, limit=args.customers)[0], args.repeat)
+        print(f'{q:<18}{like_ms:>10.2f}{like_rows:>9}{fts_ms:>10.2f}{fts_rows:>9}')
+
+
+def bench_export(args):
+    use_temp_db()
+    seed(args.customers, args.notes)
+    client = crm.app.test_client()
+    print(f'{"export":<32}{"TTFB ms":>10}{"total s":>10}{"MB":>10}{"peak MB":>10}')
+    for path in ['/export', '/export?gzip=1', '/export/interactions']:
+        tracemalloc.start()
+        start = time.perf_counter()
+        resp = client.get(path, buffered=False)
+        first_byte, size = None, 0
+        for chunk in resp.response:
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            size += len(chunk)
+        resp.close()
+        total = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f'{path:<32}{first_byte * 1000:>10.1f}{total:>10.2f}{size / 1e6:>10.1f}{peak / 1e6:>10.1f}')
+
+
+def bench_import(args):
+    use_temp_db()
+    crm.init_db()
+    rng = random.Random(42)
+    path = os.path.join(os.path.dirname(crm.DB), 'import.csv')
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ID', 'Name', 'Account', 'Email', 'Phone', 'Created At', 'Updated At'])
+        for i in range(args.customers):
+            first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            # Roughly 1% of rows repeat an earlier email to exercise deduplication.
+            n = rng.randrange(i) if i and rng.random() < 0.01 else i
+            writer.writerow([i + 1, f'{first} {last}', f'ACC-{i:07d}', f'{first.lower()}{n}@example.com',
+                             f'555-{i % 10000:04d}', '', ''])
+    with open(path, 'rb') as stream:
+        report = crm.import_customers(stream, 'csv')
+    print(f"imported {report['imported']} rows in {report['seconds']}s ({report['rows_per_sec']} rows/s), "
+          f"{report['duplicates']} duplicates, {report['rejected']} rejected")
+
+
+def bench_render(args):
+    from flask import render_template, render_template_string
+
+    now = datetime.now().isoformat()
+    customers = [(i, f'Customer {i}', f'ACC-{i:07d}', f'c{i}@example.com', '555-0100', now, i)
+                 for i in range(crm.PAGE_SIZE, 0, -1)]
+    context = dict(
+        customers=customers, next_url='/?after=x', search_query='', chat_history=[('Hi', '<p>Hello</p>', now)] * 5,
+        sort_headers=crm.SORT_HEADERS, sort='id', direction='desc', per_page=crm.PAGE_SIZE, page_size=crm.PAGE_SIZE,
+        name='Customer 1', account='ACC-0000001', email='c1@example.com', phone='555-0100', customer_id=1,
+        interactions=[(i, now, f'Note {i}') for i in range(20)], insight='<h2>Overview</h2>' * 10,
+        raw_insight='## Overview', query='What next?', response='<p>Call them.</p>',
+    )
+    print(f'{"template":<22}{"string ms":>11}{"compiled ms":>13}')
+    with crm.app.test_request_context('/'):
+        for name, source in crm.TEMPLATES.items():
+            string_ms, _ = timed(lambda: [render_template_string(source, **context)], args.repeat)
+            compiled_ms, _ = timed(lambda: [render_template(name, **context)], args.repeat)
+            print(f'{name:<22}{string_ms:>11.3f}{compiled_ms:>13.3f}')
+
+
+def bench_llm(args):
+    import httpx
+    from groq import Groq
+
+    start_stub_llm(args.latency)
+    messages = [{'role': 'user', 'content': 'Suggest a next step for customer 1.'}]
+
+    def per_request_client():
+        client = Groq(api_key='bench', http_client=httpx.Client())
+        return client.chat.completions.create(model='llama3-70b-8192', messages=messages)
+
+    def shared_client():
+        return crm.get_llm_client('bench').chat.completions.create(model='llama3-70b-8192', messages=messages)
+
+    print(f'{"client":<22}{"ms/call":>10}{"connections":>13}')
+    for label, call in [('new client per call', per_request_client), ('shared client', shared_client)]:
+        StubLLMHandler.connections = 0
+        start = time.perf_counter()
+        for _ in range(args.calls):
+            call()
+        elapsed = time.perf_counter() - start
+        print(f'{label:<22}{elapsed / args.calls * 1000:>10.2f}{StubLLMHandler.connections:>13}')
+
+
+def bench_chat(args):
+    start_stub_llm(args.latency)
+    client = crm.app.test_client()
+    messages = ['What should I do next with Olga Novak?', 'Summarize the Acme accounts', 'How do I export data?']
+    print(f'{"customers":>10}{"full dump tokens":>18}{"prompt tokens":>15}{"ms/chat":>10}')
+    for size in (int(n) for n in args.sizes.split(',')):
+        use_temp_db()
+        seed(size, args.notes)
+        conn = crm.get_db()
+        # What the prompt used to embed: one line per customer in the table.
+        full_dump = sum(len(f"ID: {c[0]}, Name: {c[1]}, Account: {c[2]}, Email: {c[3] or 'N/A'}, Phone: {c[4] or 'N/A'}") + 1
+                        for c in conn.execute('SELECT id, name, account, email, phone FROM customers'))
+        prompt_tokens, start = 0, time.perf_counter()
+        for message in messages:
+            client.post('/chat', json={'message': message})
+            prompt_tokens += crm.estimate_tokens(StubLLMHandler.last_prompt)
+        elapsed = (time.perf_counter() - start) / len(messages)
+        print(f'{size:>10}{full_dump // 4:>18}{prompt_tokens // len(messages):>15}{elapsed * 1000:>10.1f}')
+        crm.close_db()
+
+
+def bench_stream(args):
+    start_stub_llm(args.latency, args.token_delay)
+    StubLLMHandler.reply = ' '.join(['- **Step**: follow up on the renewal.\n'] * 25)
+    use_temp_db()
+    seed(1000, 2)
+    client = crm.app.test_client()
+    body = {'message': 'What should I do next with Olga Novak?'}
+    print(f'{"endpoint":<16}{"first byte ms":>15}{"first token ms":>16}{"total ms":>10}')
+    for path in ['/chat', '/chat/stream']:
+        start = time.perf_counter()
+        resp = client.post(path, json=body, buffered=False)
+        first_byte = first_token = None
+        for chunk in resp.response:
+            now = time.perf_counter() - start
+            first_byte = first_byte if first_byte is not None else now
+            if first_token is None and (b'"response"' in chunk or b'event: delta' in chunk or b'event: html' in chunk):
+                first_token = now
+        resp.close()
+        total = time.perf_counter() - start
+        print(f'{path:<16}{first_byte * 1000:>15.1f}{(first_token or total) * 1000:>16.1f}{total * 1000:>10.1f}')
+
+
+def bench_jobs(args):
+    # A fixed pool of request workers, like a sync WSGI server, serves a burst
+    # of AI chats and a stream of CRUD page loads at the same time.
+    start_stub_llm(args.latency, rate_limit=args.rate_limit)
+    use_temp_db()
+    seed(1000, 2)
+    crm.set_api_key('bench')
+    print(f'{"/chat mode":<12}{"chat ms":>10}{"crud p50 ms":>13}{"crud p95 ms":>13}{"crud max ms":>13}{"429s":>6}')
+    for mode in ['blocking', 'async']:
+        StubLLMHandler.rate_limited = 0
+        pool = ThreadPoolExecutor(max_workers=args.workers)
+
+        def chat():
+            client = crm.app.test_client()
+            resp = client.post('/chat', json={'message': 'What should I do next with Olga Novak?', 'async': mode == 'async'})
+            return resp.get_json().get('status_url')
+
+        def crud(queued_at):
+            # Latency includes the time spent waiting for a free worker.
+            crm.app.test_client().get('/edit/1')
+            return time.perf_counter() - queued_at
+
+        start = time.perf_counter()
+        chats = [pool.submit(chat) for _ in range(args.chats)]
+        cruds = [pool.submit(crud, time.perf_counter()) for _ in range(args.crud)]
+        status_urls = [f.result() for f in chats]
+        client = crm.app.test_client()
+        while any(url and client.get(url).get_json()['status'] in ('queued', 'running') for url in status_urls):
+            time.sleep(0.01)
+        chat_ms = (time.perf_counter() - start) * 1000
+        latencies = sorted(f.result() * 1000 for f in cruds)
+        pool.shutdown()
+        print(f'{mode:<12}{chat_ms:>10.0f}{latencies[len(latencies) // 2]:>13.1f}'
+              f'{latencies[int(len(latencies) * 0.95)]:>13.1f}{latencies[-1]:>13.1f}{StubLLMHandler.rate_limited:>6}')
+
+
+def bench_batch(args):
+    start_stub_llm(args.latency)
+    print(f'{"workers":>8}{"rpm":>6}{"tpm":>7}{"insights":>10}{"seconds":>9}{"per min":>9}{"tokens":>8}{"tokens/min":>12}')
+    for workers in (int(n) for n in args.workers.split(',')):
+        use_temp_db()
+        seed(args.customers, args.notes)
+        crm.set_api_key('bench')
+        batch_id = crm.create_insight_batch()
+        start = time.perf_counter()
+        crm.run_insight_batch(batch_id, workers, args.rpm, args.tpm)
+        elapsed = time.perf_counter() - start
+        batch = crm.get_insight_batch(batch_id)
+        print(f'{workers:>8}{args.rpm:>6}{args.tpm:>7}{batch["counts"]["done"]:>10}{elapsed:>9.1f}'
+              f'{batch["counts"]["done"] / elapsed * 60:>9.0f}{batch["total_tokens"]:>8}{batch["total_tokens"] / elapsed * 60:>12.0f}')
+        crm.close_db()
+
+
+def legacy_markdown(text):
+    # basic_markdown() before the single-pass renderer, kept for comparison.
+    text = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', text)
+    text = re.sub(r'\*(.*?)\*', r'<em>\1</em>', text)
+    text = re.sub(r'^\s*#\s+(.*)$', r'<h1>\1</h1>', text, flags=re.M)
+    text = re.sub(r'^\s*##\s+(.*)$', r'<h2>\1</h2>', text, flags=re.M)
+    text = re.sub(r'^\s*###\s+(.*)$', r'<h3>\1</h3>', text, flags=re.M)
+    text = re.sub(r'^\s*-\s+(.*)$', r'<li>\1</li>', text, flags=re.M)
+    text = re.sub(r'(<li>.*</li>)', r'<ul>\1</ul>', text, flags=re.S)
+    text = text.replace('\n', '<br>')
+    return text
+
+
+def markdown_response(lines, rng):
+    # An insight-shaped answer: sections of prose, bullets and nested bullets.
+    out = []
+    while len(out) < lines:
+        out.append(f'## {rng.choice(["Overview", "Recommendations", "Next Steps"])}')
+        out.append(f'{rng.choice(COMPANIES)} renewed in Q{rng.randint(1, 4)}; **priority** is *retention* and `upsell`.')
+        for _ in range(rng.randint(2, 6)):
+            out.append(f'- **{rng.choice(FIRST_NAMES)}**: follow up on the {rng.choice(COMPANIES)} contract.')
+            if rng.random() < 0.3:
+                out.append(f'  - check *usage* for the last {rng.randint(2, 12)} months')
+        out.append('')
+    return '\n'.join(out[:lines])
+
+
+def bench_markdown(args):
+    rng = random.Random(42)
+    print(f'{"lines":>8}{"chars":>10}{"legacy ms":>11}{"single-pass ms":>16}')
+    for lines in (int(n) for n in args.lines.split(',')):
+        text = markdown_response(lines, rng)
+        legacy_ms, _ = timed(lambda: legacy_markdown(text), args.repeat)
+        new_ms, _ = timed(lambda: crm.basic_markdown(text), args.repeat)
+        print(f'{lines:>8}{len(text):>10}{legacy_ms:>11.3f}{new_ms:>16.3f}')
+
+
+def bench_history(args):
+    use_temp_db()
+    seed(10, 0)
+    conn = sqlite3.connect(crm.DB)
+    now = datetime.now()
+    span = args.days * 86400
+    rng = random.Random(42)
+    answer = crm.basic_markdown(markdown_response(12, rng))
+    with conn:
+        conn.executemany('INSERT INTO chat_history (user_message, ai_response, timestamp) VALUES (?, ?, ?)',
+                         ((f'What should I do next with {rng.choice(FIRST_NAMES)}?', answer,
+                           (now - timedelta(seconds=span * (args.messages - i) / args.messages)).isoformat())
+                          for i in range(args.messages)))
+    conn.close()
+    client = crm.app.test_client()
+    first_ms, _ = timed(lambda: client.get('/chat/history').get_json()['messages'], args.repeat)
+    url, pages = '/chat/history?limit=100', 0
+    start = time.perf_counter()
+    while url and pages < args.pages:
+        url = client.get(url).get_json()['next']
+        pages += 1
+    page_ms = (time.perf_counter() - start) / pages * 1000
+    db_bytes = os.path.getsize(crm.DB)
+    start = time.perf_counter()
+    moved, path = crm.archive_chat_history(args.keep_days, os.path.join(os.path.dirname(crm.DB), 'archive'))
+    elapsed = time.perf_counter() - start
+    print(f'messages {args.messages}, {db_bytes / 1e6:.0f} MB database')
+    print(f'first page {first_ms:.2f} ms, 100-row pages {page_ms:.2f} ms each over {pages} pages')
+    print(f'archived {moved} messages older than {args.keep_days} days in {elapsed:.1f}s '
+          f'({moved / elapsed:.0f} rows/s), archive {os.path.getsize(path) / 1e6:.1f} MB')
+
+
+def stateless_chat_prompt(cur, user_message):
+    # The /chat prompt before sessions: no memory of earlier turns.
+    customer_data, interaction_data = crm.retrieve_chat_context(cur, user_message)
+    return f"""You are an AI assistant for a Customer Relationship Manager. Answer the user's query: '{user_message}'.
+Customer data:
+{customer_data or 'No customers available.'}
+Recent interactions:
+{interaction_data or 'No interactions available.'}
+Provide a concise, professional response in Markdown format. If the query is about a specific customer, use their data. For general queries, provide helpful information related to CRM or the app's features."""
+
+
+def bench_session(args):
+    start_stub_llm(args.latency)
+    rng = random.Random(42)
+    StubLLMHandler.reply = markdown_response(args.reply_lines, rng)
+    use_temp_db()
+    seed(args.customers, args.notes)
+    crm.set_api_key('bench')
+    conn = crm.get_db()
+    names = [r[0] for r in conn.execute('SELECT name FROM customers ORDER BY random() LIMIT 5')]
+    follow_ups = ['What did we last discuss with them?', 'Draft a short follow-up email.', 'What should the next step be?',
+                  'Any risk of churn there?']
+    client = crm.app.test_client()
+    session_id = client.post('/chat/sessions').get_json()['session_id']
+    transcript = []
+    totals = {'stateless': 0, 'transcript': 0, 'session': 0, 'summaries': 0}
+    print(f'{"turn":>5}{"stateless":>11}{"+transcript":>13}{"session":>9}')
+    for turn in range(args.turns):
+        message = (f'Tell me about {names[turn // 4 % len(names)]}' if turn % 4 == 0 else follow_ups[turn % 4])
+        stateless = crm.estimate_tokens(stateless_chat_prompt(conn.cursor(), message))
+        # Stateless prompt plus every earlier turn: what memory costs without sessions.
+        with_transcript = stateless + sum(crm.estimate_tokens(t) for t in transcript)
+        StubLLMHandler.prompts = []
+        client.post('/chat', json={'message': message, 'session_id': session_id})
+        session = crm.estimate_tokens(StubLLMHandler.prompts[0])
+        while conn.execute("SELECT count(*) FROM llm_jobs WHERE status IN ('queued', 'running')").fetchone()[0]:
+            time.sleep(0.01)
+        totals['summaries'] += sum(crm.estimate_tokens(p) for p in StubLLMHandler.prompts[1:])
+        transcript.append(f'User: {message}\nAssistant: {StubLLMHandler.reply}')
+        totals['stateless'] += stateless
+        totals['transcript'] += with_transcript
+        totals['session'] += session
+        print(f'{turn + 1:>5}{stateless:>11}{with_transcript:>13}{session:>9}')
+    print(f'{"total":>5}{totals["stateless"]:>11}{totals["transcript"]:>13}{totals["session"]:>9}'
+          f'  (+{totals["summaries"]} summary prompt tokens)')
+
+
+def bench_api(args):
+    # Each case makes args.changes changes through a pool of client threads.
+    # Form posts follow the redirect to the home page, as a browser would.
+    use_temp_db()
+    seed(args.customers, args.notes)
+    crm.set_api_key('bench')
+
+    def throughput(request, calls, changes_per_call=1):
+        per_thread = max(1, calls // args.threads)
+
+        def worker():
+            client = crm.app.test_client()
+            for _ in range(per_thread):
+                request(client)
+
+        workers = [threading.Thread(target=worker) for _ in range(args.threads)]
+        start = time.perf_counter()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        return per_thread * args.threads * changes_per_call / (time.perf_counter() - start)
+
+    customer = {'name': 'Bench', 'account': 'ACC-BENCH', 'email': 'b@example.com', 'phone': '555'}
+    batch = args.batch
+    etag = crm.app.test_client().get('/api/v1/customers/2').headers['ETag']
+    cases = [
+        ('create', 'form POST /add',
+         lambda c: c.post('/add', data=customer, follow_redirects=True), args.changes, 1),
+        ('create', 'POST /api/v1/customers',
+         lambda c: c.post('/api/v1/customers', json=customer), args.changes, 1),
+        ('create', f'batch of {batch}',
+         lambda c: c.post('/api/v1/customers', json=[customer] * batch), max(1, args.changes // batch), batch),
+        ('note', 'form POST /interactions/1',
+         lambda c: c.post('/interactions/1', data={'note': 'bench note'}), args.changes, 1),
+        ('note', f'batch of {batch}',
+         lambda c: c.post('/api/v1/interactions/batch', json={'create': [{'customer_id': 1, 'note': 'bench note'}] * batch}),
+         max(1, args.changes // batch), batch),
+        ('update', 'form POST /edit/1',
+         lambda c: c.post('/edit/1', data=customer, follow_redirects=True), args.changes, 1),
+        ('update', 'PATCH /api/v1/customers/1',
+         lambda c: c.patch('/api/v1/customers/1', json={'phone': '556'}), args.changes, 1),
+        ('read', 'form GET /edit/2',
+         lambda c: c.get('/edit/2'), args.changes, 1),
+        ('read', 'GET /api/v1/customers/2',
+         lambda c: c.get('/api/v1/customers/2'), args.changes, 1),
+        ('read', 'GET, If-None-Match (304)',
+         lambda c: c.get('/api/v1/customers/2', headers={'If-None-Match': etag}), args.changes, 1),
+    ]
+    print(f'{"op":<8}{"route":<34}{"changes/s":>11}')
+    for op, label, request, calls, per_call in cases:
+        print(f'{op:<8}{label:<34}{throughput(request, calls, per_call):>11.0f}')
+
+
+def bench_timeline(args):
+    use_temp_db()
+    seed(10, 0)
+    conn = sqlite3.connect(crm.DB)
+    now = datetime.now()
+    rng = random.Random(42)
+    with conn:
+        conn.executemany('INSERT INTO interactions (customer_id, date, note) VALUES (?, ?, ?)',
+                         ((1, (now - timedelta(hours=args.notes - i)).strftime('%Y-%m-%d %H:%M:%S'),
+                           f'Call with {rng.choice(FIRST_NAMES)} about renewal, follow up on pricing')
+                          for i in range(args.notes)))
+    conn.close()
+    crm.set_api_key('bench')
+    cur = crm.get_db().cursor()
+    client = crm.app.test_client()
+    # The page before pagination rendered every note in one response.
+    full_ms, full_rows = timed(lambda: cur.execute(
+        'SELECT id, date, note FROM interactions WHERE customer_id = ? ORDER BY date DESC', (1,)).fetchall(), args.repeat)
+    page_ms, page_rows = timed(lambda: crm.list_interactions(cur, 1)[0], args.repeat)
+    view_ms, _ = timed(lambda: [client.get('/interactions/1')], args.repeat)
+    url, pages = '/interactions/1', 0
+    start = time.perf_counter()
+    while url and pages < args.pages:
+        url = client.get(url + ('&' if '?' in url else '?') + 'format=json').get_json()['next']
+        pages += 1
+    scroll_ms = (time.perf_counter() - start) / pages * 1000
+    full_notes = '\n'.join(f'{date}: {note}' for _, date, note in cur.execute(
+        'SELECT id, date, note FROM interactions WHERE customer_id = ? ORDER BY date DESC', (1,)))
+    print(f'customer with {args.notes} interactions')
+    print(f'full timeline query {full_ms:.2f} ms ({full_rows} rows), first page {page_ms:.2f} ms ({page_rows} rows)')
+    print(f'GET /interactions/1 {view_ms:.2f} ms, scroll pages {scroll_ms:.2f} ms each over {pages} pages')
+    print(f'insight prompt notes: full history {crm.estimate_tokens(full_notes)} tokens, '
+          f'bounded window {crm.estimate_tokens(crm.recent_interaction_notes(cur, 1))} tokens')
+
+
+SERVE_ROUTES = [
+    ('GET', '/', None),
+    ('GET', '/?search=Garcia', None),
+    ('POST', '/add', {'name': 'Bench', 'account': 'ACC-BENCH', 'email': 'b@example.com', 'phone': '555'}),
+]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def http_load(port, method, path, data, seconds, json_body=None, customers=0, seed_value=0):
+    # One keep-alive connection per client process, hammering a single route.
+    # '{id}' in the path becomes a random customer id on every request.
+    rng = random.Random(seed_value)
+    if json_body is not None:
+        body, headers = json.dumps(json_body), {'Content-Type': 'application/json'}
+    else:
+        body = urllib.parse.urlencode(data) if data else None
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'} if data else {}
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    done = errors = 0
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        target = path.format(id=rng.randint(1, customers)) if customers else path
+        started = time.perf_counter()
+        conn.request(method, target, body, headers)
+        resp = conn.getresponse()
+        resp.read()
+        latencies.append(time.perf_counter() - started)
+        if resp.status >= 400:
+            errors += 1
+        done += 1
+    conn.close()
+    return done, errors, latencies
+
+
+def start_server(port, workers, threads):
+    env = dict(os.environ, CRM_DB=crm.DB, CRM_CHAT_RETENTION_DAYS=str(crm.CHAT_RETENTION_DAYS))
+    proc = subprocess.Popen([sys.executable, os.path.abspath(crm.__file__), '--host', '127.0.0.1', '--port', str(port),
+                             '--workers', str(workers), '--threads', str(threads)],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('server did not start')
+
+
+def bench_serve(args):
+    # Each worker count gets its own server process tree; the load comes from
+    # separate client processes so it is not throttled by this one's GIL.
+    use_temp_db()
+    seed(args.customers, args.notes)
+    crm.set_api_key('bench')
+    counts = [int(w) for w in args.workers.split(',')]
+    print(f'{os.cpu_count()} cores, {args.clients} clients, {args.seconds}s per route, {args.threads} threads per worker')
+    print(f'{"workers":<9}' + ''.join(f'{m + " " + p:>24}' for m, p, _ in SERVE_ROUTES))
+    with ProcessPoolExecutor(max_workers=args.clients) as clients:
+        for workers in counts:
+            port = free_port()
+            server = start_server(port, workers, args.threads)
+            try:
+                cells = []
+                for method, path, data in SERVE_ROUTES:
+                    results = list(clients.map(http_load, *zip(*[(port, method, path, data, args.seconds)] * args.clients)))
+                    done, errors = sum(r[0] for r in results), sum(r[1] for r in results)
+                    cells.append(f'{done / args.seconds:.0f} req/s' + (f' ({errors} err)' if errors else ''))
+            finally:
+                server.terminate()
+                server.wait()
+            print(f'{workers:<9}' + ''.join(f'{c:>24}' for c in cells))
+
+
+def bench_metrics(args):
+    # Where the time goes on each route, from the app's own metrics, and
+    # what the instrumentation costs per SQL statement.
+    use_temp_db()
+    seed(args.customers, args.notes)
+    crm.set_api_key('bench')
+    sql = 'SELECT id, name FROM customers WHERE id = ?'
+    plain = sqlite3.connect(crm.DB)
+    timed_conn = sqlite3.connect(crm.DB, factory=crm.TimedConnection)
+    plain_ms, _ = timed(lambda: [plain.execute(sql, (i % args.customers + 1,)).fetchone() for i in range(1000)], args.repeat)
+    timed_ms, _ = timed(lambda: [timed_conn.execute(sql, (i % args.customers + 1,)).fetchone() for i in range(1000)], args.repeat)
+    print(f'point query: plain {plain_ms:.3f} us, instrumented {timed_ms:.3f} us, '
+          f'overhead {(timed_ms - plain_ms):.3f} us per statement')
+    crm._histograms.clear()
+    client = crm.app.test_client()
+    for method, path, data in ROUTES:
+        for _ in range(args.requests):
+            client.open(path, method=method, data=data).get_data()
+    histograms, _ = crm.collect_metrics()
+
+    def mean_ms(values):
+        count = sum(values[:-1])
+        return values[-1] / count * 1000 if count else 0, count
+
+    print(f'\n{"route":<40}{"mean ms":>10}{"count":>8}')
+    for (name, labels), values in sorted(histograms.items()):
+        if name == 'crm_http_request_duration_seconds':
+            labels = dict(labels)
+            ms, count = mean_ms(values)
+            print(f'{labels["method"] + " " + labels["route"] + " " + labels["status"]:<40}{ms:>10.3f}{count:>8}')
+    print(f'\n{"template":<40}{"mean ms":>10}{"count":>8}')
+    for (name, labels), values in sorted(histograms.items()):
+        if name == 'crm_template_render_duration_seconds':
+            ms, count = mean_ms(values)
+            print(f'{dict(labels)["template"]:<40}{ms:>10.3f}{count:>8}')
+    statements = sorted(((values[-1], dict(labels)['statement'], sum(values[:-1])) for (name, labels), values in histograms.items()
+                         if name == 'crm_sql_query_duration_seconds'), reverse=True)
+    print(f'\n{"total ms":>10}{"count":>8}  statement')
+    for total, statement, count in statements[:args.top]:
+        print(f'{total * 1000:>10.1f}{count:>8}  {statement[:90]}')
+
+
+# Routes driven by the suite: name, method, path ('{id}' is a random customer),
+# form data, JSON body. The AI routes answer from the stub LLM.
+SUITE_ROUTES = [
+    ('home', 'GET', '/', None, None),
+    ('search', 'GET', '/?search=Garcia', None, None),
+    ('add', 'POST', '/add', {'name': 'Bench', 'account': 'ACC-BENCH', 'email': 'b@example.com', 'phone': '555'}, None),
+    ('edit', 'GET', '/edit/{id}', None, None),
+    ('edit_save', 'POST', '/edit/{id}', {'name': 'Bench Edit', 'account': 'ACC-EDIT', 'email': 'e@example.com', 'phone': '556'}, None),
+    ('interactions', 'GET', '/interactions/{id}', None, None),
+    ('add_note', 'POST', '/interactions/{id}', {'note': 'bench note'}, None),
+    ('export', 'GET', '/export', None, None),
+    ('insight_page', 'GET', '/insight/{id}', None, None),
+    ('insight_stream', 'GET', '/insight/{id}/stream', None, None),
+    ('custom_insight_stream', 'GET', '/custom_insight/{id}/stream?q=What+should+we+offer+next', None, None),
+    ('chat', 'POST', '/chat', None, {'message': 'Who should I call about Billing renewals?'}),
+    ('chat_stream', 'POST', '/chat/stream', None, {'message': 'Summarize recent activity for customer 7'}),
+]
+
+
+def latency_stats(latencies, elapsed):
+    ordered = sorted(latencies)
+
+    def pct(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3) if ordered else None
+
+    return {'requests': len(ordered), 'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3) if ordered else None,
+            'p50_ms': pct(0.5), 'p95_ms': pct(0.95), 'p99_ms': pct(0.99),
+            'rps': round(len(ordered) / elapsed, 1) if elapsed else None}
+
+
+def process_tree_rss_mb(pid):
+    # Resident memory of a server and its workers; Linux only.
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            pids = [pid] + [int(child) for child in f.read().split()]
+        total_kb = 0
+        for p in pids:
+            with open(f'/proc/{p}/status') as f:
+                total_kb += next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+        return round(total_kb / 1024, 1)
+    except (OSError, StopIteration, ValueError):
+        return None
+
+
+def run_metadata(args):
+    def git(*command):
+        try:
+            return subprocess.run(['git', *command], capture_output=True, text=True, timeout=30,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            return ''
+
+    return {'commit': git('rev-parse', '--short', 'HEAD') or None, 'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+            'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'started_at': datetime.now().isoformat(timespec='seconds'),
+            'args': {k: v for k, v in vars(args).items() if k != 'func'}}
+
+
+def suite_client_case(client, case, customers, args, rng):
+    # Sequential requests until args.requests or args.route_seconds (at least
+    # three), then a few more under tracemalloc for the peak Python allocation.
+    name, method, path, data, body = case
+
+    def call():
+        resp = client.open(path.format(id=rng.randint(1, customers)), method=method, data=data, json=body)
+        resp.get_data()
+        resp.close()
+        return resp.status_code
+
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + args.route_seconds
+    while len(latencies) < args.requests and (len(latencies) < 3 or time.perf_counter() < deadline):
+        started = time.perf_counter()
+        status = call()
+        latencies.append(time.perf_counter() - started)
+        errors += status >= 400
+    tracemalloc.start()
+    for _ in range(args.memory_requests):
+        call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return dict(latency_stats(latencies, sum(latencies)), errors=errors, peak_kb=round(peak / 1024, 1))
+
+
+def bench_suite(args):
+    scales = args.scales.split(',')
+    unknown = [s for s in scales if s not in SCALES]
+    if unknown:
+        raise SystemExit(f'unknown scale {unknown}, choose from {", ".join(SCALES)}')
+    names = args.routes.split(',') if args.routes else [case[0] for case in SUITE_ROUTES]
+    server_names = args.server_routes.split(',')
+    worker_counts = [int(w) for w in args.workers.split(',') if int(w) > 0]
+    start_stub_llm(args.llm_latency, args.token_delay)
+    # The generated chat history predates GENERATOR_EPOCH, so the first /chat
+    # would archive most of it mid-run; every phase must see the same data.
+    crm.CHAT_RETENTION_DAYS = 0
+    out = os.path.abspath(args.out or f'bench-{run_metadata(args)["commit"] or "local"}.json')
+    args.data_dir = os.path.abspath(args.data_dir)
+    report = {'meta': run_metadata(args), 'results': []}
+    row = '{:<7}{:<8}{:<3}{:<24}{:>9}{:>10}{:>10}{:>10}{:>11}{:>7}'
+    print(row.format('scale', 'mode', 'w', 'route', 'requests', 'mean ms', 'p95 ms', 'req/s', 'memory', 'err'))
+
+    def emit(result):
+        report['results'].append(result)
+        memory = f'{result["peak_kb"]:.0f} KB' if result.get('peak_kb') is not None else (
+            f'{result["rss_mb"]:.0f} MB' if result.get('rss_mb') is not None else '-')
+        print(row.format(result['scale'], result['mode'], result['workers'], result['route'], result['requests'],
+                         result['mean_ms'] or 0, result['p95_ms'] or 0, result['rps'] or 0, memory, result['errors']))
+
+    for scale in scales:
+        customers = use_generated_db(scale, args)
+        crm.set_api_key('bench')
+        rng = random.Random(args.seed)
+        client = crm.app.test_client()
+        for case in SUITE_ROUTES:
+            if case[0] in names:
+                emit(dict(scale=scale, mode='client', workers=0, route=case[0],
+                          **suite_client_case(client, case, customers, args, rng)))
+        crm.close_db()
+        with ProcessPoolExecutor(max_workers=args.clients) as clients:
+            for workers in worker_counts:
+                port = free_port()
+                server = start_server(port, workers, args.threads)
+                try:
+                    for name, method, path, data, body in SUITE_ROUTES:
+                        if name not in server_names:
+                            continue
+                        jobs = [(port, method, path, data, args.seconds, body, customers, args.seed + i) for i in range(args.clients)]
+                        results = list(clients.map(http_load, *zip(*jobs)))
+                        latencies = [latency for r in results for latency in r[2]]
+                        emit(dict(scale=scale, mode='server', workers=workers, route=name,
+                                  **latency_stats(latencies, args.seconds), errors=sum(r[1] for r in results),
+                                  rss_mb=process_tree_rss_mb(server.pid)))
+                finally:
+                    server.terminate()
+                    server.wait()
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(f'results written to {out}')
+
+
+# Lower is better for latency and memory, higher for throughput.
+COMPARE_METRICS = {'mean_ms': -1, 'p50_ms': -1, 'p95_ms': -1, 'rps': 1, 'peak_kb': -1, 'rss_mb': -1}
+
+
+def bench_compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    def index(report):
+        return {(r['scale'], r['mode'], r['workers'], r['route']): r for r in report['results']}
+
+    before, after = index(old), index(new)
+    print(f'{old["meta"]["commit"]} -> {new["meta"]["commit"]}, threshold {args.threshold:g}%')
+    regressions = 0
+    for key in sorted(set(before) & set(after)):
+        for metric, better in COMPARE_METRICS.items():
+            a, b = before[key].get(metric), after[key].get(metric)
+            if not a or b is None:
+                continue
+            change = (b - a) / a * 100
+            regressed = change * better < -args.threshold
+            regressions += regressed
+            if regressed or args.all or change * better > args.threshold:
+                scale, mode, workers, route = key
+                print(f'{"REGRESSION" if regressed else "":<11}{scale:<6}{mode:<7}{workers:<3}{route:<24}{metric:<9}'
+                      f'{a:>12g}{b:>12g}{change:>+9.1f}%')
+    missing = sorted(set(before) ^ set(after))
+    if missing:
+        print(f'{len(missing)} results only in one file, not compared')
+    print(f'{regressions} regressions')
+    sys.exit(1 if regressions else 0)
+
+
+def bench_summary(args):
+    # Customer activity from customer_summary vs aggregating interactions at
+    # read time, and what the triggers add to each note insert.
+    use_temp_db()
+    generate(args.customers, args.notes, 0)
+    cur = crm.get_db().cursor()
+    page_ids = [row[0] for row in crm.list_customers(cur)[0]]
+    cases = [
+        ('page activity, N+1 aggregates', lambda: [cur.execute(
+            'SELECT count(*), max(date) FROM interactions WHERE customer_id = ?', (i,)).fetchone() for i in page_ids]),
+        ('page activity, summary rows', lambda: cur.execute(
+            f'SELECT interaction_count, last_interaction FROM customer_summary WHERE customer_id IN ({",".join("?" * len(page_ids))})',
+            page_ids).fetchall()),
+        ('sort by last contact, GROUP BY', lambda: cur.execute(
+            'SELECT c.id, max(i.date) AS last FROM customers c LEFT JOIN interactions i ON i.customer_id = c.id '
+            'GROUP BY c.id ORDER BY last DESC, c.id DESC LIMIT 50').fetchall()),
+        ('sort by last contact, summary index', lambda: crm.list_customers(cur, '', 'last_contact', 'desc')[0]),
+        ('sort by notes, summary index', lambda: crm.list_customers(cur, '', 'interactions', 'desc')[0]),
+    ]
+    print(f'{args.customers} customers, about {args.notes} notes each')
+    for label, fn in cases:
+        ms, _ = timed(fn, args.repeat)
+        print(f'{label:<40}{ms:>10.3f} ms')
+    conn = crm.get_db()
+
+    def insert_notes(table):
+        start = time.perf_counter()
+        with conn:
+            conn.executemany(f'INSERT INTO {table} (customer_id, date, note) VALUES (?, ?, ?)',
+                             ((i % args.customers + 1, datetime.now().isoformat(), 'bench note') for i in range(args.inserts)))
+        return (time.perf_counter() - start) / args.inserts * 1e6
+
+    conn.execute('CREATE TABLE bench_interactions AS SELECT * FROM interactions WHERE 0')
+    conn.execute('CREATE INDEX bench_interactions_customer_date ON bench_interactions (customer_id, date)')
+    conn.execute('CREATE INDEX bench_interactions_date ON bench_interactions (date)')
+    plain_us, trigger_us = insert_notes('bench_interactions'), insert_notes('interactions')
+    print(f'note insert: {plain_us:.1f} us without summary trigger, {trigger_us:.1f} us with it')
+
+
+def bench_writes(args):
+    # Note and chat inserts from concurrent threads: one transaction per write
+    # vs group commit, each with the default synchronous=NORMAL and with FULL
+    # (an fsync per commit). Latency is what the caller waits for.
+    use_temp_db()
+    seed(args.customers, 0)
+    cases = [('commit', 'normal'), ('commit', 'full'), ('group', 'normal'), ('group', 'full')]
+    print(f'{args.threads} threads, {args.writes} writes per case, half notes and half chat messages, '
+          f'batch delay {crm.WRITE_BATCH_DELAY * 1000:g} ms')
+    print(f'{"mode":<8}{"sync":<8}{"writes/s":>10}{"p50 ms":>9}{"p95 ms":>9}{"rows/commit":>13}')
+    for mode, sync in cases:
+        crm.WRITE_MODE, crm.WRITE_SYNC, crm._write_queue = mode, sync, None
+        crm._counters.clear()
+        per_thread = args.writes // args.threads
+        latencies = []
+
+        def worker(n):
+            crm.close_db()
+            own = []
+            for i in range(per_thread):
+                started = time.perf_counter()
+                if i % 2:
+                    crm.queued_write(crm.insert_chat, f'question {n}-{i}', '<p>answer</p>', None, 'answer')
+                else:
+                    crm.queued_write(crm.add_interaction, (n * per_thread + i) % args.customers + 1, f'note {n}-{i}')
+                own.append(time.perf_counter() - started)
+            latencies.extend(own)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.threads)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        stats = latency_stats(latencies, elapsed)
+        batches = crm._counters.get(('crm_write_batches_total', ()), 0)
+        rows_per_commit = crm._counters.get(('crm_write_batch_rows_total', ()), 0) / batches if batches else 1
+        print(f'{mode:<8}{sync:<8}{stats["rps"]:>10.0f}{stats["p50_ms"]:>9.2f}{stats["p95_ms"]:>9.2f}{rows_per_commit:>13.1f}')
+
+
+SURNAME_SYLLABLES = ['ab', 'ber', 'cal', 'dor', 'el', 'fen', 'gar', 'hol', 'is', 'jan', 'kov', 'lin', 'mar', 'nel',
+                     'or', 'pol', 'quin', 'ros', 'sten', 'tor', 'ul', 'ver', 'wick', 'yar', 'zel']
+EMAIL_DOMAINS = ['gmail.com', 'outlook.com', 'example.com', 'mail.net']
+
+
+def dedup_customer(rng, i):
+    first = rng.choice(FIRST_NAMES)
+    last = ''.join(rng.choice(SURNAME_SYLLABLES) for _ in range(rng.randint(2, 3))).capitalize()
+    return (f'{first} {last}', rng.choice(COMPANIES), f'{first.lower()}.{last.lower()}{i}@{rng.choice(EMAIL_DOMAINS)}',
+            f'+1 ({rng.randint(200, 999)}) {rng.randint(200, 999)}-{rng.randint(0, 9999):04d}')
+
+
+def perturb_customer(rng, customer):
+    # The kinds of variation a second entry of the same person has.
+    name, account, email, phone = customer
+    first, last = name.split(' ', 1)
+    name = rng.choice([name, f'{last}, {first}', f'{first[0]}. {last}', f'{first[:-1]} {last}', name.upper()])
+    local, domain = email.split('@')
+    email = rng.choice([email.upper(), f'{local}+crm@{domain}', local.replace('.', '') + '@' + domain
+                        if domain == 'gmail.com' else email, None])
+    phone = rng.choice([re.sub(r'\D', '', phone), phone[3:], None])
+    return name, account.lower(), email, phone
+
+
+def bench_dedup(args):
+    # Batch scan with blocking keys vs comparing every pair, recall on
+    # injected duplicates, and what the incremental check adds to an insert.
+    use_temp_db()
+    crm.init_db()
+    rng = random.Random(42)
+    customers = [dedup_customer(rng, i) for i in range(args.customers)]
+    originals = rng.sample(range(args.customers), args.duplicates)
+    customers += [perturb_customer(rng, customers[i]) for i in originals]
+    injected = {(i + 1, args.customers + n + 1) for n, i in enumerate(originals)}
+    conn = crm.get_db()
+    with conn:
+        conn.executemany('INSERT INTO customers (name, account, email, phone) VALUES (?, ?, ?, ?)', customers)
+    report = crm.scan_duplicates()
+    found = {row[:2] for row in conn.execute('SELECT customer_id, duplicate_id FROM customer_duplicates')}
+    print(f'{len(customers)} customers, {args.duplicates} injected duplicates')
+    print(f"blocking scan: {report['seconds']:.2f} s ({report['indexed']} keyed), {report['compared']} pairs compared, "
+          f"{report['skipped_blocks']} oversized blocks skipped")
+    print(f'found {len(found)} pairs: recall {len(found & injected) / len(injected):.1%}, '
+          f'{len(found - injected)} not injected')
+
+    sample = [crm.match_fields(*customer) for customer in customers[:args.sample]]
+    start = time.perf_counter()
+    for i, a in enumerate(sample):
+        for b in sample[i + 1:]:
+            crm.match_score(a, b, crm.DEDUP_THRESHOLD)
+    per_pair = (time.perf_counter() - start) / (len(sample) * (len(sample) - 1) / 2)
+    all_pairs = len(customers) * (len(customers) - 1) / 2
+    print(f'all-pairs comparison: {per_pair * 1e6:.1f} us per pair, {all_pairs:.3g} pairs, about {per_pair * all_pairs:.0f} s')
+
+    cur = conn.cursor()
+    new = [perturb_customer(rng, dedup_customer(rng, args.customers + i)) for i in range(args.inserts)]
+    start = time.perf_counter()
+    with conn:
+        for customer in new:
+            cur.execute('INSERT INTO customers (name, account, email, phone) VALUES (?, ?, ?, ?)', customer)
+    plain_us = (time.perf_counter() - start) / args.inserts * 1e6
+    start = time.perf_counter()
+    with conn:
+        for customer in new:
+            crm.create_customer(cur, *customer)
+    checked_us = (time.perf_counter() - start) / args.inserts * 1e6
+    print(f'customer insert: {plain_us:.1f} us plain, {checked_us:.1f} us with keys and duplicate check')
+
+
+def bench_generate(args):
+    if os.path.exists(args.out):
+        raise SystemExit(f'{args.out} exists')
+    crm.DB = args.out
+    start = time.perf_counter()
+    generate(SCALES[args.scale] if args.scale else args.customers, args.notes, args.chats, args.seed)
+    conn = sqlite3.connect(args.out)
+    counts = [conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] for table in ('customers', 'interactions', 'chat_history')]
+    conn.close()
+    print(f'{counts[0]} customers, {counts[1]} interactions, {counts[2]} chat messages in {time.perf_counter() - start:.1f}s '
+          f'-> {args.out} ({os.path.getsize(args.out) / 1e6:.0f} MB)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    modes = parser.add_subparsers(dest='mode', required=True)
+
+    routes = modes.add_parser('routes', help='requests/sec per route through the test client')
+    routes.add_argument('--customers', type=int, default=2000)
+    routes.add_argument('--notes', type=int, default=2, help='interactions per customer')
+    routes.add_argument('--requests', type=int, default=400)
+    routes.add_argument('--threads', type=int, default=4)
+    routes.set_defaults(func=bench_routes)
+
+    search = modes.add_parser('search', help='customer search latency, LIKE scan vs FTS index')
+    search.add_argument('--customers', type=int, default=1000000)
+    search.add_argument('--repeat', type=int, default=5)
+    search.set_defaults(func=bench_search)
+
+    export = modes.add_parser('export', help='time-to-first-byte, duration and peak memory of /export')
+    export.add_argument('--customers', type=int, default=2000000)
+    export.add_argument('--notes', type=int, default=1, help='interactions per customer')
+    export.set_defaults(func=bench_export)
+
+    bulk = modes.add_parser('import', help='bulk CSV import throughput')
+    bulk.add_argument('--customers', type=int, default=1000000)
+    bulk.set_defaults(func=bench_import)
+
+    render = modes.add_parser('render', help='per-template render time, render_template_string vs compiled')
+    render.add_argument('--repeat', type=int, default=200)
+    render.set_defaults(func=bench_render)
+
+    llm = modes.add_parser('llm', help='Groq client reuse against a local stub server')
+    llm.add_argument('--calls', type=int, default=200)
+    llm.add_argument('--latency', type=float, default=0, help='stub response delay in ms')
+    llm.set_defaults(func=bench_llm)
+
+    chat = modes.add_parser('chat', help='/chat prompt size and latency as the customer table grows')
+    chat.add_argument('--sizes', default='100,10000,100000')
+    chat.add_argument('--notes', type=int, default=2, help='interactions per customer')
+    chat.add_argument('--latency', type=float, default=0, help='stub response delay in ms')
+    chat.set_defaults(func=bench_chat)
+
+    stream = modes.add_parser('stream', help='time to first token, /chat vs /chat/stream')
+    stream.add_argument('--latency', type=float, default=200, help='stub delay before the first token in ms')
+    stream.add_argument('--token-delay', type=float, default=20, help='stub delay between tokens in ms')
+    stream.set_defaults(func=bench_stream)
+
+    jobs = modes.add_parser('jobs', help='CRUD latency during a burst of AI chats, blocking vs background jobs')
+    jobs.add_argument('--workers', type=int, default=4, help='request worker threads')
+    jobs.add_argument('--chats', type=int, default=16)
+    jobs.add_argument('--crud', type=int, default=200)
+    jobs.add_argument('--latency', type=float, default=500, help='stub response delay in ms')
+    jobs.add_argument('--rate-limit', type=float, default=0.1, help='fraction of stub calls answered with 429')
+    jobs.set_defaults(func=bench_jobs)
+
+    batch = modes.add_parser('batch', help='insight batch throughput and token accounting against a stub LLM')
+    batch.add_argument('--customers', type=int, default=200)
+    batch.add_argument('--notes', type=int, default=2, help='interactions per customer')
+    batch.add_argument('--workers', default='1,4,8', help='comma-separated pool sizes to compare')
+    batch.add_argument('--rpm', type=int, default=0, help='requests per minute budget, 0 for none')
+    batch.add_argument('--tpm', type=int, default=0, help='tokens per minute budget, 0 for none')
+    batch.add_argument('--latency', type=float, default=200, help='stub response delay in ms')
+    batch.set_defaults(func=bench_batch)
+
+    markdown = modes.add_parser('markdown', help='basic_markdown on large generated responses, legacy vs single-pass')
+    markdown.add_argument('--lines', default='20,200,2000,20000')
+    markdown.add_argument('--repeat', type=int, default=20)
+    markdown.set_defaults(func=bench_markdown)
+
+    history = modes.add_parser('history', help='chat history paging and archive throughput')
+    history.add_argument('--messages', type=int, default=200000)
+    history.add_argument('--days', type=int, default=365, help='age span of the seeded messages')
+    history.add_argument('--keep-days', type=int, default=90)
+    history.add_argument('--pages', type=int, default=200, help='100-row pages to walk back through')
+    history.add_argument('--repeat', type=int, default=200)
+    history.set_defaults(func=bench_history)
+
+    session = modes.add_parser('session', help='prompt tokens per turn, stateless vs full transcript vs chat session')
+    session.add_argument('--turns', type=int, default=20)
+    session.add_argument('--customers', type=int, default=10000)
+    session.add_argument('--notes', type=int, default=3, help='interactions per customer')
+    session.add_argument('--reply-lines', type=int, default=8, help='length of the stub answer')
+    session.add_argument('--latency', type=float, default=0, help='stub response delay in ms')
+    session.set_defaults(func=bench_session)
+
+    api = modes.add_parser('api', help='JSON API vs form routes throughput, single and batched')
+    api.add_argument('--customers', type=int, default=10000)
+    api.add_argument('--notes', type=int, default=2, help='interactions per customer')
+    api.add_argument('--changes', type=int, default=800, help='changes per case')
+    api.add_argument('--batch', type=int, default=100, help='items per batch request')
+    api.add_argument('--threads', type=int, default=4)
+    api.set_defaults(func=bench_api)
+
+    timeline = modes.add_parser('timeline', help='interaction timeline paging and insight prompt size for a long-lived customer')
+    timeline.add_argument('--notes', type=int, default=50000, help='interactions on the benchmarked customer')
+    timeline.add_argument('--pages', type=int, default=100, help='scroll pages to walk back through')
+    timeline.add_argument('--repeat', type=int, default=50)
+    timeline.set_defaults(func=bench_timeline)
+
+    serve = modes.add_parser('serve', help='HTTP throughput of the production server as worker processes are added')
+    serve.add_argument('--workers', default='1,2,4', help='comma-separated worker process counts')
+    serve.add_argument('--threads', type=int, default=crm.SERVER_THREADS, help='threads per worker')
+    serve.add_argument('--clients', type=int, default=8, help='concurrent client processes')
+    serve.add_argument('--seconds', type=float, default=5)
+    serve.add_argument('--customers', type=int, default=10000)
+    serve.add_argument('--notes', type=int, default=2, help='interactions per customer')
+    serve.set_defaults(func=bench_serve)
+
+    metrics = modes.add_parser('metrics', help='per-route, template and SQL time from the /metrics instrumentation, and its overhead')
+    metrics.add_argument('--customers', type=int, default=100000)
+    metrics.add_argument('--notes', type=int, default=2, help='interactions per customer')
+    metrics.add_argument('--requests', type=int, default=50, help='requests per route')
+    metrics.add_argument('--repeat', type=int, default=20, help='rounds of 1000 point queries for the overhead')
+    metrics.add_argument('--top', type=int, default=10, help='slowest statements to list')
+    metrics.set_defaults(func=bench_metrics)
+
+    summary = modes.add_parser('summary', help='customer activity from customer_summary vs aggregating interactions')
+    summary.add_argument('--customers', type=int, default=100000)
+    summary.add_argument('--notes', type=int, default=5, help='mean interactions per customer')
+    summary.add_argument('--inserts', type=int, default=20000, help='notes inserted to time the trigger')
+    summary.add_argument('--repeat', type=int, default=20)
+    summary.set_defaults(func=bench_summary)
+
+    writes = modes.add_parser('writes', help='note and chat insert throughput, per-row commit vs group commit')
+    writes.add_argument('--threads', type=int, default=16)
+    writes.add_argument('--writes', type=int, default=4000, help='writes per case')
+    writes.add_argument('--customers', type=int, default=10000)
+    writes.set_defaults(func=bench_writes)
+
+    dedup = modes.add_parser('dedup', help='duplicate detection: blocking scan vs all pairs, recall, insert overhead')
+    dedup.add_argument('--customers', type=int, default=100000)
+    dedup.add_argument('--duplicates', type=int, default=2000, help='perturbed copies of existing customers')
+    dedup.add_argument('--sample', type=int, default=2000, help='customers compared pairwise to time the all-pairs scan')
+    dedup.add_argument('--inserts', type=int, default=1000)
+    dedup.set_defaults(func=bench_dedup)
+
+    generate_mode = modes.add_parser('generate', help='write a synthetic CRM database')
+    generate_mode.add_argument('--scale', choices=SCALES, help='customer count preset')
+    generate_mode.add_argument('--customers', type=int, default=10000, help='used when --scale is not given')
+    generate_mode.add_argument('--notes', type=int, default=5, help='mean interactions per customer')
+    generate_mode.add_argument('--chats', type=int, default=None, help='chat messages, default customers / 10')
+    generate_mode.add_argument('--seed', type=int, default=42)
+    generate_mode.add_argument('--out', required=True)
+    generate_mode.set_defaults(func=bench_generate)
+
+    suite = modes.add_parser('suite', help='every route at each scale, test client and multi-worker server, results as JSON')
+    suite.add_argument('--scales', default='10k', help=f'comma-separated, from {",".join(SCALES)}')
+    suite.add_argument('--notes', type=int, default=5, help='mean interactions per customer')
+    suite.add_argument('--seed', type=int, default=42)
+    suite.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'crm-bench-data'),
+                       help='cache of generated databases')
+    suite.add_argument('--routes', default='', help='test-client routes, default all')
+    suite.add_argument('--requests', type=int, default=200, help='test-client requests per route')
+    suite.add_argument('--route-seconds', type=float, default=10, help='time cap per test-client route')
+    suite.add_argument('--memory-requests', type=int, default=3, help='requests per route under tracemalloc')
+    suite.add_argument('--workers', default='1,4', help='server worker counts, 0 to skip the server runs')
+    suite.add_argument('--threads', type=int, default=crm.SERVER_THREADS, help='threads per worker')
+    suite.add_argument('--server-routes', default='home,search,add,edit,interactions,chat_stream')
+    suite.add_argument('--clients', type=int, default=8, help='concurrent client processes')
+    suite.add_argument('--seconds', type=float, default=5, help='load duration per server route')
+    suite.add_argument('--llm-latency', type=float, default=0, help='stub LLM delay in ms')
+    suite.add_argument('--token-delay', type=float, default=0, help='stub delay per streamed token in ms')
+    suite.add_argument('--out', default=None, help='JSON results file, default bench-<commit>.json')
+    suite.set_defaults(func=bench_suite)
+
+    compare = modes.add_parser('compare', help='diff two suite result files; exits 1 on regressions')
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.add_argument('--threshold', type=float, default=10, help='percent change counted as a regression')
+    compare.add_argument('--all', action='store_true', help='print every metric, not only the changed ones')
+    compare.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
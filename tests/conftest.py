@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as crm
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    crm.create_app(str(tmp_path / 'crm.db'))
+    crm.set_api_key('test-key')
+    yield crm.get_db()
+    crm.close_db()
+
+
+@pytest.fixture
+def client(db):
+    return crm.app.test_client()
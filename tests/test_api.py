@@ -0,0 +1,24 @@
+import app as crm
+
+
+def add_customer(client, **fields):
+    response = client.post('/api/v1/customers', json={'name': 'Grace Hopper', 'account': 'Navy', **fields})
+    assert response.status_code == 201
+    return response.json['id']
+
+
+def test_patch_null_date_keeps_current_date(client):
+    customer_id = add_customer(client)
+    created = client.post(f'/api/v1/customers/{customer_id}/interactions',
+                          json={'note': 'Kickoff', 'date': '2025-03-01T10:00:00'}).json
+    response = client.patch(f"/api/v1/interactions/{created['id']}", json={'note': 'Kickoff call', 'date': None})
+    assert response.status_code == 200
+    assert response.json['date'] == '2025-03-01T10:00:00'
+    assert response.json['note'] == 'Kickoff call'
+
+
+def test_patch_rejects_bad_date(client):
+    customer_id = add_customer(client)
+    created = client.post(f'/api/v1/customers/{customer_id}/interactions', json={'note': 'Kickoff'}).json
+    response = client.patch(f"/api/v1/interactions/{created['id']}", json={'date': 'yesterday'})
+    assert response.status_code == 400
@@ -0,0 +1,41 @@
+import app as crm
+
+
+def test_empty_id_list_selects_nobody(db):
+    with db:
+        crm.create_customer(db.cursor(), 'Ada Lovelace', 'Acme')
+    assert crm.get_insight_batch(crm.create_insight_batch(customer_ids=[]))['total'] == 0
+    assert crm.get_insight_batch(crm.create_insight_batch())['total'] == 1
+
+
+def test_resume_reuses_batch_settings(db, monkeypatch):
+    with db:
+        customer_id = crm.create_customer(db.cursor(), 'Ada Lovelace', 'Acme')
+    budgets = []
+
+    class RecordingBudget(crm.RateBudget):
+        def __init__(self, rpm, tpm):
+            budgets.append((rpm, tpm))
+            super().__init__(rpm, tpm)
+
+    monkeypatch.setattr(crm, 'RateBudget', RecordingBudget)
+    monkeypatch.setattr(crm, 'complete_with_usage', lambda api_key, prompt: ('insight', 10, 5))
+    batch_id = crm.create_insight_batch(customer_ids=[customer_id], workers=2, rpm=7, tpm=0)
+    batch = crm.get_insight_batch(batch_id)
+    assert (batch['workers'], batch['rpm'], batch['tpm']) == (2, 7, 0)
+    crm.run_insight_batch(batch_id)
+    crm.run_insight_batch(batch_id, rpm=3)
+    assert budgets == [(7, 0), (3, 0)]
+    assert crm.get_insight_batch(batch_id)['counts']['done'] == 1
+
+
+def test_cli_rejects_non_numeric_ids(db):
+    result = crm.app.test_cli_runner().invoke(args=['precompute-insights', '--ids', '4,x'])
+    assert result.exit_code == 2
+    assert "Invalid value for '--ids'" in result.output
+
+
+def test_batch_route_caps_customer_ids(client, monkeypatch):
+    monkeypatch.setattr(crm, 'INSIGHT_BATCH_MAX_IDS', 2)
+    response = client.post('/batches/insights', json={'customer_ids': [1, 2, 3]})
+    assert response.status_code == 400
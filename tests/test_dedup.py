@@ -0,0 +1,58 @@
+import pytest
+
+import app as crm
+
+
+@pytest.mark.parametrize('word, key', [
+    ('robert', 'r163'), ('rupert', 'r163'), ('ashcraft', 'a261'),
+    ('tymczak', 't522'), ('pfister', 'p236'), ('lee', 'l000'),
+])
+def test_soundex(word, key):
+    assert crm.soundex(word) == key
+
+
+@pytest.mark.parametrize('a, b, score', [
+    ('martha', 'marhta', 0.9611), ('dixon', 'dicksonx', 0.8133), ('dwayne', 'duane', 0.84),
+    ('same', 'same', 1.0), ('abc', 'xyz', 0.0), ('', 'abc', 0.0),
+])
+def test_jaro_winkler(a, b, score):
+    assert crm.jaro_winkler(a, b) == pytest.approx(score, abs=1e-4)
+    assert crm.jaro_winkler(b, a) == pytest.approx(score, abs=1e-4)
+
+
+def test_match_keys():
+    assert crm.name_key('Smith, John') == crm.name_key('John Smyth') == 's530 j'
+    assert crm.normalize_email(' J.Smith+crm@GoogleMail.com') == 'jsmith@gmail.com'
+    assert crm.phone_key('+1 (555) 123-4567') == crm.phone_key('555.123.4567') == '5551234567'
+
+
+def insert_customers(db, rows):
+    # Raw inserts skip create_customer's incremental check, as an import would.
+    with db:
+        cur = db.cursor()
+        cur.executemany("INSERT INTO customers (name, account, email, phone, created_at) VALUES (?, ?, ?, ?, '')", rows)
+    return [row[0] for row in db.execute('SELECT id FROM customers ORDER BY id')]
+
+
+def test_scan_finds_pairs_once(db):
+    ids = insert_customers(db, [
+        ('John Smith', 'Acme', 'j.smith@gmail.com', '555-123-4567'),
+        ('Smith, Jon', 'ACME', 'jsmith@googlemail.com', '+1 555 123 4567'),
+        ('Mary Smith', 'Initech', 'mary@initech.com', '555-987-6543'),
+        ('Ada Lovelace', 'Analytical', None, None),
+    ])
+    report = crm.scan_duplicates()
+    assert report['indexed'] == 4 and report['found'] == 1
+    # The first two share name, email and phone blocks but are compared once.
+    assert report['compared'] == 1
+    pairs = db.execute('SELECT customer_id, duplicate_id, status FROM customer_duplicates').fetchall()
+    assert pairs == [(ids[0], ids[1], 'open')]
+    # Keys are already indexed, and a rescan does not queue the pair again.
+    assert crm.scan_duplicates()['indexed'] == 0
+    assert db.execute('SELECT count(*) FROM customer_duplicates').fetchone()[0] == 1
+
+
+def test_scan_skips_large_blocks(db):
+    insert_customers(db, [(name, 'Switchboard', None, '555-000-0000') for name in ('Ada', 'Alan', 'Grace', 'Linus')])
+    report = crm.scan_duplicates(max_block=3)
+    assert report['skipped_blocks'] == 1 and report['compared'] == 0 and report['found'] == 0
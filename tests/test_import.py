@@ -0,0 +1,15 @@
+import io
+
+import app as crm
+
+
+def test_unreadable_tail_reports_what_was_imported(client, db, monkeypatch):
+    monkeypatch.setattr(crm, 'IMPORT_BATCH_ROWS', 50)
+    rows = ''.join(f'Customer {n},Account {n},c{n}@example.com\n' for n in range(500))
+    data = b'name,account,email\n' + rows.encode() + b'Bad \xff\xfe row,Acme,\n'
+    response = client.post('/import', data={'file': (io.BytesIO(data), 'customers.csv')})
+    assert response.status_code == 400
+    assert response.json['error'].startswith('Could not read file')
+    imported = db.execute('SELECT count(*) FROM customers').fetchone()[0]
+    assert 0 < imported <= 500
+    assert response.json['imported'] == imported
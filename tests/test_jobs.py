@@ -0,0 +1,25 @@
+import threading
+
+import app as crm
+
+
+class IdleExecutor:
+    # Accepts jobs without running them, so they stay queued.
+    def submit(self, fn, *args):
+        pass
+
+
+def test_full_queue_returns_queued_and_skipped_ids(client, db, monkeypatch):
+    monkeypatch.setattr(crm, '_job_queue_slots', threading.BoundedSemaphore(2))
+    monkeypatch.setattr(crm, 'get_job_executor', lambda: IdleExecutor())
+    with db:
+        ids = [crm.create_customer(db.cursor(), f'Customer {n}', f'Account {n}') for n in range(4)]
+    response = client.post('/jobs/insights', json={'customer_ids': ids})
+    assert response.status_code == 202
+    assert sorted(response.json['jobs']) == [str(i) for i in ids[:2]]
+    assert response.json['skipped'] == ids[2:]
+    for job_id in response.json['jobs'].values():
+        assert crm.get_job(job_id)['status'] == 'queued'
+    response = client.post('/jobs/insights', json={'customer_ids': ids[2:]})
+    assert response.status_code == 503
+    assert response.json['skipped'] == ids[2:]
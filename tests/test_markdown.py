@@ -0,0 +1,30 @@
+from app import basic_markdown
+
+
+def test_model_html_is_escaped():
+    html = basic_markdown('<script>alert(1)</script> **b** *i* `<x>`')
+    assert html == '<p>&lt;script&gt;alert(1)&lt;/script&gt; <strong>b</strong> <em>i</em> <code>&lt;x&gt;</code></p>'
+
+
+def test_markup_inside_emphasis_is_escaped():
+    assert basic_markdown('**<img src=x onerror=alert(1)>**') == \
+        '<p><strong>&lt;img src=x onerror=alert(1)&gt;</strong></p>'
+
+
+def test_nested_lists():
+    html = basic_markdown('- a\n  - b\n    1. c\n- d')
+    assert html == '<ul><li>a<ul><li>b<ol><li>c</li></ol></li></ul></li><li>d</li></ul>'
+
+
+def test_numbered_list():
+    assert basic_markdown('1. one\n2. two') == '<ol><li>one</li><li>two</li></ol>'
+
+
+def test_fenced_code_is_literal():
+    html = basic_markdown('# H <i>\n\n```\n<b>**x**</b>\n```\n---\ntext\nmore')
+    assert html == '<h1>H &lt;i&gt;</h1><pre><code>&lt;b&gt;**x**&lt;/b&gt;</code></pre><hr><p>text<br>more</p>'
+
+
+def test_unclosed_fence_and_empty_input():
+    assert basic_markdown('```\ncode') == '<pre><code>code</code></pre>'
+    assert basic_markdown('') == ''
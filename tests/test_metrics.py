@@ -0,0 +1,32 @@
+import app as crm
+
+
+def commit_samples():
+    key = ('crm_sql_query_duration_seconds', crm.sql_labels('COMMIT'))
+    return crm.metrics_snapshot()['histograms'], key
+
+
+def commit_count():
+    histograms, (name, labels) = commit_samples()
+    return sum(sum(values[:-1]) for n, l, values in histograms if n == name and l == labels)
+
+
+def test_with_block_records_commit(db):
+    before = commit_count()
+    with db:
+        crm.create_customer(db.cursor(), 'Ada Lovelace', 'Analytical')
+    assert commit_count() == before + 1
+
+
+def test_read_only_with_block_records_nothing(db):
+    before = commit_count()
+    with db:
+        db.execute('SELECT count(*) FROM customers').fetchone()
+    assert commit_count() == before
+
+
+def test_flush_writes_snapshot(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(crm, 'METRICS_DIR', str(tmp_path))
+    crm.inc('crm_llm_retries_total')
+    crm.flush_metrics()
+    assert (tmp_path / f'{crm.os.getpid()}.json').exists()
@@ -0,0 +1,84 @@
+import base64
+import json
+
+import app as crm
+
+
+def page_through(fetch, limit):
+    rows, after = [], None
+    while True:
+        page, next_cursor = fetch(crm.decode_cursor(after) if after else None, limit)
+        assert len(page) <= limit
+        rows.extend(page)
+        if next_cursor is None:
+            return rows
+        after = next_cursor
+
+
+def test_cursor_round_trip():
+    for key, row_id in [(42, 42), ('smith, john', 7), ('', 3), (None, 5)]:
+        token = crm.encode_cursor(key, row_id)
+        assert '=' not in token
+        assert crm.decode_cursor(token) == (key, row_id)
+
+
+def test_bad_cursor_is_ignored():
+    for token in ['', 'not-a-cursor', crm.encode_cursor('x', 'y')[:-2], 'WzEsMl0x']:
+        assert crm.decode_cursor(token) is None
+
+
+def crafted_cursor(payload):
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+
+def test_malformed_cursor_is_rejected(client):
+    for payload in [[[1], 2], [{'a': 1}, 2], ['x', 1.5], ['x', True], [1, 2, 3], {'key': 1}, 'x']:
+        token = crafted_cursor(payload)
+        assert crm.decode_cursor(token) is None
+        assert client.get('/', query_string={'after': token}).status_code == 200
+        assert client.get('/api/v1/customers', query_string={'after': token}).status_code == 400
+
+
+def test_customer_pages_have_no_gaps_or_repeats(db):
+    names = ['Ada', 'ada', 'Grace', 'Alan', 'Ada', 'Linus', 'grace', 'Edsger', 'Barbara']
+    with db:
+        cur = db.cursor()
+        for name in names:
+            crm.create_customer(cur, name, 'Acme')
+    cur = db.cursor()
+    for sort, direction in [(None, None), ('name', 'asc'), ('name', 'desc'), ('interactions', None)]:
+        full, next_cursor = crm.list_customers(cur, sort=sort, direction=direction, limit=100)
+        assert next_cursor is None and len(full) == len(names)
+        paged = page_through(lambda after, limit: crm.list_customers(cur, sort=sort, direction=direction, after=after, limit=limit), 2)
+        assert [row[0] for row in paged] == [row[0] for row in full]
+
+
+def test_interaction_pages_newest_first(db):
+    with db:
+        cur = db.cursor()
+        customer_id = crm.create_customer(cur, 'Ada Lovelace', 'Acme')
+        for n in range(7):
+            # Pairs of interactions share a date so paging has to break ties on id.
+            crm.add_interaction(cur, customer_id, f'note {n}', f'2025-01-0{n // 2 + 1}T09:00:00')
+    cur = db.cursor()
+    paged = page_through(lambda after, limit: crm.list_interactions(cur, customer_id, after, limit), 3)
+    assert [row[2] for row in paged] == [f'note {n}' for n in (6, 5, 4, 3, 2, 1, 0)]
+
+
+def test_chat_history_rejects_non_scalar_cursor(client):
+    for payload in [[['2025-01-01'], 1], [{'ts': 1}, 1]]:
+        response = client.get('/chat/history', query_string={'before': crafted_cursor(payload)})
+        assert response.status_code == 400
+
+
+def test_undated_interactions_page_last(db):
+    with db:
+        cur = db.cursor()
+        customer_id = crm.create_customer(cur, 'Ada Lovelace', 'Acme')
+        for n in range(3):
+            crm.add_interaction(cur, customer_id, f'note {n}', f'2025-01-0{n + 1}T09:00:00')
+        cur.executemany('INSERT INTO interactions (customer_id, date, note) VALUES (?, NULL, ?)',
+                        [(customer_id, 'undated 0'), (customer_id, 'undated 1')])
+    cur = db.cursor()
+    paged = page_through(lambda after, limit: crm.list_interactions(cur, customer_id, after, limit), 2)
+    assert [row[2] for row in paged] == ['note 2', 'note 1', 'note 0', 'undated 1', 'undated 0']
@@ -0,0 +1,99 @@
+import gc
+import json
+import time
+
+import pytest
+
+import app as crm
+from bench import StubLLMHandler, start_stub_llm
+
+REPLY = 'Call **Ada** this week.\n- Offer the annual plan.\n- Send the pricing sheet.'
+
+
+@pytest.fixture(scope='module')
+def stub_server():
+    server = start_stub_llm()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def llm(stub_server, client, monkeypatch):
+    monkeypatch.setattr(StubLLMHandler, 'reply', REPLY)
+    monkeypatch.setattr(StubLLMHandler, 'token_delay', 0.02)
+    monkeypatch.setattr(StubLLMHandler, 'fail_after', None)
+    monkeypatch.setattr(crm, 'CHAT_RETENTION_DAYS', 0)
+    # The client is built per API key and reads GROQ_BASE_URL when built.
+    monkeypatch.setattr(crm, '_llm_client', None)
+    return StubLLMHandler
+
+
+def stream_events(client, message):
+    # (seconds since the request, event, data) for each SSE frame as it arrives.
+    start = time.perf_counter()
+    response = client.post('/chat/stream', json={'message': message}, buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    events, buffer = [], ''
+    for chunk in response.response:
+        buffer += chunk.decode() if isinstance(chunk, bytes) else chunk
+        while '\n\n' in buffer:
+            frame, buffer = buffer.split('\n\n', 1)
+            fields = dict(line.split(': ', 1) for line in frame.splitlines())
+            events.append((time.perf_counter() - start, fields['event'], json.loads(fields['data'])))
+    response.close()
+    return response, events
+
+
+def test_tokens_arrive_before_the_reply_finishes(llm, client):
+    _, events = stream_events(client, 'What next with Ada?')
+    kinds = [event for _, event, _ in events]
+    assert kinds[-1] == 'done'
+    assert kinds.count('delta') + kinds.count('html') >= 5
+    first, last = events[0][0], events[-1][0]
+    # About 14 tokens at 20 ms each: the first must not wait for the rest.
+    assert last - first > 0.15
+    assert 'html' in kinds  # completed lines are re-rendered as Markdown
+
+
+def test_full_reply_is_persisted(llm, client, db):
+    response, events = stream_events(client, 'What next with Ada?')
+    done = events[-1][2]
+    assert done['text'] == REPLY.strip()
+    assert '<strong>Ada</strong>' in done['html']
+    row = db.execute('SELECT user_message, ai_text, ai_response, session_id FROM chat_history ORDER BY id DESC LIMIT 1').fetchone()
+    assert row[:3] == ('What next with Ada?', REPLY.strip(), done['html'])
+    assert row[3] == response.headers['X-Chat-Session']
+
+
+def test_error_mid_stream_is_reported_and_not_saved(llm, client, db):
+    llm.fail_after = 3
+    _, events = stream_events(client, 'What next with Ada?')
+    kinds = [event for _, event, _ in events]
+    assert kinds[:3] == ['delta', 'delta', 'delta']
+    assert kinds[-1] == 'error'
+    assert 'done' not in kinds
+    assert db.execute('SELECT count(*) FROM chat_history').fetchone()[0] == 0
+
+
+def test_key_change_closes_old_client_once_unused(monkeypatch):
+    monkeypatch.setattr(crm, '_llm_client', None)
+    old = crm.get_llm_client('first-key')
+    assert crm.get_llm_client('first-key') is old
+    new = crm.get_llm_client('second-key')
+    assert new is not old
+    # A caller still holding the old client can keep using it.
+    http_client = old._client
+    assert not http_client.is_closed
+    del old
+    gc.collect()
+    assert http_client.is_closed and not new._client.is_closed
+    new.close()
+
+
+@pytest.mark.parametrize('route', ['/chat', '/chat/stream'])
+@pytest.mark.parametrize('session_id', [123, ['a'], {'id': 'a'}, 'not-hex'])
+def test_bad_session_id_is_rejected(client, route, session_id):
+    response = client.post(route, json={'message': 'hello', 'session_id': session_id})
+    assert response.status_code == 400
+    assert response.json == {'error': 'Invalid session_id'}
@@ -0,0 +1,38 @@
+import app as crm
+
+
+def test_activity_with_undated_interactions(db):
+    with db:
+        cur = db.cursor()
+        customer_id = crm.create_customer(cur, 'Alan Turing', 'Bletchley')
+        cur.execute('INSERT INTO interactions (customer_id, date, note) VALUES (?, NULL, ?)', (customer_id, 'undated'))
+    assert crm.customer_activity(db.cursor(), customer_id) == '1 interactions, first ?, last ?'
+    assert 'undated' in crm.insight_prompt(db.cursor(), customer_id)[1]
+
+
+def test_summary_follows_interactions(db):
+    with db:
+        cur = db.cursor()
+        customer_id = crm.create_customer(cur, 'Alan Turing', 'Bletchley')
+        crm.add_interaction(cur, customer_id, 'first', '2025-01-01T09:00:00')
+        last = crm.add_interaction(cur, customer_id, 'second', '2025-02-01T09:00:00')
+    assert crm.customer_activity(db.cursor(), customer_id) == '2 interactions, first 2025-01-01, last 2025-02-01'
+    with db:
+        crm.remove_interaction(db.cursor(), last)
+    assert crm.customer_activity(db.cursor(), customer_id) == '1 interactions, first 2025-01-01, last 2025-01-01'
+
+
+def test_customer_without_summary_row_is_listed(client, db):
+    with db:
+        cur = db.cursor()
+        kept = crm.create_customer(cur, 'Alan Turing', 'Bletchley')
+        lost = crm.create_customer(cur, 'Grace Hopper', 'Navy')
+        crm.add_interaction(cur, lost, 'compiler', '2025-01-01T09:00:00')
+        cur.execute('DELETE FROM customer_summary WHERE customer_id = ?', (lost,))
+    rows, _ = crm.list_customers(db.cursor())
+    assert {row[0]: row[7] for row in rows} == {kept: 0, lost: 0}
+    assert {c['id'] for c in client.get('/api/v1/customers').json['customers']} == {kept, lost}
+    with db:
+        crm._migrate_customer_summary_backfill(db.cursor())
+    rows, _ = crm.list_customers(db.cursor(), sort='interactions')
+    assert [(row[0], row[7]) for row in rows] == [(lost, 1), (kept, 0)]
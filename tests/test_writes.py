@@ -0,0 +1,46 @@
+import sqlite3
+
+import pytest
+
+import app as crm
+
+
+def add_note(client, customer_id, note):
+    return client.post(f'/interactions/{customer_id}', data={'note': note})
+
+
+def test_default_write_mode_is_commit():
+    assert crm.WRITE_MODE == 'commit'
+
+
+def test_write_sync_applies_to_every_connection(db, monkeypatch):
+    assert db.execute('PRAGMA synchronous').fetchone()[0] == 1
+    monkeypatch.setattr(crm, 'WRITE_SYNC', 'full')
+    crm.close_db()
+    assert crm.get_db().execute('PRAGMA synchronous').fetchone()[0] == 2
+
+
+def test_group_commit_reads_own_writes(client, db, monkeypatch):
+    monkeypatch.setattr(crm, 'WRITE_MODE', 'group')
+    monkeypatch.setattr(crm, '_write_queue', None)
+    with db:
+        customer_id = crm.create_customer(db.cursor(), 'Edsger Dijkstra', 'Eindhoven')
+    add_note(client, customer_id, 'shortest path')
+    page = client.get(f'/interactions/{customer_id}')
+    assert b'shortest path' in page.data
+
+
+def test_failing_write_does_not_undo_batch(db, monkeypatch):
+    monkeypatch.setattr(crm, 'WRITE_MODE', 'group')
+    monkeypatch.setattr(crm, '_write_queue', None)
+    with db:
+        customer_id = crm.create_customer(db.cursor(), 'Edsger Dijkstra', 'Eindhoven')
+
+    def broken(cur):
+        cur.execute('INSERT INTO no_such_table VALUES (1)')
+
+    crm.queued_write(crm.add_interaction, customer_id, 'kept')
+    with pytest.raises(sqlite3.OperationalError):
+        crm.queued_write(broken)
+    notes = [row[2] for row in crm.list_interactions(db.cursor(), customer_id)[0]]
+    assert notes == ['kept']